@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+POLL_INTERVAL = 0.2
+
+
+def setup_environment(args, work_dir):
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    adb_path = os.path.join(bin_dir, 'adb')
+    with open(adb_path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec {sys.executable} {os.path.join(BENCH_DIR, "fake_adb.py")} "$@"\n')
+    os.chmod(adb_path, 0o755)
+    os.environ.update({
+        'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+        'FAKE_ADB_ROOT': os.path.join(work_dir, 'devices'),
+        'FAKE_ADB_DEVICES': str(args.devices),
+        'FAKE_ADB_BANDWIDTH': str(args.bandwidth),
+        'FAKE_ADB_LATENCY': str(args.adb_latency),
+        'MUSE_ADB_BACKEND': 'cli',
+        'MUSE_SERVER_CACHE_DIR': os.path.join(work_dir, 'server'),
+        'MUSE_CACHE_DIR': os.path.join(work_dir, 'client'),
+    })
+
+
+def start_server(mode, port):
+    if mode == 'aiohttp':
+        from aiohttp import web
+        from muse.aio_server import create_app
+
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(create_app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+    else:
+        from werkzeug.serving import make_server
+        from muse.server import app
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', port, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def start_scheduler():
+    from muse.scheduler import Scheduler
+
+    scheduler = Scheduler()
+    threading.Thread(target=scheduler.loop, daemon=True).start()
+    return scheduler
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'mean': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        for offset in range(0, size, 1 << 20):
+            f.write(os.urandom(min(1 << 20, size - offset)))
+
+
+def get_adb_transfers():
+    from muse.device_manager import TRANSFER_BYTES, TRANSFER_SECONDS
+
+    transfers = {}
+    for counter, index in ((TRANSFER_BYTES, 0), (TRANSFER_SECONDS, 1)):
+        for (device_id, direction), value in counter.values.items():
+            transfers.setdefault(direction, [0, 0])[index] += value
+    return transfers
+
+
+async def wait_devices(client, num_devices, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if len(await client.list_devices()) >= num_devices:
+            return
+        await asyncio.sleep(POLL_INTERVAL)
+    raise RuntimeError(f'{num_devices} fake device(s) did not show up')
+
+
+async def wait_tasks(client, tasks):
+    from muse.log_stream import is_finished_status
+
+    results = {}
+    pending = list(tasks)
+    while pending:
+        for _id, task_info in (await client.query_tasks(pending)).items():
+            if is_finished_status(task_info['status']):
+                results[_id] = task_info
+        pending = [task for task in pending if task._id not in results]
+        if pending:
+            await asyncio.sleep(POLL_INTERVAL)
+    return [results[task._id] for task in tasks]
+
+
+def get_specs(args, num_tasks, cmd, output_files=()):
+    return [{
+        'hint_device_id': f'fake-{i % args.devices:04d}',
+        'cmd': [cmd],
+        'output_files': list(output_files),
+    } for i in range(num_tasks)]
+
+
+async def bench_dispatch(client, args, work_dir):
+    input_path = os.path.join(work_dir, 'dispatch.txt')
+    with open(input_path, 'w') as f:
+        f.write('dispatch\n')
+
+    start_time = time.time()
+    tasks = await client.create_tasks(
+            get_specs(args, args.tasks, f'sleep {args.run_seconds}'), [input_path], lease_duration=3600)
+    submit_time = time.time() - start_time
+    task_infos = await wait_tasks(client, tasks)
+    drain_time = time.time() - start_time
+
+    return {
+        'tasks': len(tasks),
+        'failed': sum(task_info['status'] != 'COMPLETED' for task_info in task_infos),
+        'submit_seconds': submit_time,
+        'queue_drain_seconds': drain_time,
+        'tasks_per_second': len(tasks) / drain_time,
+        'dispatch_latency': summarize([
+            task_info['start_time'] - task_info['input_ready_time']
+            for task_info in task_infos if 'start_time' in task_info]),
+        'end_to_end_latency': summarize([
+            task_info['finish_time'] - task_info['create_time']
+            for task_info in task_infos if 'finish_time' in task_info]),
+    }
+
+
+async def bench_transfer(client, args, work_dir):
+    input_size = int(args.input_mb * 1024 ** 2)
+    output_size = int(args.output_mb * 1024 ** 2)
+    input_path = os.path.join(work_dir, 'transfer.bin')
+    write_random_file(input_path, input_size)
+
+    prev_transfers = get_adb_transfers()
+    start_time = time.time()
+    tasks = await client.create_tasks(
+            get_specs(args, args.devices, f'head -c {output_size} /dev/urandom > out.bin', ['out.bin']),
+            [input_path], lease_duration=3600)
+    upload_time = time.time() - start_time
+    task_infos = await wait_tasks(client, tasks)
+
+    async def download(task):
+        directory = os.path.join(work_dir, 'download', task._id)
+        os.makedirs(directory)
+        await task.extract_outputs(directory=directory)
+
+    start_time = time.time()
+    await asyncio.gather(*[download(task) for task in tasks])
+    download_time = time.time() - start_time
+
+    adb_speeds = {}
+    for direction, (num_bytes, time_cost) in get_adb_transfers().items():
+        prev_bytes, prev_time_cost = prev_transfers.get(direction, (0, 0))
+        if time_cost > prev_time_cost:
+            adb_speeds[direction] = (num_bytes - prev_bytes) / (time_cost - prev_time_cost) / 1024 ** 2
+
+    return {
+        'tasks': len(tasks),
+        'failed': sum(task_info['status'] != 'COMPLETED' for task_info in task_infos),
+        'upload_mb_per_second': input_size / upload_time / 1024 ** 2,
+        'download_mb_per_second': len(tasks) * output_size / download_time / 1024 ** 2,
+        'adb_mb_per_second': adb_speeds,
+        'push_stage_mb_per_second': summarize([
+            input_size / (task_info['run_start_time'] - task_info['start_time']) / 1024 ** 2
+            for task_info in task_infos if 'run_start_time' in task_info]),
+        'pull_stage_mb_per_second': summarize([
+            output_size / (task_info['pull_end_time'] - task_info['run_end_time']) / 1024 ** 2
+            for task_info in task_infos if 'pull_end_time' in task_info]),
+    }
+
+
+async def bench_log_streams(client, args, work_dir):
+    log_size = int(args.log_mb * 1024 ** 2)
+    input_path = os.path.join(work_dir, 'log.txt')
+    with open(input_path, 'w') as f:
+        f.write('log\n')
+
+    cmd = f'yes 0123456789abcdef0123456789abcdef0123456789abcdef0123456789abcde | head -c {log_size}'
+    tasks = await client.create_tasks(get_specs(args, args.devices, cmd), [input_path], lease_duration=3600)
+    received = []
+
+    async def watch(task):
+        num_bytes = 0
+
+        def output(log, data):
+            nonlocal num_bytes
+            num_bytes += len(data)
+
+        await task.monitor_task(output)
+        received.append(num_bytes)
+
+    start_time = time.time()
+    await asyncio.gather(*[watch(task) for task in tasks for _ in range(args.watchers)])
+    time_cost = time.time() - start_time
+
+    return {
+        'streams': len(received),
+        'incomplete': sum(num_bytes != log_size for num_bytes in received),
+        'seconds': time_cost,
+        'mb_per_second': sum(received) / time_cost / 1024 ** 2,
+    }
+
+
+async def run_benchmarks(args, work_dir):
+    from muse.aio_client import AsyncMuseClient
+
+    async with AsyncMuseClient(f'http://127.0.0.1:{args.port}/') as client:
+        await wait_devices(client, args.devices)
+        return {
+            'dispatch': await bench_dispatch(client, args, work_dir),
+            'transfer': await bench_transfer(client, args, work_dir),
+            'log_streams': await bench_log_streams(client, args, work_dir),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the Muse server and scheduler against fake devices')
+    parser.add_argument('--mode', choices=['flask', 'aiohttp'], default='flask')
+    parser.add_argument('--port', type=int, default=10923)
+    parser.add_argument('--devices', type=int, default=8, help='number of fake devices')
+    parser.add_argument('--bandwidth', type=float, default=40, help='fake adb MB/s per transfer, 0 for unlimited')
+    parser.add_argument('--adb-latency', type=float, default=0.01, help='seconds added to every adb call')
+    parser.add_argument('--tasks', type=int, default=200, help='tasks submitted for the dispatch benchmark')
+    parser.add_argument('--run-seconds', type=float, default=0.1, help='command duration of dispatch tasks')
+    parser.add_argument('--input-mb', type=float, default=64)
+    parser.add_argument('--output-mb', type=float, default=16)
+    parser.add_argument('--log-mb', type=float, default=8, help='log volume written by each task')
+    parser.add_argument('--watchers', type=int, default=4, help='clients following each task log')
+    parser.add_argument('--log-level', type=str, default='ERROR')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--output', type=str, default=None, help='write results as JSON')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='muse_bench_load_')
+    setup_environment(args, work_dir)
+
+    from loguru import logger
+    from local_db import install_local_db
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    install_local_db()
+    try:
+        start_server(args.mode, args.port)
+        start_scheduler()
+        results = {'config': vars(args), 'results': asyncio.run(run_benchmarks(args, work_dir))}
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from bson import ObjectId
+
+
+def start_server(mode, port, cache_dir):
+    env = dict(os.environ, MUSE_SERVER_MODE=mode, MUSE_SERVER_PORT=str(port), MUSE_SERVER_CACHE_DIR=cache_dir)
+    process = subprocess.Popen(
+            [sys.executable, '-m', 'muse.server'], env=env, start_new_session=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process
+
+
+def stop_server(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait()
+
+
+async def wait_server(url, timeout=30):
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            try:
+                async with session.get(f'{url}task/list') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'Server at {url} did not start')
+
+
+async def bench_download(url, task_id, num_clients, archive_size):
+    async def download(session):
+        size = 0
+        async with session.get(f'{url}task/download/{task_id}') as response:
+            async for data in response.content.iter_chunked(1 << 20):
+                size += len(data)
+        assert size == archive_size
+
+    async with aiohttp.ClientSession() as session:
+        start_time = time.time()
+        await asyncio.gather(*[download(session) for _ in range(num_clients)])
+        time_cost = time.time() - start_time
+    return {'seconds': time_cost, 'mb_per_second': num_clients * archive_size / time_cost / 1024 ** 2}
+
+
+async def bench_upload(url, num_clients, blob_size):
+    blobs = [os.urandom(blob_size) for _ in range(num_clients)]
+
+    async def upload(session, data):
+        blob_hash = hashlib.sha256(data).hexdigest()
+        async with session.post(f'{url}blob/upload/{blob_hash}', data=data) as response:
+            assert response.status == 200
+
+    async with aiohttp.ClientSession() as session:
+        start_time = time.time()
+        await asyncio.gather(*[upload(session, data) for data in blobs])
+        time_cost = time.time() - start_time
+    return {'seconds': time_cost, 'mb_per_second': num_clients * blob_size / time_cost / 1024 ** 2}
+
+
+async def bench_log_streams(url, colle_tasks, log_path, num_streams):
+    from muse.events import publish_task_event
+
+    task_id = ObjectId()
+    open(log_path, 'wb').close()
+    colle_tasks.insert_one({
+        '_id': task_id, 'status': 'RUNNING', 'stdout': log_path, 'stderr': log_path,
+        'lease_duration': 3600, 'lease_expire_time': time.time() + 3600})
+    marker = b'benchmark-marker\n'
+    received = {}
+
+    async def stream(session, i):
+        async with session.get(f'{url}task/log/{task_id}/stdout') as response:
+            async for data in response.content.iter_any():
+                if marker in data and i not in received:
+                    received[i] = time.time()
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        tasks = [asyncio.ensure_future(stream(session, i)) for i in range(num_streams)]
+        await asyncio.sleep(2.0)
+        start_time = time.time()
+        with open(log_path, 'ab') as f:
+            f.write(marker)
+        while len(received) < num_streams and time.time() - start_time < 30:
+            await asyncio.sleep(0.01)
+        delivered = len(received)
+        latencies = sorted(t - start_time for t in received.values())
+
+        colle_tasks.update_one({'_id': task_id}, {'$set': {'status': 'COMPLETED'}})
+        publish_task_event(task_id, 'COMPLETED')
+        finish_time = time.time()
+        await asyncio.wait(tasks, timeout=30)
+        close_time = time.time() - finish_time
+
+    return {
+        'streams': num_streams,
+        'delivered': delivered,
+        'p50_latency': latencies[len(latencies) // 2] if latencies else None,
+        'max_latency': latencies[-1] if latencies else None,
+        'seconds_to_close_all': close_time,
+    }
+
+
+async def bench_mode(mode, args):
+    from muse.db import get_colle
+
+    cache_dir = tempfile.mkdtemp(prefix=f'muse_bench_{mode}_')
+    url = f'http://127.0.0.1:{args.port}/'
+    process = start_server(mode, args.port, cache_dir)
+    try:
+        await wait_server(url)
+
+        task_id = ObjectId()
+        output_dir = os.path.join(cache_dir, 'output_archive')
+        with open(os.path.join(output_dir, f'{task_id}.tar'), 'wb') as f:
+            f.write(os.urandom(args.archive_size))
+
+        return {
+            'download': await bench_download(url, task_id, args.clients, args.archive_size),
+            'upload': await bench_upload(url, args.clients, args.blob_size),
+            'log_streams': await bench_log_streams(
+                url, get_colle('tasks'), os.path.join(cache_dir, 'log', 'bench_out.log'), args.streams),
+        }
+    finally:
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the Flask and aiohttp Muse servers')
+    parser.add_argument('--modes', nargs='+', default=['flask', 'aiohttp'])
+    parser.add_argument('--port', type=int, default=10913)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--archive-size', type=int, default=128 * 1024 ** 2)
+    parser.add_argument('--blob-size', type=int, default=32 * 1024 ** 2)
+    parser.add_argument('--streams', type=int, default=500)
+    parser.add_argument('--output', type=str, default=None, help='write results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes:
+        results[mode] = asyncio.run(bench_mode(mode, args))
+        print(mode, json.dumps(results[mode], indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import os
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.getenv('FAKE_ADB_ROOT', '/tmp/fake_adb')
+NUM_DEVICES = int(os.getenv('FAKE_ADB_DEVICES', 4))
+BANDWIDTH = float(os.getenv('FAKE_ADB_BANDWIDTH', 0)) * 1024 ** 2
+LATENCY = float(os.getenv('FAKE_ADB_LATENCY', 0))
+REMOTE_ROOT = '/data/local/tmp'
+CHUNK_SIZE = 1 << 16
+
+SHELL_PRELUDE = '''
+getprop() {
+    case "$1" in
+        ro.product.model) echo "Fake Phone";;
+        persist.muse.labels) echo "fake,$FAKE_ADB_SERIAL";;
+    esac
+}
+dumpsys() {
+    case "$1" in
+        input_method) echo "mSystemReady=true mScreenOn=true";;
+        battery) echo "  level: 100";;
+    esac
+}
+sh() {
+    # scripts pushed to the device, such as the cache sync script, hold device paths as well
+    if [ $# -eq 1 ] && [ -f "$1" ]; then
+        sed "s#$FAKE_ADB_REMOTE_ROOT#$FAKE_ADB_DEVICE_ROOT#g" "$1" | bash -s
+    else
+        command sh "$@"
+    fi
+}
+'''
+
+
+def get_serials():
+    return [f'fake-{i:04d}' for i in range(NUM_DEVICES)]
+
+
+def get_device_root(serial):
+    return os.path.join(ROOT, serial)
+
+
+def to_local(serial, path):
+    return path.replace(REMOTE_ROOT, get_device_root(serial))
+
+
+class Throttle:
+    def __init__(self, bandwidth=BANDWIDTH):
+        self.bandwidth = bandwidth
+        self.start_time = time.time()
+        self.num_bytes = 0
+
+    def __call__(self, num_bytes):
+        self.num_bytes += num_bytes
+        if self.bandwidth:
+            delay = self.start_time + self.num_bytes / self.bandwidth - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def copy_file(src, dst):
+    throttle = Throttle()
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        while True:
+            data = fin.read(CHUNK_SIZE)
+            if not data:
+                break
+            throttle(len(data))
+            fout.write(data)
+
+
+def pump(fin, fout):
+    throttle = Throttle()
+    try:
+        while True:
+            data = os.read(fin.fileno(), CHUNK_SIZE)
+            if not data:
+                break
+            throttle(len(data))
+            fout.write(data)
+            fout.flush()
+    except BrokenPipeError:
+        pass
+    finally:
+        fout.close()
+
+
+def run_shell(serial, remote_cmd, stdin=None, stdout=None):
+    os.makedirs(get_device_root(serial), exist_ok=True)
+    env = dict(
+            os.environ, FAKE_ADB_SERIAL=serial, FAKE_ADB_REMOTE_ROOT=REMOTE_ROOT,
+            FAKE_ADB_DEVICE_ROOT=get_device_root(serial))
+    return subprocess.Popen(
+            ['bash', '-c', SHELL_PRELUDE + to_local(serial, remote_cmd)], stdin=stdin, stdout=stdout, env=env)
+
+
+def main_device(serial, cmd, args):
+    if serial not in get_serials():
+        print(f"adb: device '{serial}' not found", file=sys.stderr)
+        return 1
+    if cmd == 'shell':
+        return run_shell(serial, ' '.join(args)).wait()
+    if cmd == 'exec-in':
+        process = run_shell(serial, ' '.join(args), stdin=subprocess.PIPE)
+        pump(sys.stdin.buffer, process.stdin)
+        return process.wait()
+    if cmd == 'exec-out':
+        process = run_shell(serial, ' '.join(args), stdout=subprocess.PIPE)
+        pump(process.stdout, sys.stdout.buffer)
+        return process.wait()
+    if cmd == 'push':
+        *srcs, dst = [arg for arg in args if arg != '--sync']
+        dst = to_local(serial, dst)
+        for src in srcs:
+            path = os.path.join(dst, os.path.basename(src)) if os.path.isdir(dst) else dst
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            copy_file(src, path)
+        return 0
+    if cmd == 'pull':
+        copy_file(to_local(serial, args[0]), args[1])
+        return 0
+    print(f'adb: unknown command {cmd}', file=sys.stderr)
+    return 1
+
+
+def main():
+    args = sys.argv[1:]
+    time.sleep(LATENCY)
+    if args[:1] == ['-s']:
+        sys.exit(main_device(args[1], args[2], args[3:]))
+    if args[:1] == ['devices']:
+        print('List of devices attached')
+        for serial in get_serials():
+            print(f'{serial}\tdevice')
+        return
+    if args[:1] == ['track-devices']:
+        body = ''.join(f'{serial}\tdevice\n' for serial in get_serials())
+        sys.stdout.write(f'{len(body):04x}{body}')
+        sys.stdout.flush()
+        threading.Event().wait()
+    if args[:1] in (['start-server'], ['kill-server']):
+        return
+    print(f'adb: unknown command {" ".join(args)}', file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import inspect
+import time
+from threading import RLock
+
+import mongomock
+from bson import ObjectId
+
+import muse.db
+import muse.events
+import muse.log_stream
+import muse.scheduler
+from muse.db import get_colle
+from muse.events import EVENTS_COLLE_NAME, EventWatcher
+
+POLL_INTERVAL = 0.02
+# mongomock is not thread-safe, the server and the scheduler share its collections from many threads
+DB_LOCK = RLock()
+
+
+def locked(method):
+    def wrapper(*args, **kwargs):
+        with DB_LOCK:
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def bulk_write(self, requests, ordered=True):
+    # mongomock cannot build pymongo>=4.9 UpdateOne requests
+    for request in requests:
+        self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+
+class PollingEventWatcher(EventWatcher):
+    # mongomock has neither change streams nor tailable cursors
+    def run(self):
+        colle_events = get_colle(EVENTS_COLLE_NAME)
+        last_id = ObjectId()
+        while True:
+            for event in colle_events.find({'_id': {'$gt': last_id}}).sort('_id', 1):
+                last_id = event['_id']
+                self.callback(event)
+            time.sleep(POLL_INTERVAL)
+
+
+def install_local_db():
+    muse.db.MongoClient = mongomock.MongoClient
+    # mongomock has no capped collections, keep publishing events to a plain one
+    muse.events.supports_change_streams = lambda: False
+    muse.events.ensure_event_log = lambda: None
+    mongomock.Collection.bulk_write = bulk_write
+    for cls in (mongomock.Collection, mongomock.collection.Cursor):
+        for name, method in list(vars(cls).items()):
+            if inspect.isfunction(method) and (not name.startswith('_') or name == '__next__'):
+                setattr(cls, name, locked(method))
+    muse.log_stream.EventWatcher = PollingEventWatcher
+    muse.scheduler.EventWatcher = PollingEventWatcher
@@ -0,0 +1,299 @@
+import select
+import socket
+import struct
+import subprocess
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from loguru import logger
+
+from muse.exceptions import AdbError, AdbCancelled
+from muse.server_settings import ADB_SERVER_HOST, ADB_SERVER_PORT
+
+SYNC_DATA_MAX = 64 * 1024
+SHELL_PACKET_MAX = 32 * 1024
+SYNC_POOL_IDLE_TIME = 30.0
+
+SHELL_STDIN = 0
+SHELL_STDOUT = 1
+SHELL_STDERR = 2
+SHELL_EXIT = 3
+SHELL_CLOSE_STDIN = 4
+
+
+class AdbConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.settimeout(None)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.sock.close()
+
+    def abort(self):
+        # wakes up a thread blocked on this socket, called when its terminate flag is set
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def is_stale(self):
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    @contextmanager
+    def cancellable(self, terminate_flag):
+        if terminate_flag is None:
+            yield
+            return
+        if terminate_flag.is_set():
+            raise AdbCancelled('Cancelled')
+        timeout = terminate_flag.remaining()
+        if timeout is not None:
+            self.sock.settimeout(timeout)
+        try:
+            with terminate_flag.watch(self.abort):
+                yield
+        except (AdbError, OSError):
+            if terminate_flag.is_set():
+                raise AdbCancelled('Cancelled')
+            raise
+        finally:
+            if timeout is not None:
+                self.sock.settimeout(None)
+
+    def send_all(self, data, terminate_flag=None):
+        with self.cancellable(terminate_flag):
+            self.sock.sendall(data)
+
+    def recv_exact(self, size, terminate_flag=None):
+        with self.cancellable(terminate_flag):
+            while len(self.buffer) < size:
+                data = self.sock.recv(max(size - len(self.buffer), SYNC_DATA_MAX))
+                if not data:
+                    raise AdbError('Connection closed by adb')
+                self.buffer += data
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def recv_some(self, terminate_flag=None):
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            return data
+        with self.cancellable(terminate_flag):
+            data = self.sock.recv(SYNC_DATA_MAX)
+        if not data and terminate_flag is not None and terminate_flag.is_set():
+            raise AdbCancelled('Cancelled')
+        return data
+
+    def read_status(self):
+        status = self.recv_exact(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbError(self.read_hex_block().decode(errors='replace'))
+        raise AdbError(f'Unexpected adb status {status!r}')
+
+    def read_hex_block(self, terminate_flag=None):
+        size = int(self.recv_exact(4, terminate_flag), 16)
+        return self.recv_exact(size, terminate_flag)
+
+    def request(self, service):
+        payload = service.encode()
+        self.send_all(b'%04x' % len(payload) + payload)
+        self.read_status()
+
+
+class ShellSession:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write_stdin(self, data, terminate_flag=None):
+        view = memoryview(data)
+        for i in range(0, len(view), SHELL_PACKET_MAX):
+            chunk = view[i:i + SHELL_PACKET_MAX]
+            self.conn.send_all(struct.pack('<BI', SHELL_STDIN, len(chunk)) + chunk, terminate_flag)
+
+    def close_stdin(self, terminate_flag=None):
+        self.conn.send_all(struct.pack('<BI', SHELL_CLOSE_STDIN, 0), terminate_flag)
+
+    def read_packet(self, terminate_flag=None):
+        packet_id, size = struct.unpack('<BI', self.conn.recv_exact(5, terminate_flag))
+        return packet_id, self.conn.recv_exact(size, terminate_flag)
+
+    def wait(self, stdout=None, stderr=None, terminate_flag=None):
+        while True:
+            packet_id, data = self.read_packet(terminate_flag)
+            if packet_id == SHELL_STDOUT and stdout is not None:
+                stdout.write(data)
+            elif packet_id == SHELL_STDERR and stderr is not None:
+                stderr.write(data)
+            elif packet_id == SHELL_EXIT:
+                return data[0]
+
+    def close(self):
+        self.conn.close()
+
+
+class ExecSession:
+    # exec: carries raw stdin/stdout without exit status, like `adb exec-in` and `adb exec-out`
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write_stdin(self, data, terminate_flag=None):
+        self.conn.send_all(data, terminate_flag)
+
+    def close_stdin(self, terminate_flag=None):
+        self.conn.sock.shutdown(socket.SHUT_WR)
+
+    def wait(self, stdout=None, stderr=None, terminate_flag=None):
+        while True:
+            data = self.conn.recv_some(terminate_flag)
+            if not data:
+                return 0
+            if stdout is not None:
+                stdout.write(data)
+
+    def close(self):
+        self.conn.close()
+
+
+class SyncConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send_request(self, command, data=b'', terminate_flag=None):
+        self.conn.send_all(command + struct.pack('<I', len(data)) + data, terminate_flag)
+
+    def read_response(self, terminate_flag=None):
+        command, size = struct.unpack('<4sI', self.conn.recv_exact(8, terminate_flag))
+        if command == b'FAIL':
+            raise AdbError(self.conn.recv_exact(size, terminate_flag).decode(errors='replace'))
+        return command, size
+
+    def push(self, fileobj, remote_path, mode=0o644, terminate_flag=None):
+        self.send_request(b'SEND', f'{remote_path},{0o100000 | mode}'.encode(), terminate_flag)
+        num_bytes = 0
+        while True:
+            data = fileobj.read(SYNC_DATA_MAX)
+            if not data:
+                break
+            self.send_request(b'DATA', data, terminate_flag)
+            num_bytes += len(data)
+        self.conn.send_all(b'DONE' + struct.pack('<I', int(time.time())), terminate_flag)
+        command, _ = self.read_response(terminate_flag)
+        if command != b'OKAY':
+            raise AdbError(f'Unexpected sync response {command!r}')
+        return num_bytes
+
+    def pull(self, remote_path, fileobj, terminate_flag=None):
+        self.send_request(b'RECV', remote_path.encode(), terminate_flag)
+        num_bytes = 0
+        while True:
+            command, size = self.read_response(terminate_flag)
+            if command == b'DONE':
+                return num_bytes
+            if command != b'DATA':
+                raise AdbError(f'Unexpected sync response {command!r}')
+            fileobj.write(self.conn.recv_exact(size, terminate_flag))
+            num_bytes += size
+
+
+class AdbClient:
+    def __init__(self, host=ADB_SERVER_HOST, port=ADB_SERVER_PORT):
+        self.host = host
+        self.port = port
+        self.features = {}
+        self.sync_pool = {}
+        self.lock = Lock()
+
+    def connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=10)
+        except ConnectionRefusedError:
+            logger.warning('adb server is not running, starting it')
+            subprocess.call(['adb', 'start-server'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            sock = socket.create_connection((self.host, self.port), timeout=10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return AdbConnection(sock)
+
+    def host_query(self, service):
+        conn = self.connect()
+        try:
+            conn.request(service)
+            return conn.read_hex_block().decode(errors='replace')
+        finally:
+            conn.close()
+
+    def devices(self):
+        return self.host_query('host:devices')
+
+    def track_devices(self):
+        conn = self.connect()
+        try:
+            conn.request('host:track-devices')
+            while True:
+                yield conn.read_hex_block().decode(errors='replace')
+        finally:
+            conn.close()
+
+    def get_features(self, serial):
+        with self.lock:
+            features = self.features.get(serial)
+        if features is None:
+            features = set(self.host_query(f'host-serial:{serial}:features').split(','))
+            with self.lock:
+                self.features[serial] = features
+        return features
+
+    def open_service(self, serial, service):
+        conn = self.connect()
+        try:
+            conn.request(f'host:transport:{serial}')
+            conn.request(service)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def shell(self, serial, cmd):
+        if 'shell_v2' not in self.get_features(serial):
+            raise AdbError(f'Device {serial} does not support shell protocol v2')
+        return ShellSession(self.open_service(serial, f'shell,v2,raw:{cmd}'))
+
+    def exec(self, serial, cmd):
+        return ExecSession(self.open_service(serial, f'exec:{cmd}'))
+
+    def acquire_sync(self, serial):
+        now = time.time()
+        with self.lock:
+            idle = self.sync_pool.get(serial, [])
+            while idle:
+                conn, idle_since = idle.pop()
+                if now - idle_since < SYNC_POOL_IDLE_TIME and not conn.is_stale():
+                    return conn
+                conn.close()
+        return self.open_service(serial, 'sync:')
+
+    def release_sync(self, serial, conn):
+        with self.lock:
+            self.sync_pool.setdefault(serial, []).append((conn, time.time()))
+
+    @contextmanager
+    def sync(self, serial):
+        conn = self.acquire_sync(serial)
+        try:
+            yield SyncConnection(conn)
+        except BaseException:
+            conn.close()
+            raise
+        self.release_sync(serial, conn)
+
+    def forget_device(self, serial):
+        with self.lock:
+            self.features.pop(serial, None)
+            for conn, _ in self.sync_pool.pop(serial, []):
+                conn.close()
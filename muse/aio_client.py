@@ -0,0 +1,430 @@
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+
+import aiohttp
+from humanize import naturalsize
+from loguru import logger
+
+from muse.client import Task
+from muse.client_settings import (
+    EMPTY_FILENAME, SERVER_URL, TASK_EVENT_TIMEOUT, TRANSFER_CONNECTIONS, TRANSFER_CHUNK_SIZE, TRANSFER_RETRIES,
+    TRANSFER_COMPRESSION, CLIENT_CONNECTIONS)
+from muse.compression import DECOMPRESS_ERRORS, ENCODING_HEADER, decompress, select_codec
+from muse.exceptions import MuseClientError, TransferError
+from muse.frames import FrameType, FrameDecoder
+from muse.manifest import iter_manifest
+from muse.task import TaskStatus
+from muse.transfer import UPLOAD_BATCH_SIZE, PartialDownload, Progress, Transfer, get_output_codecs, read_chunk
+
+RETRYABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, TransferError)
+
+
+async def run_in_thread(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def with_retries(func, *args):
+    for attempt in range(TRANSFER_RETRIES):
+        try:
+            return await func(*args)
+        except RETRYABLE_ERRORS as e:
+            if attempt == TRANSFER_RETRIES - 1:
+                raise MuseClientError(f'Transfer failed after {TRANSFER_RETRIES} attempts: {e}')
+            logger.warning(f'Transfer interrupted ({e}), retrying in {2 ** attempt} second(s)')
+            await asyncio.sleep(2 ** attempt)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def verify_chunk(data, encoding, size, chunk_hash):
+    if encoding is not None:
+        try:
+            data = decompress(encoding, data, size)
+        except (DECOMPRESS_ERRORS + (KeyError,)) as e:
+            raise TransferError(f'Failed to decode chunk: {e}')
+    if hashlib.sha256(data).hexdigest() != chunk_hash:
+        raise TransferError('Checksum mismatch')
+    return data
+
+
+class AsyncTransfer(Transfer):
+    def __init__(
+            self, session, server_url, connections=TRANSFER_CONNECTIONS, chunk_size=TRANSFER_CHUNK_SIZE,
+            compression=TRANSFER_COMPRESSION):
+        super().__init__(server_url, connections, chunk_size, compression)
+        self.session = session
+        self.semaphore = asyncio.Semaphore(connections)
+
+    async def send(self, method, url, data=None, headers=None, json=None):
+        async with self.semaphore:
+            start_time = time.time()
+            async with self.session.request(method, url, data=data, headers=headers, json=json) as response:
+                content = await response.read()
+            num_bytes = len(data) if data is not None else len(content)
+            self.link_meter.add(num_bytes, time.time() - start_time)
+            return response.status, response.headers, content
+
+    async def upload_blob(self, blob_hash, path, progress):
+        data = await run_in_thread(read_file, path)
+        body, headers = await run_in_thread(self.encode, data)
+        headers['Content-Type'] = 'application/octet-stream'
+        status, _, _ = await self.send('POST', f'{self.server_url}blob/upload/{blob_hash}', body, headers)
+        if status != 200:
+            raise TransferError(f'Failed to upload blob {blob_hash}: HTTP {status}')
+        progress.add(len(data))
+
+    async def start_chunked_blob(self, blob_hash, size):
+        status, _, content = await self.send(
+                'POST', f'{self.server_url}blob/chunked/{blob_hash}',
+                json={'size': size, 'chunk_size': self.chunk_size})
+        if status != 200:
+            raise TransferError(f'Failed to start chunked upload of blob {blob_hash}: HTTP {status}')
+        return json.loads(content)
+
+    async def upload_blob_chunk(self, blob_hash, path, index, progress):
+        data = await run_in_thread(read_chunk, path, index * self.chunk_size, self.chunk_size)
+        body, headers = await run_in_thread(self.encode, data)
+        headers['Content-Type'] = 'application/octet-stream'
+        headers['X-Chunk-Sha256'] = hashlib.sha256(data).hexdigest()
+        status, _, _ = await self.send('PUT', f'{self.server_url}blob/chunked/{blob_hash}/{index}', body, headers)
+        if status != 200:
+            raise TransferError(f'Failed to upload chunk {index} of blob {blob_hash}: HTTP {status}')
+        progress.add(len(data))
+
+    async def commit_chunked_blob(self, blob_hash):
+        status, _, content = await self.send('POST', f'{self.server_url}blob/chunked/{blob_hash}/commit')
+        if status == 409:
+            return json.loads(content)['missing_chunks']
+        if status != 200:
+            raise MuseClientError(f'Server rejected blob {blob_hash}: HTTP {status}')
+        return []
+
+    async def find_missing_blobs(self, blob_hashes):
+        status, _, content = await self.send('POST', f'{self.server_url}blob/missing', json={'hashes': blob_hashes})
+        if status != 200:
+            raise TransferError(f'Failed to query missing blobs: HTTP {status}')
+        self.encodings = json.loads(content).get('encodings', [])
+        return set(json.loads(content)['missing'])
+
+    async def upload_chunked_blob(self, blob_hash, path, size, progress):
+        state = await with_retries(self.start_chunked_blob, blob_hash, size)
+        if state['exists']:
+            progress.add(size)
+            return
+        received = set(state['received'])
+        jobs = []
+        for index in range(-(-size // self.chunk_size)):
+            if index in received:
+                progress.add(min(self.chunk_size, size - index * self.chunk_size))
+            else:
+                jobs.append(with_retries(self.upload_blob_chunk, blob_hash, path, index, progress))
+        await asyncio.gather(*jobs)
+        missing = await with_retries(self.commit_chunked_blob, blob_hash)
+        if missing:
+            await asyncio.gather(*[
+                with_retries(self.upload_blob_chunk, blob_hash, path, index, progress) for index in missing])
+            if await with_retries(self.commit_chunked_blob, blob_hash):
+                raise MuseClientError(f'Failed to upload blob {blob_hash}')
+
+    async def upload_manifest(self, paths):
+        manifest = []
+        seen = set()
+        jobs = []
+        stats = {'size': 0, 'missing': 0, 'missing_size': 0}
+        progress = Progress('Uploading', 0)
+
+        entries = iter_manifest(paths)
+        try:
+            while True:
+                items = await run_in_thread(lambda: list(islice(entries, UPLOAD_BATCH_SIZE)))
+                if not items:
+                    break
+                batch = []
+                for entry, path in items:
+                    manifest.append(entry)
+                    if entry['type'] != 'file' or entry['hash'] in seen:
+                        continue
+                    seen.add(entry['hash'])
+                    stats['size'] += entry['size']
+                    batch.append((entry, path))
+                if not batch:
+                    continue
+                missing = await with_retries(self.find_missing_blobs, [entry['hash'] for entry, path in batch])
+                for entry, path in batch:
+                    if entry['hash'] not in missing:
+                        continue
+                    stats['missing'] += 1
+                    stats['missing_size'] += entry['size']
+                    progress.add_total(entry['size'])
+                    if entry['size'] <= self.chunk_size:
+                        job = with_retries(self.upload_blob, entry['hash'], path, progress)
+                    else:
+                        job = self.upload_chunked_blob(entry['hash'], path, entry['size'], progress)
+                    jobs.append(asyncio.ensure_future(job))
+            await asyncio.gather(*jobs)
+        finally:
+            for job in jobs:
+                job.cancel()
+
+        logger.info(
+            f'Inputs: {len(seen)} blob(s) of {naturalsize(stats["size"])}'
+            f', uploaded {stats["missing"]} blob(s) of {naturalsize(stats["missing_size"])}')
+        return manifest
+
+    async def download_chunk(self, url, offset, size, chunk_hash, codecs, progress):
+        name = select_codec(self.compression, codecs, self.link_meter.speed)
+        status, headers, data = await self.send('GET', url, headers={} if name is None else {ENCODING_HEADER: name})
+        if status != 200:
+            raise TransferError(f'Failed to download bytes {offset}+{size}: HTTP {status}')
+        try:
+            data = await run_in_thread(verify_chunk, data, headers.get(ENCODING_HEADER), size, chunk_hash)
+        except TransferError as e:
+            raise TransferError(f'Bytes {offset}+{size}: {e}')
+        progress.add(size)
+        return data
+
+    async def download(self, url, output_info, write=None, path=None):
+        size = output_info['size']
+        chunk_size = output_info['chunk_size']
+        num_chunks = len(output_info['chunks'])
+        codecs = get_output_codecs(output_info)
+        progress = Progress('Downloading', size)
+
+        partial = None
+        done = set()
+        if path is not None:
+            partial = PartialDownload(path, output_info)
+            done = await run_in_thread(partial.open)
+            progress.done_size = partial.done_size()
+
+        async def fetch(index):
+            offset = index * chunk_size
+            chunk_len = min(chunk_size, size - offset)
+            if index in done:
+                return await run_in_thread(partial.read, index)
+            data = await with_retries(
+                    self.download_chunk, f'{url}/{index}', offset, chunk_len, output_info['chunks'][index], codecs,
+                    progress)
+            if partial is not None:
+                await run_in_thread(partial.write, index, data)
+            return data
+
+        h = hashlib.sha256()
+        futures = deque()
+        next_index = 0
+        try:
+            while next_index < num_chunks or futures:
+                while next_index < num_chunks and len(futures) < 2 * self.connections:
+                    futures.append(asyncio.ensure_future(fetch(next_index)))
+                    next_index += 1
+                data = await futures.popleft()
+                h.update(data)
+                if write is not None:
+                    await write(data)
+        finally:
+            for future in futures:
+                future.cancel()
+
+        if h.hexdigest() != output_info['sha256']:
+            if partial is not None:
+                await run_in_thread(partial.discard)
+            raise MuseClientError('Checksum mismatch for the downloaded archive')
+        if partial is not None:
+            await run_in_thread(partial.commit)
+
+
+def write_std_output(log, data):
+    output_io = sys.stdout.buffer if log == 'stdout' else sys.stderr.buffer
+    output_io.write(data)
+    output_io.flush()
+
+
+class AsyncTask(Task):
+    def __init__(
+            self, client, hint_device_id, cmd, output_files, lease_duration=None, device_selector=None,
+            queue_timeout=None, priority=None):
+        super().__init__(
+                hint_device_id, cmd, output_files, server_url=client.server_url, lease_duration=lease_duration,
+                device_selector=device_selector, queue_timeout=queue_timeout, priority=priority)
+        self.client = client
+
+    async def init(self):
+        status, body = await self.client.request_json('POST', 'task/create', json=self.get_create_request())
+        if status != 200:
+            raise MuseClientError(f'Failed to create task: HTTP {status}')
+        self._id = body['_id']
+
+    async def run(self, output=write_std_output):
+        try:
+            await self.monitor_task(output)
+            if not self.log_task_status():
+                raise MuseClientError(f'Task {self._id} failed!')
+        except asyncio.CancelledError as exception:
+            logger.warning(f'Killing task {self._id}...')
+            await asyncio.shield(self.kill())
+            raise exception
+
+    async def upload_input_archive(self, archive_path):
+        with open(archive_path, 'rb') as f:
+            data = aiohttp.FormData()
+            data.add_field(
+                    'file', f, filename=os.path.basename(archive_path), content_type='application/octet-stream')
+            async with self.client.session.post(f'{self.server_url}task/upload/{self._id}', data=data) as response:
+                return await response.text()
+
+    async def upload_inputs(self, paths):
+        manifest = await self.client.get_transfer().upload_manifest(paths)
+        status, _ = await self.client.request_json('POST', f'task/input/{self._id}', json={'manifest': manifest})
+        if status != 200:
+            raise MuseClientError(f'Failed to attach inputs to task: HTTP {status}')
+
+    async def get_output_info(self):
+        status, body = await self.client.request_json('GET', f'task/output/{self._id}')
+        if status != 200 or body['sha256'] is None:
+            raise MuseClientError('Output archive is not available')
+        return body
+
+    async def download_output_archive(self, archive_path):
+        await self.client.get_transfer().download(
+                f'{self.server_url}task/output/{self._id}', await self.get_output_info(), path=archive_path)
+
+    async def extract_outputs(self, archive_path=None, directory=None):
+        output_info = await self.get_output_info()
+        process = await asyncio.create_subprocess_exec(
+                'tar', 'xf', '-', '--exclude', EMPTY_FILENAME, stdin=asyncio.subprocess.PIPE, cwd=directory)
+
+        async def write(data):
+            process.stdin.write(data)
+            await process.stdin.drain()
+
+        try:
+            await self.client.get_transfer().download(
+                    f'{self.server_url}task/output/{self._id}', output_info, write=write, path=archive_path)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            process.stdin.close()
+            return_code = await process.wait()
+        if return_code:
+            raise MuseClientError(f'Failed to extract outputs, tar exited with {return_code}')
+
+    async def iter_log(self, log, offset=0):
+        async with self.client.session.get(
+                f'{self.server_url}task/log/{self._id}/{log}', params={'offset': offset}) as response:
+            async for data in response.content.iter_any():
+                yield data
+
+    async def save_logs(self, directory):
+        for log in ('stdout', 'stderr'):
+            with open(os.path.join(directory, f'{log}.log'), 'wb') as f:
+                async for data in self.iter_log(log):
+                    f.write(data)
+
+    async def monitor_task(self, output=write_std_output):
+        offsets = {'stdout': 0, 'stderr': 0}
+        logs = {FrameType.STDOUT: 'stdout', FrameType.STDERR: 'stderr'}
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=TASK_EVENT_TIMEOUT)
+        while True:
+            try:
+                async with self.client.session.get(
+                        f'{self.server_url}task/events/{self._id}', params=offsets, timeout=timeout) as response:
+                    decoder = FrameDecoder()
+                    async for chunk in response.content.iter_any():
+                        for frame_type, payload in decoder.feed(chunk):
+                            if frame_type in logs:
+                                output(logs[frame_type], payload)
+                                offsets[logs[frame_type]] += len(payload)
+                            elif frame_type == FrameType.STATUS:
+                                status = TaskStatus[json.loads(payload)['status']]
+                                logger.info(f'Task {self._id} status: {status}')
+                            elif frame_type == FrameType.RESULT:
+                                self.task = json.loads(payload)
+                                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f'Lost event stream of task {self._id}, reconnecting: {e}')
+            await asyncio.sleep(1)
+
+    async def kill(self):
+        if self._id is None:
+            return
+        status, _ = await self.client.request_json('DELETE', f'task/kill/{self._id}')
+        if status == 204:
+            logger.warning(f'Killed task {self._id}')
+
+
+class AsyncMuseClient:
+    def __init__(self, server_url=SERVER_URL, connections=CLIENT_CONNECTIONS):
+        self.server_url = server_url
+        self.connections = connections
+        self.session = None
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def get_transfer(self):
+        return AsyncTransfer(self.open(), self.server_url)
+
+    async def request_json(self, method, path, json=None):
+        async with self.open().request(method, f'{self.server_url}{path}', json=json) as response:
+            if response.content_type == 'application/json':
+                return response.status, await response.json()
+            await response.read()
+            return response.status, None
+
+    async def create_task(
+            self, hint_device_id, cmd, output_files, lease_duration=None, device_selector=None, queue_timeout=None,
+            priority=None):
+        task = AsyncTask(
+                self, hint_device_id, cmd, output_files, lease_duration=lease_duration,
+                device_selector=device_selector, queue_timeout=queue_timeout, priority=priority)
+        await task.init()
+        return task
+
+    async def create_tasks(self, specs, inputs=(), lease_duration=None):
+        tasks = [AsyncTask(self, **dict({'lease_duration': lease_duration}, **spec)) for spec in specs]
+        manifest = await self.get_transfer().upload_manifest(inputs) if inputs else None
+        status, body = await self.request_json('POST', 'task/create_batch', json={
+            'tasks': [task.get_create_request() for task in tasks],
+            'create_user': os.getenv('USER'),
+            'input_manifest': manifest,
+        })
+        if status != 200:
+            raise MuseClientError(f'Failed to create tasks: HTTP {status}')
+        for task, _id in zip(tasks, body['_ids']):
+            task._id = _id
+        return tasks
+
+    async def query_tasks(self, tasks):
+        status, body = await self.request_json('POST', 'task/query_batch', json={'_ids': [task._id for task in tasks]})
+        return {task['_id']: task for task in body['tasks']}
+
+    async def list_tasks(self):
+        status, body = await self.request_json('GET', 'task/list')
+        return body['tasks']
+
+    async def list_devices(self):
+        status, body = await self.request_json('GET', 'device/list')
+        return body['device_infos']
@@ -0,0 +1,411 @@
+import asyncio
+import os
+import time
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+from loguru import logger
+
+from muse.blob_store import MAX_UPLOAD_CHUNK_SIZE, is_valid_hash
+from muse.compression import DECOMPRESS_ERRORS, ENCODING_HEADER, get_codec
+from muse.log_stream import FETCH, Wait
+from muse.metrics import CONTENT_TYPE
+from muse.server_settings import MUSE_SERVER_HOST, MUSE_SERVER_PORT, NODE_FORWARD_MODE
+from muse.service import MuseService
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+CLIENT_MAX_SIZE = MAX_UPLOAD_CHUNK_SIZE + (1 << 20)
+NODE_ROUTES = {
+    '/task/log/{_id}/{log}',
+    '/task/events/{_id}',
+    '/task/download/{_id}',
+    '/task/output/{_id}/{index}',
+}
+FORWARD_HEADERS = ('Content-Type', 'Content-Length', ENCODING_HEADER)
+FORWARD_CHUNK_SIZE = 1 << 16
+
+routes = web.RouteTableDef()
+
+
+class AsyncFileNotifier:
+    def __init__(self, file_watcher, loop):
+        self.file_watcher = file_watcher
+        self.loop = loop
+        self.waiters = {}
+        file_watcher.add_listener(lambda names: loop.call_soon_threadsafe(self.dispatch, names))
+
+    def dispatch(self, names):
+        if names is None:
+            futures = set().union(*self.waiters.values())
+        else:
+            futures = set().union(*(self.waiters.get(name, ()) for name in names))
+        for future in futures:
+            if not future.done():
+                future.set_result(None)
+
+    async def wait(self, names, version, timeout):
+        if self.file_watcher.get_version(names) != version:
+            return
+        if self.file_watcher.fd is None:
+            timeout = min(timeout, self.file_watcher.poll_interval)
+        future = self.loop.create_future()
+        for name in names:
+            self.waiters.setdefault(name, set()).add(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for name in names:
+                self.waiters[name].discard(future)
+                if not self.waiters[name]:
+                    del self.waiters[name]
+
+
+async def run_in_thread(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def stream_steps(request, response, steps, fetch):
+    notifier = request.app['notifier']
+    await response.prepare(request)
+    value = None
+    try:
+        while True:
+            try:
+                step = steps.send(value)
+            except StopIteration:
+                break
+            value = None
+            if step is FETCH:
+                value = await run_in_thread(fetch)
+            elif isinstance(step, Wait):
+                await notifier.wait(step.names, step.version, step.timeout)
+            else:
+                await response.write(step)
+    except ConnectionResetError:
+        return response
+    finally:
+        steps.close()
+    await response.write_eof()
+    return response
+
+
+@routes.get('/metrics')
+async def metrics(request):
+    text = await run_in_thread(request.app['service'].get_metrics)
+    return web.Response(body=text.encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+@routes.get('/device/list')
+async def list_devices(request):
+    return web.json_response(await run_in_thread(request.app['service'].list_devices))
+
+
+@routes.post('/task/create')
+async def create_task(request):
+    j = await request.json()
+    body, status = await run_in_thread(request.app['service'].create_task, j)
+    if body:
+        return web.json_response(body, status=status)
+    return web.Response(status=status)
+
+
+@routes.post('/task/create_batch')
+async def create_tasks(request):
+    j = await request.json()
+    body, status = await run_in_thread(request.app['service'].create_tasks, j)
+    if body:
+        return web.json_response(body, status=status)
+    return web.Response(status=status)
+
+
+@routes.post('/task/upload/{_id}')
+async def upload_input_archive(request):
+    service = request.app['service']
+    _id = request.match_info['_id']
+    reader = await request.multipart()
+    part = await reader.next()
+    while part is not None and part.name != 'file':
+        part = await reader.next()
+    if part is None:
+        return web.Response(status=400)
+    f = await run_in_thread(open, service.get_input_archive_path(_id), 'wb')
+    try:
+        while True:
+            data = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            await run_in_thread(f.write, data)
+    finally:
+        await run_in_thread(f.close)
+    await run_in_thread(service.set_input_archive_ready, _id)
+    return web.Response()
+
+
+@routes.post('/blob/missing')
+async def find_missing_blobs(request):
+    j = await request.json()
+    result = await run_in_thread(request.app['service'].find_missing_blobs, j['hashes'])
+    if result is None:
+        return web.Response(status=400)
+    return web.json_response(result)
+
+
+@routes.post('/blob/upload/{blob_hash}')
+async def upload_blob(request):
+    blob_hash = request.match_info['blob_hash']
+    if not is_valid_hash(blob_hash):
+        return web.Response(status=400)
+    encoding = request.headers.get(ENCODING_HEADER)
+    if encoding is not None and get_codec(encoding) is None:
+        return web.Response(status=415)
+    incoming = await run_in_thread(request.app['service'].blob_store.open_incoming, blob_hash, encoding)
+    try:
+        while True:
+            data = await request.content.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            await run_in_thread(incoming.write, data)
+        if not await run_in_thread(incoming.commit):
+            return web.Response(status=400)
+    except DECOMPRESS_ERRORS as e:
+        logger.warning(f'Blob {blob_hash}: failed to decode upload: {e}')
+        return web.Response(status=400)
+    finally:
+        await run_in_thread(incoming.abort)
+    return web.Response()
+
+
+@routes.post('/blob/chunked/{blob_hash}')
+async def start_chunked_blob(request):
+    j = await request.json()
+    body, status = await run_in_thread(request.app['service'].start_chunked_blob, request.match_info['blob_hash'], j)
+    if body:
+        return web.json_response(body, status=status)
+    return web.Response(status=status)
+
+
+@routes.put(r'/blob/chunked/{blob_hash}/{index:\d+}')
+async def upload_blob_chunk(request):
+    data = await request.read()
+    status = await run_in_thread(
+            request.app['service'].upload_blob_chunk, request.match_info['blob_hash'],
+            int(request.match_info['index']), data, request.headers.get('X-Chunk-Sha256'),
+            request.headers.get(ENCODING_HEADER))
+    return web.Response(status=status)
+
+
+@routes.post('/blob/chunked/{blob_hash}/commit')
+async def commit_chunked_blob(request):
+    body, status = await run_in_thread(request.app['service'].commit_chunked_blob, request.match_info['blob_hash'])
+    if body:
+        return web.json_response(body, status=status)
+    return web.Response(status=status)
+
+
+@routes.get('/blob/{blob_hash}')
+async def download_blob(request):
+    path = await run_in_thread(request.app['service'].find_blob, request.match_info['blob_hash'])
+    if path is None:
+        return web.Response(status=404)
+    return web.FileResponse(path, headers={'Content-Type': 'application/octet-stream'})
+
+
+@routes.get('/task/input/{_id}')
+async def download_input_archive(request):
+    path = await run_in_thread(request.app['service'].find_input_archive, request.match_info['_id'])
+    if path is None:
+        return web.Response(status=404)
+    return web.FileResponse(path, headers={'Content-Type': 'application/x-tar'})
+
+
+@routes.post('/task/input/{_id}')
+async def set_input_manifest(request):
+    j = await request.json()
+    body, status = await run_in_thread(
+            request.app['service'].set_input_manifest, request.match_info['_id'], j['manifest'])
+    if body:
+        return web.json_response(body, status=status)
+    return web.Response(status=status)
+
+
+@routes.get('/task/download/{_id}')
+async def download_output_archive(request):
+    _id = request.match_info['_id']
+    path = request.app['service'].get_output_archive_path(_id)
+    if not await run_in_thread(os.path.exists, path):
+        return web.Response(status=404)
+    return web.FileResponse(path, headers={'Content-Disposition': f'attachment; filename="{_id}.tar"'})
+
+
+@routes.get('/task/output/{_id}')
+async def get_output_info(request):
+    output_info = await run_in_thread(request.app['service'].get_output_info, request.match_info['_id'])
+    if output_info is None:
+        return web.Response(status=404)
+    return web.json_response(output_info)
+
+
+@routes.get(r'/task/output/{_id}/{index:\d+}')
+async def download_output_chunk(request):
+    data, encoding = await run_in_thread(
+            request.app['service'].read_output_chunk, request.match_info['_id'], int(request.match_info['index']),
+            request.headers.get(ENCODING_HEADER))
+    if data is None:
+        return web.Response(status=404)
+    headers = {} if encoding is None else {ENCODING_HEADER: encoding}
+    return web.Response(body=data, content_type='application/octet-stream', headers=headers)
+
+
+@routes.get('/task/query/{_id}')
+async def query_task(request):
+    return web.json_response(await run_in_thread(request.app['service'].query_task, request.match_info['_id']))
+
+
+@routes.post('/task/query_batch')
+async def query_tasks(request):
+    j = await request.json()
+    return web.json_response(await run_in_thread(request.app['service'].query_tasks, j['_ids']))
+
+
+@routes.get('/task/log/{_id}/{log}')
+async def stream_task_log(request):
+    offset = int(request.query.get('offset', 0))
+    log_file_path, steps, fetch = await run_in_thread(
+            request.app['service'].open_task_log, request.match_info['_id'], request.match_info['log'], offset)
+    if log_file_path is None:
+        return web.Response(body=b'', content_type='text/plain')
+    if steps is None:
+        return web.FileResponse(log_file_path, headers={'Content-Type': 'text/plain'})
+    response = web.StreamResponse(headers={'Content-Type': 'text/plain'})
+    return await stream_steps(request, response, steps, fetch)
+
+
+@routes.get('/task/events/{_id}')
+async def stream_task_events(request):
+    offsets = {
+        'stdout': int(request.query.get('stdout', 0)),
+        'stderr': int(request.query.get('stderr', 0)),
+    }
+    steps, fetch = await run_in_thread(request.app['service'].open_task_events, request.match_info['_id'], offsets)
+    if steps is None:
+        return web.Response(status=404)
+    response = web.StreamResponse(headers={'Content-Type': 'application/octet-stream'})
+    return await stream_steps(request, response, steps, fetch)
+
+
+@routes.get('/task/trace/{_id}')
+async def get_trace(request):
+    trace = await run_in_thread(request.app['service'].get_trace, request.match_info['_id'])
+    if trace is None:
+        return web.Response(status=404)
+    return web.json_response(trace)
+
+
+@routes.post('/task/trace/{_id}')
+async def add_trace_spans(request):
+    j = await request.json()
+    status = await run_in_thread(request.app['service'].add_trace_spans, request.match_info['_id'], j.get('spans'))
+    return web.Response(status=status)
+
+
+@routes.get('/task/list')
+async def list_tasks(request):
+    return web.json_response(await run_in_thread(request.app['service'].list_tasks))
+
+
+@routes.delete('/task/kill/{_id}')
+async def kill_task(request):
+    if await run_in_thread(request.app['service'].kill_task, request.match_info['_id']):
+        return web.Response(status=204)
+    else:
+        return web.Response(status=409)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start_time = time.time()
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        request.app['service'].record_request(
+                request.method, route, status, start_time, request.match_info.get('_id'))
+
+
+async def proxy_to_node(request, url):
+    headers = {key: value for key, value in request.headers.items() if key in (ENCODING_HEADER, 'Range')}
+    response = None
+    try:
+        async with request.app['node_session'].get(url, headers=headers) as upstream:
+            response = web.StreamResponse(
+                    status=upstream.status,
+                    headers={key: upstream.headers[key] for key in FORWARD_HEADERS if key in upstream.headers})
+            await response.prepare(request)
+            async for data in upstream.content.iter_chunked(FORWARD_CHUNK_SIZE):
+                await response.write(data)
+    except ClientError as e:
+        logger.error(f'Failed to proxy {url}: {e}')
+        if response is None:
+            return web.Response(status=502)
+        return response
+    except ConnectionResetError:
+        return response
+    await response.write_eof()
+    return response
+
+
+@web.middleware
+async def node_middleware(request, handler):
+    resource = request.match_info.route.resource
+    if resource is None or resource.canonical not in NODE_ROUTES:
+        return await handler(request)
+    node_url = await run_in_thread(request.app['service'].get_node_url, request.match_info['_id'])
+    if node_url is None:
+        return await handler(request)
+    url = node_url + request.rel_url.path_qs.lstrip('/')
+    if NODE_FORWARD_MODE == 'redirect':
+        raise web.HTTPTemporaryRedirect(url)
+    return await proxy_to_node(request, url)
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+async def on_startup(app):
+    app['notifier'] = AsyncFileNotifier(app['service'].log_streamer.file_watcher, asyncio.get_running_loop())
+    app['node_session'] = ClientSession(timeout=ClientTimeout(total=None, sock_connect=10), auto_decompress=False)
+
+
+async def on_cleanup(app):
+    await app['node_session'].close()
+
+
+def create_app(service=None):
+    app = web.Application(
+            client_max_size=CLIENT_MAX_SIZE, middlewares=[metrics_middleware, cors_middleware, node_middleware])
+    app['service'] = service or MuseService()
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_server():
+    logger.info(f'Starting aiohttp server on {MUSE_SERVER_HOST}:{MUSE_SERVER_PORT}')
+    web.run_app(create_app(), host=MUSE_SERVER_HOST, port=MUSE_SERVER_PORT, print=None)
+
+
+if __name__ == '__main__':
+    run_server()
@@ -0,0 +1,120 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import yaml
+from loguru import logger
+
+from muse.client import MuseClient
+from muse.exceptions import MuseClientError
+from muse.log_stream import is_finished_status
+from muse.selector import is_valid_selector
+from muse.task import TaskStatus
+
+POLL_INTERVAL = 1.0
+COLLECT_WORKERS = 4
+COLLECT_ERRORS = (MuseClientError, requests.RequestException, OSError)
+
+
+def load_batch_manifest(path):
+    with open(path) as f:
+        j = yaml.safe_load(f)
+    if not isinstance(j, dict) or not j.get('tasks'):
+        raise MuseClientError(f'{path}: no tasks defined')
+
+    specs = []
+    names = set()
+    for index, task in enumerate(j['tasks']):
+        name = str(task.get('name', index))
+        if name in names or os.path.basename(name) != name or name in ('.', '..'):
+            raise MuseClientError(f'{path}: invalid or duplicate task name {name!r}')
+        names.add(name)
+        cmd = task['cmd']
+        device = task.get('device', j.get('device') if 'select' not in task else None)
+        device_selector = task.get('select', j.get('select') if 'device' not in task else None)
+        if (device is None) == (device_selector is None):
+            raise MuseClientError(f'{path}: task {name!r} needs either a device or a device selector')
+        if device_selector is not None and not is_valid_selector(device_selector):
+            raise MuseClientError(f'{path}: task {name!r} has an invalid device selector')
+        priority = task.get('priority', j.get('priority'))
+        specs.append((name, {
+            'hint_device_id': device,
+            'device_selector': device_selector,
+            'queue_timeout': task.get('queue_timeout', j.get('queue_timeout')),
+            'priority': None if priority is None else str(priority).upper(),
+            'cmd': [cmd] if isinstance(cmd, str) else [str(arg) for arg in cmd],
+            'output_files': task.get('outputs', j.get('outputs', [])),
+        }))
+    return specs, j.get('inputs', []), j.get('lease_duration')
+
+
+def collect_task(task, task_info, directory):
+    os.makedirs(directory, exist_ok=True)
+    task.save_logs(directory)
+    if task_info.get('output_sha256') is not None:
+        task.extract_outputs(directory=directory)
+
+
+def run_batch(manifest_path, out_dir, client=None):
+    client = client or MuseClient()
+    specs, inputs, lease_duration = load_batch_manifest(manifest_path)
+
+    start_time = time.time()
+    tasks = client.create_tasks([spec for name, spec in specs], inputs, lease_duration=lease_duration)
+    logger.info(f'Submitted {len(tasks)} task(s) in {time.time() - start_time:.1f}s')
+
+    names = {task._id: name for task, (name, spec) in zip(tasks, specs)}
+    pending = {task._id: task for task in tasks}
+    results = {}
+    futures = {}
+    prev_statuses = None
+    try:
+        with ThreadPoolExecutor(max_workers=COLLECT_WORKERS) as executor:
+            while pending:
+                try:
+                    task_infos = client.query_tasks(pending.values())
+                except requests.RequestException as e:
+                    logger.warning(f'Failed to query {len(pending)} task(s), retrying: {e}')
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                for _id, task_info in task_infos.items():
+                    if not is_finished_status(task_info['status']):
+                        continue
+                    task = pending.pop(_id)
+                    task.task = task_info
+                    results[_id] = task_info
+                    futures[_id] = executor.submit(collect_task, task, task_info, os.path.join(out_dir, names[_id]))
+                statuses = {}
+                for task_info in task_infos.values():
+                    statuses[task_info['status']] = statuses.get(task_info['status'], 0) + 1
+                if pending and statuses != prev_statuses:
+                    logger.info(
+                        f'{len(results)} / {len(tasks)} finished, '
+                        + ', '.join(f'{status}: {count}' for status, count in sorted(statuses.items())))
+                    prev_statuses = statuses
+                if pending:
+                    time.sleep(POLL_INTERVAL)
+            for _id, future in futures.items():
+                try:
+                    future.result()
+                except COLLECT_ERRORS as e:
+                    logger.error(f'{names[_id]}: failed to collect outputs: {e}')
+                    results[_id] = dict(results[_id], collect_failed=True)
+    except KeyboardInterrupt as exception:
+        logger.warning(f'Killing {len(pending)} unfinished task(s)...')
+        for task in pending.values():
+            task.kill()
+        raise exception
+
+    num_failed = 0
+    for task in tasks:
+        task_info = results[task._id]
+        ok = TaskStatus[task_info['status']] == TaskStatus.COMPLETED and not task_info.get('collect_failed')
+        if not ok:
+            num_failed += 1
+        print(f'{names[task._id]}: {task_info["status"]}'
+              + (f' ({task_info["fail_reason"]})' if 'fail_reason' in task_info else '')
+              + (', outputs not collected' if task_info.get('collect_failed') else ''))
+    print(f'{len(tasks) - num_failed} / {len(tasks)} task(s) succeeded, outputs in {out_dir}')
+    return num_failed
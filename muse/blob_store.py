@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from threading import Lock
+
+from loguru import logger
+
+from muse.compression import DECOMPRESS_ERRORS, SizeLimitedWriter, get_codec
+from muse.manifest import hash_file
+from muse.server_settings import BLOB_DIR, BLOB_CACHE_SIZE, PARTIAL_BLOB_TTL
+
+BLOB_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+RECEIVE_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_CHUNK_SIZE = 64 * 1024 ** 2
+TEMP_PREFIXES = ('.incoming_', '.partial_')
+
+
+def is_valid_hash(blob_hash):
+    return isinstance(blob_hash, str) and BLOB_HASH_PATTERN.match(blob_hash) is not None
+
+
+class IncomingBlob:
+    def __init__(self, blob_store, blob_hash, encoding=None):
+        self.blob_store = blob_store
+        self.blob_hash = blob_hash
+        self.h = hashlib.sha256()
+        fd, self.tmp_path = tempfile.mkstemp(dir=blob_store.blob_dir, prefix='.incoming_')
+        self.f = os.fdopen(fd, 'wb')
+        self.decoder = None
+        if encoding is not None:
+            self.decoder = get_codec(encoding).decompress_writer(
+                    SizeLimitedWriter(self.write_decoded, MAX_UPLOAD_CHUNK_SIZE))
+
+    def write(self, data):
+        if self.decoder is not None:
+            self.decoder.write(data)
+        else:
+            self.write_decoded(data)
+
+    def write_decoded(self, data):
+        self.h.update(data)
+        self.f.write(data)
+
+    def commit(self):
+        if self.decoder is not None:
+            self.decoder.close()
+        self.f.close()
+        if self.h.hexdigest() != self.blob_hash:
+            logger.warning(f'Blob {self.blob_hash}: hash mismatch, got {self.h.hexdigest()}')
+            return False
+        os.replace(self.tmp_path, self.blob_store.get_path(self.blob_hash))
+        self.tmp_path = None
+        return True
+
+    def abort(self):
+        self.f.close()
+        if self.tmp_path is not None:
+            os.remove(self.tmp_path)
+            self.tmp_path = None
+
+
+class BlobStore:
+    def __init__(self, blob_dir=BLOB_DIR, max_size=BLOB_CACHE_SIZE):
+        self.blob_dir = blob_dir
+        self.max_size = max_size
+        self.lock = Lock()
+
+    def get_path(self, blob_hash):
+        assert is_valid_hash(blob_hash)
+        return os.path.join(self.blob_dir, blob_hash)
+
+    def has(self, blob_hash):
+        return os.path.exists(self.get_path(blob_hash))
+
+    def find_missing(self, blob_hashes):
+        return [h for h in blob_hashes if not self.has(h)]
+
+    def touch(self, blob_hashes):
+        now = time.time()
+        for h in blob_hashes:
+            try:
+                os.utime(self.get_path(h), (now, now))
+            except FileNotFoundError:
+                pass
+
+    def open_incoming(self, blob_hash, encoding=None):
+        return IncomingBlob(self, blob_hash, encoding)
+
+    def receive(self, blob_hash, read, encoding=None):
+        incoming = self.open_incoming(blob_hash, encoding)
+        try:
+            while True:
+                data = read(RECEIVE_CHUNK_SIZE)
+                if not data:
+                    break
+                incoming.write(data)
+            return incoming.commit()
+        except DECOMPRESS_ERRORS as e:
+            logger.warning(f'Blob {blob_hash}: failed to decode upload: {e}')
+            return False
+        finally:
+            incoming.abort()
+
+    def get_partial_path(self, blob_hash):
+        assert is_valid_hash(blob_hash)
+        return os.path.join(self.blob_dir, f'.partial_{blob_hash}')
+
+    def load_partial_meta(self, blob_hash):
+        try:
+            with open(self.get_partial_path(blob_hash) + '.json') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get_received_chunks(self, blob_hash):
+        try:
+            with open(self.get_partial_path(blob_hash) + '.chunks') as f:
+                return sorted({int(line) for line in f if line.strip()})
+        except FileNotFoundError:
+            return []
+
+    def remove_partial(self, blob_hash):
+        partial_path = self.get_partial_path(blob_hash)
+        for path in (partial_path, partial_path + '.json', partial_path + '.chunks'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def start_chunked(self, blob_hash, size, chunk_size):
+        meta = {'size': size, 'chunk_size': chunk_size}
+        partial_path = self.get_partial_path(blob_hash)
+        with self.lock:
+            if self.load_partial_meta(blob_hash) != meta or not os.path.exists(partial_path):
+                self.remove_partial(blob_hash)
+                with open(partial_path, 'wb') as f:
+                    f.truncate(size)
+                with open(partial_path + '.json', 'w') as f:
+                    json.dump(meta, f)
+            else:
+                os.utime(partial_path)
+        return self.get_received_chunks(blob_hash)
+
+    def write_chunk(self, blob_hash, index, data, chunk_hash):
+        meta = self.load_partial_meta(blob_hash)
+        if meta is None:
+            return True if self.has(blob_hash) else None
+        offset = index * meta['chunk_size']
+        if index < 0 or offset >= max(meta['size'], 1):
+            return False
+        if len(data) != min(meta['chunk_size'], meta['size'] - offset):
+            return False
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            logger.warning(f'Blob {blob_hash}: chunk {index} hash mismatch')
+            return False
+
+        partial_path = self.get_partial_path(blob_hash)
+        fd = os.open(partial_path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+        fd = os.open(partial_path + '.chunks', os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, f'{index}\n'.encode())
+        finally:
+            os.close(fd)
+        return True
+
+    def commit_chunked(self, blob_hash):
+        meta = self.load_partial_meta(blob_hash)
+        if meta is None:
+            return self.has(blob_hash), []
+        num_chunks = max(1, -(-meta['size'] // meta['chunk_size']))
+        missing = sorted(set(range(num_chunks)) - set(self.get_received_chunks(blob_hash)))
+        if missing:
+            return False, missing
+
+        partial_path = self.get_partial_path(blob_hash)
+        with self.lock:
+            if not os.path.exists(partial_path):
+                return self.has(blob_hash), []
+            if hash_file(partial_path) != blob_hash:
+                logger.warning(f'Blob {blob_hash}: hash mismatch after chunked upload, discarding it')
+                self.remove_partial(blob_hash)
+                return False, []
+            os.replace(partial_path, self.get_path(blob_hash))
+            self.remove_partial(blob_hash)
+        return True, []
+
+    def evict(self, pinned=()):
+        pinned = set(pinned)
+        with self.lock:
+            blobs = []
+            total_size = 0
+            for entry in os.scandir(self.blob_dir):
+                if entry.name.startswith(TEMP_PREFIXES):
+                    try:
+                        if time.time() - entry.stat().st_mtime > PARTIAL_BLOB_TTL:
+                            os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if not is_valid_hash(entry.name):
+                    continue
+                st = entry.stat()
+                blobs.append((st.st_mtime, st.st_size, entry.name))
+                total_size += st.st_size
+
+            if total_size <= self.max_size:
+                return
+
+            for _, size, blob_hash in sorted(blobs):
+                if total_size <= self.max_size:
+                    break
+                if blob_hash in pinned:
+                    continue
+                try:
+                    os.remove(self.get_path(blob_hash))
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                logger.info(f'Blob {blob_hash}: evicted, {total_size} bytes left in store')
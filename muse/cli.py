@@ -1,12 +1,17 @@
 import argparse
-import subprocess
-import tempfile
+import json
+import os
+import sys
 import time
 
 from loguru import logger
 
-from muse.client_settings import EMPTY_FILENAME, EMPTY_FILEPATH, INPUT_ARCHIVE_DIR, OUTPUT_ARCHIVE_DIR
+from muse.batch import run_batch
+from muse.client_settings import OUTPUT_ARCHIVE_DIR
 from muse.client import MuseClient, TaskStatus
+from muse.task import TaskPriority
+from muse.selector import parse_selector
+from muse.trace import Tracer, format_waterfall, to_chrome_trace
 
 
 def setup_parser():
@@ -20,9 +25,38 @@ def setup_parser():
     run_parser.add_argument('--in', type=str, nargs='+', default=[], help='input files')
     run_parser.add_argument('--cmd', type=str, required=True, nargs='+', help='command')
     run_parser.add_argument('--out', type=str, nargs='+', default=[], help='output files')
-    run_parser.add_argument('--dev', type=str, required=True, help='device id')
+    device_group = run_parser.add_mutually_exclusive_group(required=True)
+    device_group.add_argument('--dev', type=str, help='device id')
+    device_group.add_argument(
+        '--select', type=str, nargs='+', metavar='KEY=PATTERN',
+        help='run on any device matching all patterns, keys: device_id, model, hostname, label')
+    run_parser.add_argument(
+        '--queue-timeout', type=float, default=None,
+        help='seconds to wait for a free device before giving up')
+    run_parser.add_argument(
+        '--priority', type=str.upper, default=None, choices=[priority.name for priority in TaskPriority],
+        help='priority class, higher classes are dispatched first')
+    run_parser.add_argument(
+        '--lease-duration', type=float, default=None,
+        help='seconds the task survives without the client watching it')
+    run_parser.add_argument(
+        '--no-temp', action='store_true',
+        help='extract outputs while they download without keeping a local copy of the archive')
+
+    batch_parser = subparser.add_parser('batch')
+    batch_parser.add_argument('manifest', type=str, help='batch manifest (yaml)')
+    batch_parser.add_argument('--out-dir', type=str, default='muse_batch', help='directory for per-task outputs')
+
+    trace_parser = subparser.add_parser('trace')
+    trace_parser.add_argument('task_id', type=str, help='task id')
+    trace_parser.add_argument('--chrome', type=str, default=None, help='write a chrome://tracing json file')
 
     args = parser.parse_args()
+    if args.action == 'run':
+        try:
+            args.device_selector = None if args.select is None else parse_selector(args.select)
+        except ValueError as e:
+            run_parser.error(str(e))
     return args
 
 
@@ -32,6 +66,9 @@ def device_info_to_text(info):
         'power_on': 'unknown' if info['power_on'] is None else ('on' if info['power_on'] else 'off'),
         'battery': 'unknown' if info['battery'] is None else str(info['battery']) + '%',
         'hostname': 'unknown' if info['hostname'] is None else info['hostname'],
+        'model': info.get('model') or 'unknown',
+        'labels': ', '.join(info.get('labels') or []) or 'none',
+        'node_id': info.get('node_id') or 'unknown',
     }
 
 
@@ -57,6 +94,9 @@ def main_devices(args):
         else:
             print(device_info['device_id'])
         print('  Name: ' + device_info['hostname'])
+        print('  Model: ' + device_info['model'])
+        print('  Labels: ' + device_info['labels'])
+        print('  Node: ' + device_info['node_id'])
         print('  Battery: ' + device_info['battery'])
         print('  Screen: ' + device_info['power_on'])
     print()
@@ -65,22 +105,48 @@ def main_devices(args):
 
 def main_run(args):
     muse_client = MuseClient()
+    tracer = Tracer('client')
 
     logger.info('Starting task')
-    task = muse_client.create_task(args.dev, args.cmd, args.out)
-
-    logger.info('Packaging inputs')
-    with tempfile.NamedTemporaryFile(dir=INPUT_ARCHIVE_DIR, suffix='.tar') as f:
-        subprocess.check_call(['tar', 'cf', f.name, EMPTY_FILEPATH] + getattr(args, 'in'))
-        task.upload_input_archive(f.name)
-
-    task.run()
-
-    logger.info('Retriving results')
-    with tempfile.NamedTemporaryFile(dir=OUTPUT_ARCHIVE_DIR, suffix='.tar') as f:
-        task.download_output_archive(f.name)
-        subprocess.check_call(['tar', 'xf', f.name, '--exclude', EMPTY_FILENAME])
-    logger.info('Finished')
+    with tracer.span('create'):
+        task = muse_client.create_task(
+                args.dev, args.cmd, args.out, lease_duration=args.lease_duration, device_selector=args.device_selector,
+                queue_timeout=args.queue_timeout, priority=args.priority)
+
+    try:
+        logger.info('Uploading inputs')
+        with tracer.span('upload'):
+            task.upload_inputs(getattr(args, 'in'))
+
+        with tracer.span('wait'):
+            task.run()
+
+        logger.info('Retriving results')
+        with tracer.span('download'):
+            if args.no_temp:
+                task.extract_outputs()
+            else:
+                archive_path = os.path.join(OUTPUT_ARCHIVE_DIR, f'{task._id}.tar')
+                task.extract_outputs(archive_path)
+                os.remove(archive_path)
+        logger.info('Finished')
+    finally:
+        task.upload_trace(tracer.spans)
+
+
+def main_trace(args):
+    spans = MuseClient().get_trace(args.task_id)
+    for line in format_waterfall(spans):
+        print(line)
+    if args.chrome is not None:
+        with open(args.chrome, 'w') as f:
+            json.dump(to_chrome_trace(spans), f)
+        logger.info(f'Chrome trace written to {args.chrome}')
+
+
+def main_batch(args):
+    if run_batch(args.manifest, args.out_dir):
+        sys.exit(1)
 
 
 def main():
@@ -90,6 +156,10 @@ def main():
         main_devices(args)
     elif args.action == 'run':
         main_run(args)
+    elif args.action == 'batch':
+        main_batch(args)
+    elif args.action == 'trace':
+        main_trace(args)
 
 
 if __name__ == '__main__':
@@ -1,29 +1,39 @@
+import json
 import os
+import subprocess
 import sys
 import time
-from threading import Thread
 
 import requests
 from humanize import naturalsize
 from loguru import logger
 from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 
-from muse.client_settings import SERVER_URL
+from muse.client_settings import EMPTY_FILENAME, SERVER_URL, TASK_EVENT_TIMEOUT
+from muse.frames import FrameType, decode_frames
+from muse.manifest import iter_manifest
 from muse.task import TaskStatus, TaskFailReason
+from muse.transfer import Transfer
 from muse.exceptions import MuseClientError
 
 
 class Task:
-    def __init__(self, hint_device_id, cmd, output_files, server_url=SERVER_URL):
+    def __init__(
+            self, hint_device_id, cmd, output_files, server_url=SERVER_URL, lease_duration=None,
+            device_selector=None, queue_timeout=None, priority=None):
         self.hint_device_id = hint_device_id
+        self.device_selector = device_selector
+        self.queue_timeout = queue_timeout
+        self.priority = priority
         self.cmd = cmd
         self.output_files = output_files
         self.server_url = server_url
+        self.lease_duration = lease_duration
         self.task = None
         self._id = None
 
-    def init(self):
-        response = requests.post(f'{self.server_url}task/create', json={
+    def get_create_request(self):
+        return {
             'cmd': {
                 'shell': self.cmd,
             },
@@ -31,13 +41,21 @@ class Task:
                 'files': self.output_files,
             },
             'hint_device_id': self.hint_device_id,
+            'device_selector': self.device_selector,
             'create_user': os.getenv('USER'),
-        })
+            'lease_duration': self.lease_duration,
+            'queue_timeout': self.queue_timeout,
+            'priority': self.priority,
+        }
+
+    def init(self):
+        response = requests.post(f'{self.server_url}task/create', json=self.get_create_request())
+        if response.status_code != 200:
+            raise MuseClientError(f'Failed to create task: HTTP {response.status_code}')
         self._id = response.json()['_id']
 
     def run(self):
         try:
-            self.wait_until_start()
             self.monitor_task()
             if not self.log_task_status():
                 raise MuseClientError('Task failed!')
@@ -66,64 +84,70 @@ class Task:
                 headers={'Content-Type': monitor.content_type})
         return response.text
 
-    def download_output_archive(self, archive_path):
-        prev_print_time = 0
+    def upload_inputs(self, paths):
+        manifest = Transfer(self.server_url).upload_manifest(iter_manifest(paths))
 
-        def print_progress(bytes_downloaded, total_len):
-            nonlocal prev_print_time
-            if time.time() > prev_print_time + 1.0 or bytes_downloaded == total_len:
-                logger.info(f'Downloading: {naturalsize(bytes_downloaded)} / {naturalsize(total_len)}')
-                prev_print_time = time.time()
+        response = requests.post(f'{self.server_url}task/input/{self._id}', json={'manifest': manifest})
+        if response.status_code != 200:
+            raise MuseClientError('Failed to attach inputs to task')
 
-        response = requests.get(f'{self.server_url}task/download/{self._id}', stream=True)
-        archive_size = int(response.headers.get('content-length'))
+    def get_output_info(self):
+        response = requests.get(f'{self.server_url}task/output/{self._id}')
+        if response.status_code != 200 or response.json()['sha256'] is None:
+            raise MuseClientError('Output archive is not available')
+        return response.json()
 
-        downloaded_size = 0
-        with open(archive_path, 'wb') as f:
-            for data in response.iter_content(chunk_size=4096):
-                f.write(data)
-                downloaded_size += len(data)
-                print_progress(downloaded_size, archive_size)
+    def download_output_archive(self, archive_path):
+        Transfer(self.server_url).download(
+                f'{self.server_url}task/output/{self._id}', self.get_output_info(), path=archive_path)
 
-    def wait_until_start(self):
-        while True:
-            response = requests.get(f'{self.server_url}task/query/{self._id}')
-            self.task = response.json()
-            status = TaskStatus[self.task['status']]
-            logger.info(f'Task status: {status}')
-            if status in (TaskStatus.QUEUEING, TaskStatus.PREPARING):
-                time.sleep(1)
-            elif status in (TaskStatus.COMPLETED, TaskStatus.KILLING, TaskStatus.FAILED):
-                return
-            elif status in (TaskStatus.RUNNING,):
-                break
-            else:
-                assert False
+    def extract_outputs(self, archive_path=None, directory=None):
+        output_info = self.get_output_info()
+        process = subprocess.Popen(
+                ['tar', 'xf', '-', '--exclude', EMPTY_FILENAME], stdin=subprocess.PIPE, cwd=directory)
+        try:
+            Transfer(self.server_url).download(
+                    f'{self.server_url}task/output/{self._id}', output_info, write=process.stdin.write,
+                    path=archive_path)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            return_code = process.wait()
+        if return_code:
+            raise MuseClientError(f'Failed to extract outputs, tar exited with {return_code}')
+
+    def save_logs(self, directory):
+        for log in ('stdout', 'stderr'):
+            response = requests.get(f'{self.server_url}task/log/{self._id}/{log}', stream=True)
+            with open(os.path.join(directory, f'{log}.log'), 'wb') as f:
+                for data in response.iter_content(chunk_size=None):
+                    f.write(data)
 
     def monitor_task(self):
-        stdout_t = Thread(target=self.get_log, args=('stdout',), daemon=True)
-        stderr_t = Thread(target=self.get_log, args=('stderr',), daemon=True)
-        keep_alive_t = Thread(target=self.keep_alive, daemon=True)
-
-        stdout_t.start()
-        stderr_t.start()
-        keep_alive_t.start()
-
-        stdout_t.join()
-        stderr_t.join()
-        keep_alive_t.join()
-
-    def get_log(self, log):
-        log_r = requests.get(f'{self.server_url}task/log/{self._id}/{log}', stream=True)
-        stdout_io = sys.stdout.buffer
-        stderr_io = sys.stderr.buffer
-        for data in log_r.iter_content(chunk_size=4096):
-            if log == 'stdout':
-                stdout_io.write(data)
-                stdout_io.flush()
-            else:
-                stderr_io.write(data)
-                stderr_io.flush()
+        offsets = {'stdout': 0, 'stderr': 0}
+        outputs = {FrameType.STDOUT: ('stdout', sys.stdout.buffer), FrameType.STDERR: ('stderr', sys.stderr.buffer)}
+        while True:
+            try:
+                response = requests.get(
+                        f'{self.server_url}task/events/{self._id}', params=offsets, stream=True,
+                        timeout=TASK_EVENT_TIMEOUT)
+                for frame_type, payload in decode_frames(response.iter_content(chunk_size=None)):
+                    if frame_type in outputs:
+                        log, output_io = outputs[frame_type]
+                        output_io.write(payload)
+                        output_io.flush()
+                        offsets[log] += len(payload)
+                    elif frame_type == FrameType.STATUS:
+                        status = TaskStatus[json.loads(payload)['status']]
+                        logger.info(f'Task status: {status}')
+                    elif frame_type == FrameType.RESULT:
+                        self.task = json.loads(payload)
+                        return
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                logger.warning(f'Lost task event stream, reconnecting: {e}')
+            time.sleep(1)
 
     def kill(self):
         if self._id is None:
@@ -132,14 +156,15 @@ class Task:
         if response.status_code == '204':
             logger.warning('Killed')
 
-    def keep_alive(self):
-        while True:
-            response = requests.get(f'{self.server_url}task/query/{self._id}')
-            self.task = response.json()
-            status = TaskStatus[self.task['status']]
-            if status in (TaskStatus.COMPLETED, TaskStatus.FAILED):
-                return
-            time.sleep(1)
+    def upload_trace(self, spans):
+        if self._id is None or not spans:
+            return
+        try:
+            response = requests.post(f'{self.server_url}task/trace/{self._id}', json={'spans': spans})
+            if response.status_code != 200:
+                logger.warning(f'Failed to upload trace: HTTP {response.status_code}')
+        except requests.RequestException as e:
+            logger.warning(f'Failed to upload trace: {e}')
 
     def log_task_status(self):
         if self.task is not None:
@@ -155,6 +180,10 @@ class Task:
                     logger.error('Non-zero return code')
                 elif fail_reason == TaskFailReason.KILLED:
                     logger.error('Killed')
+                elif fail_reason == TaskFailReason.QUEUE_TIMEOUT:
+                    logger.error('No device became free before the queue timeout')
+                elif fail_reason == TaskFailReason.INTERNAL_ERROR:
+                    logger.error('Scheduler error, see the scheduler log')
                 else:
                     assert False
             elif TaskStatus[self.task['status']] == TaskStatus.COMPLETED:
@@ -167,11 +196,41 @@ class MuseClient:
     def __init__(self, server_url=SERVER_URL):
         self.server_url = server_url
 
-    def create_task(self, hint_device_id, cmd, output_files):
-        task = Task(hint_device_id, cmd, output_files)
+    def create_task(
+            self, hint_device_id, cmd, output_files, lease_duration=None, device_selector=None, queue_timeout=None,
+            priority=None):
+        task = Task(
+                hint_device_id, cmd, output_files, server_url=self.server_url, lease_duration=lease_duration,
+                device_selector=device_selector, queue_timeout=queue_timeout, priority=priority)
         task.init()
         return task
 
+    def create_tasks(self, specs, inputs=(), lease_duration=None):
+        tasks = [
+            Task(**dict({'lease_duration': lease_duration}, **spec), server_url=self.server_url) for spec in specs]
+        manifest = Transfer(self.server_url).upload_manifest(iter_manifest(inputs)) if inputs else None
+        requests_json = [task.get_create_request() for task in tasks]
+        response = requests.post(f'{self.server_url}task/create_batch', json={
+            'tasks': requests_json,
+            'create_user': os.getenv('USER'),
+            'input_manifest': manifest,
+        })
+        if response.status_code != 200:
+            raise MuseClientError(f'Failed to create tasks: HTTP {response.status_code}')
+        for task, _id in zip(tasks, response.json()['_ids']):
+            task._id = _id
+        return tasks
+
+    def query_tasks(self, tasks):
+        response = requests.post(f'{self.server_url}task/query_batch', json={'_ids': [task._id for task in tasks]})
+        return {task['_id']: task for task in response.json()['tasks']}
+
+    def get_trace(self, task_id):
+        response = requests.get(f'{self.server_url}task/trace/{task_id}')
+        if response.status_code == 404:
+            raise MuseClientError(f'Task {task_id} not found')
+        return response.json()['spans']
+
     def list_tasks(self):
         response = requests.get(f'{self.server_url}task/list')
         return response.json()['tasks']
@@ -1,6 +1,13 @@
 import os
 
 SERVER_URL = os.getenv('MUSE_SERVER_ADDRESS', 'http://127.0.0.1:10813/')
+TASK_EVENT_TIMEOUT = float(os.getenv('MUSE_TASK_EVENT_TIMEOUT', 30.0))
+TRANSFER_CONNECTIONS = int(os.getenv('MUSE_TRANSFER_CONNECTIONS', 4))
+TRANSFER_CHUNK_SIZE = int(os.getenv('MUSE_TRANSFER_CHUNK_SIZE', 8 * 1024 ** 2))
+TRANSFER_RETRIES = int(os.getenv('MUSE_TRANSFER_RETRIES', 5))
+TRANSFER_COMPRESSION = os.getenv('MUSE_TRANSFER_COMPRESSION', 'auto')
+TRANSFER_LINK_SPEED = float(os.getenv('MUSE_TRANSFER_LINK_SPEED', 10 * 1024 ** 2))
+CLIENT_CONNECTIONS = int(os.getenv('MUSE_CLIENT_CONNECTIONS', 100))
 
 CACHE_DIR = os.getenv('MUSE_CACHE_DIR', os.path.expanduser('~/.cache/muse'))
 INPUT_ARCHIVE_DIR = os.path.join(CACHE_DIR, 'input_archive')
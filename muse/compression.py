@@ -0,0 +1,181 @@
+import io
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SAMPLE_SIZE = 256 * 1024
+DECOMPRESS_CHUNK_SIZE = 1 << 20
+ENCODING_HEADER = 'X-Muse-Encoding'
+
+
+class SampleFull(Exception):
+    pass
+
+
+class SampleWriter:
+    def __init__(self, size=SAMPLE_SIZE):
+        self.size = size
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data[:self.size - self.buffer.tell()])
+        if self.buffer.tell() >= self.size:
+            raise SampleFull()
+        return len(data)
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+class SizeLimitedWriter:
+    def __init__(self, write, max_size=None):
+        self.write_func = write
+        self.max_size = max_size
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ValueError(f'Decompressed data exceeds {self.max_size} bytes')
+        self.write_func(data)
+        return len(data)
+
+
+class GzipCompressWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+
+class GzipDecompressWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(31)
+
+    def write(self, data):
+        size = len(data)
+        while data:
+            self.fileobj.write(self.decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE))
+            data = self.decompressor.unconsumed_tail
+        return size
+
+    def close(self):
+        self.fileobj.write(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise ValueError('Truncated gzip stream')
+
+
+class GzipCodec:
+    name = 'gzip'
+    suffix = '.gz'
+    device_compress_cmd = 'gzip -c -1'
+    device_decompress_cmd = 'gzip -dc'
+
+    def compress(self, data):
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_writer(self, fileobj):
+        return GzipCompressWriter(fileobj)
+
+    def decompress_writer(self, fileobj):
+        return GzipDecompressWriter(fileobj)
+
+
+class ZstdCodec:
+    name = 'zstd'
+    suffix = '.zst'
+    device_compress_cmd = 'zstd -c -1 -q'
+    device_decompress_cmd = 'zstd -dc -q'
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    def compress_writer(self, fileobj):
+        return zstandard.ZstdCompressor(level=3).stream_writer(fileobj, closefd=False)
+
+    def decompress_writer(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_writer(
+                fileobj, write_size=DECOMPRESS_CHUNK_SIZE, write_return_read=True, closefd=False)
+
+
+CODECS = {codec.name: codec for codec in [ZstdCodec()] if zstandard is not None}
+CODECS['gzip'] = GzipCodec()
+DECOMPRESS_ERRORS = (ValueError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def get_codec(name):
+    return CODECS.get(name)
+
+
+def available_codecs():
+    return list(CODECS)
+
+
+def decompress(name, data, max_size):
+    output = io.BytesIO()
+    writer = CODECS[name].decompress_writer(SizeLimitedWriter(output.write, max_size))
+    writer.write(data)
+    writer.close()
+    return output.getvalue()
+
+
+def decompress_file(name, src_path, dst_path):
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        writer = CODECS[name].decompress_writer(dst)
+        while True:
+            data = src.read(DECOMPRESS_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+        writer.close()
+
+
+def measure_codecs(sample, names):
+    profiles = {}
+    for name in names:
+        if name not in CODECS or not sample:
+            continue
+        start_time = time.perf_counter()
+        compressed = CODECS[name].compress(sample)
+        time_cost = max(time.perf_counter() - start_time, 1e-6)
+        profiles[name] = (len(compressed) / len(sample), len(sample) / time_cost)
+    return profiles
+
+
+def choose_codec(profiles, link_speed):
+    best_name = None
+    best_time = 1 / link_speed
+    for name, (ratio, speed) in profiles.items():
+        time_cost = 1 / speed + ratio / link_speed
+        if time_cost < best_time * 0.9:
+            best_name = name
+            best_time = time_cost
+    return best_name
+
+
+def select_codec(setting, profiles, link_speed):
+    if setting == 'auto':
+        return choose_codec(profiles, link_speed)
+    return setting if setting in profiles else None
+
+
+class LinkMeter:
+    def __init__(self, initial_speed):
+        self.speed = initial_speed
+
+    def add(self, num_bytes, time_cost):
+        if num_bytes < SAMPLE_SIZE or time_cost <= 0:
+            return
+        self.speed = 0.7 * self.speed + 0.3 * num_bytes / time_cost
@@ -0,0 +1,94 @@
+import hashlib
+import posixpath
+from shlex import quote
+
+from loguru import logger
+
+from muse.db import get_colle
+from muse.server_settings import DEVICE_WORKSPACE, DEVICE_CACHE_SIZE
+
+DEVICE_MANIFEST_NAME = 'manifest'
+DEVICE_TREE_NAME = 'tree'
+SYNC_SCRIPT_NAME = '__sync.sh'
+
+
+def format_device_manifest(manifest):
+    lines = []
+    for entry in sorted(manifest, key=lambda e: e['path']):
+        lines.append('{} {} {:o} {}\n'.format(entry['type'], entry.get('hash', '-'), entry['mode'], entry['path']))
+    return ''.join(lines).encode()
+
+
+def get_manifest_digest(manifest):
+    return hashlib.md5(format_device_manifest(manifest)).hexdigest()
+
+
+def get_manifest_size(manifest):
+    return sum(entry['size'] for entry in manifest if entry['type'] == 'file')
+
+
+def build_sync_script(stale_paths):
+    lines = ['set -e', f'cd {DEVICE_TREE_NAME}']
+    for i in range(0, len(stale_paths), 100):
+        lines.append('rm -rf -- ' + ' '.join(quote(p) for p in stale_paths[i:i + 100]))
+    lines += [
+        'cd ..',
+        f'mv {DEVICE_MANIFEST_NAME}.new {DEVICE_MANIFEST_NAME}',
+        f'rm -f {SYNC_SCRIPT_NAME}',
+        f'cp -al {DEVICE_TREE_NAME}/. {quote(DEVICE_WORKSPACE)}/ 2>/dev/null'
+        f' || {{ rm -rf {quote(DEVICE_WORKSPACE)}; mkdir -p {quote(DEVICE_WORKSPACE)};'
+        f' cp -a {DEVICE_TREE_NAME}/. {quote(DEVICE_WORKSPACE)}/; }}',
+        f'touch {DEVICE_MANIFEST_NAME}',
+    ]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+class DeviceCache:
+    def __init__(self, max_size=DEVICE_CACHE_SIZE):
+        self.max_size = max_size
+        self.colle_device_caches = get_colle('device_caches')
+
+    def fits(self, manifest):
+        return get_manifest_size(manifest) <= self.max_size
+
+    def has_mirror(self, device_id):
+        return self.colle_device_caches.find_one({'_id': device_id}, {'_id': 1}) is not None
+
+    def plan(self, device_id, device_digest, manifest):
+        mirror = self.colle_device_caches.find_one({'_id': device_id})
+        current = {entry['path']: entry for entry in manifest}
+        if mirror is None or mirror['digest'] != device_digest:
+            if mirror is not None:
+                logger.warning(f'Device {device_id}: cache mirror does not match the device, resetting cache')
+            reset = True
+            previous = {}
+        else:
+            previous = {entry['path']: entry for entry in mirror['manifest']}
+            reset = any(
+                previous[path]['type'] != entry['type']
+                for path, entry in current.items() if path in previous)
+            if reset:
+                previous = {}
+
+        changed = []
+        for path, entry in current.items():
+            prev_entry = previous.get(path)
+            if prev_entry is None or any(prev_entry.get(k) != entry.get(k) for k in ('hash', 'mode')):
+                changed.append(entry)
+
+        kept_paths = set()
+        for path in current:
+            while path:
+                kept_paths.add(path)
+                path = posixpath.dirname(path)
+        stale_paths = sorted((p for p in previous if p not in kept_paths), reverse=True)
+
+        return reset, changed, stale_paths
+
+    def commit(self, device_id, manifest):
+        self.colle_device_caches.update_one(
+            {'_id': device_id},
+            {'$set': {'manifest': manifest, 'digest': get_manifest_digest(manifest)}}, upsert=True)
+
+    def invalidate(self, device_id):
+        self.colle_device_caches.delete_one({'_id': device_id})
@@ -1,128 +1,784 @@
+import io
+import os
+import signal
 import subprocess
+import tempfile
 import time
+from contextlib import contextmanager
 from shlex import quote
+from threading import Thread, Lock
 
 from loguru import logger
 
-from muse.server_settings import DEVICE_WORKSPACE
+from muse.adb import AdbClient
+from muse.compression import (
+    CODECS, DECOMPRESS_ERRORS, SAMPLE_SIZE, LinkMeter, SampleFull, SampleWriter, decompress_file, get_codec,
+    measure_codecs, select_codec)
+from muse.exceptions import AdbError, AdbCancelled
+from muse.metrics import Counter, Gauge
+from muse.terminate import Deadline
+from muse.trace import span, traced
+from muse.server_settings import (
+    ADB_BACKEND, DEVICE_INFO_TIMEOUT, DEVICE_LABELS_PROP, DEVICE_WORKSPACE, DEVICE_CACHE_DIR, DEVICE_TRANSFER_MODE,
+    DEVICE_PUSH_COMPRESSION, DEVICE_PULL_COMPRESSION, DEVICE_LINK_SPEED, INPUT_ARCHIVE_DIR)
+from muse.device_cache import DEVICE_MANIFEST_NAME, DEVICE_TREE_NAME, SYNC_SCRIPT_NAME
 
 
-class DeviceManager:
-    def __init__(self):
-        pass
+TRANSFER_CHUNK_SIZE = 1 << 20
+CANCELLED_RETURN_CODE = -signal.SIGTERM
+DEVICE_COMPRESS_SPEEDS = {'zstd': 60 * 1024 ** 2, 'gzip': 15 * 1024 ** 2}
 
-    def get_all_device_ids(self):
+TRANSFER_BYTES = Counter(
+        'muse_device_transfer_bytes_total', 'Bytes transferred to or from devices', ['device', 'direction'])
+TRANSFER_SECONDS = Counter(
+        'muse_device_transfer_seconds_total', 'Time spent transferring to or from devices', ['device', 'direction'])
+TRANSFER_SPEED = Gauge(
+        'muse_device_transfer_speed_bytes', 'Speed of the last transfer in bytes per second', ['device', 'direction'])
+
+
+def wait_process(process, terminate_flag):
+    with terminate_flag.watch(process.terminate):
+        try:
+            return process.wait(terminate_flag.remaining())
+        except subprocess.TimeoutExpired:
+            process.terminate()
+    return process.wait()
+
+
+def copy_file(path, fileobj):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(TRANSFER_CHUNK_SIZE)
+            if not data:
+                break
+            fileobj.write(data)
+
+
+def read_exact(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def parse_device_list(text):
+    devices = []
+    for line in text.splitlines():
+        if '\tdevice' in line:
+            devices.append(line.split()[0])
+    return sorted(devices)
+
+
+class ProcessWriter:
+    def __init__(self, process, terminate_flag):
+        self.fd = process.stdin.fileno()
+        self.terminate_flag = terminate_flag
+        self.bytes_written = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.terminate_flag.is_set():
+                raise AdbCancelled('Cancelled')
+            try:
+                n = os.write(self.fd, view)
+            except BrokenPipeError:
+                # the process is terminated on cancellation, which breaks the pipe under a blocked write
+                if self.terminate_flag.is_set():
+                    raise AdbCancelled('Cancelled')
+                raise
+            view = view[n:]
+            self.bytes_written += n
+        return len(data)
+
+
+class ProgressReporter(Thread):
+    def __init__(self, interval=1.0):
+        Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.callbacks = {}
+        self.lock = Lock()
+        self.started = False
+
+    @contextmanager
+    def report(self, callback):
+        key = object()
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.start()
+            self.callbacks[key] = callback
+        try:
+            yield
+        finally:
+            with self.lock:
+                del self.callbacks[key]
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                callbacks = list(self.callbacks.values())
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f'Failed to report progress: {e}')
+
+
+class ShellWriter:
+    def __init__(self, session, terminate_flag):
+        self.session = session
+        self.terminate_flag = terminate_flag
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.session.write_stdin(data, self.terminate_flag)
+        self.bytes_written += len(data)
+        return len(data)
+
+
+class CountingWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+
+def log_transfer(device_id, num_bytes, start_time):
+    time_cost = max(time.time() - start_time, 1e-6)
+    logger.info(
+        f'Device {device_id}: streamed {num_bytes} bytes in {time_cost:.2f} seconds'
+        f' ({num_bytes / time_cost / 1024 ** 2:.2f} MB/s)')
+    return time_cost
+
+
+def get_extract_cmd(codec, archive_path='-'):
+    if codec is None:
+        return f'tar xf {archive_path}'
+    if archive_path == '-':
+        return f'{codec.device_decompress_cmd} | tar xf -'
+    return f'{codec.device_decompress_cmd} {archive_path} | tar xf -'
+
+
+def compressed(write_archive, codec):
+    if codec is None:
+        return write_archive
+
+    def write_compressed(f):
+        writer = codec.compress_writer(f)
+        write_archive(writer)
+        writer.close()
+    return write_compressed
+
+
+class AdbCliBackend:
+    name = 'cli'
+
+    def list_devices(self):
         try:
-            devices = []
             cmd = ['adb', 'devices']
-            for line in subprocess.check_output(cmd, universal_newlines=True, timeout=10).splitlines():
-                if '\tdevice' in line:
-                    devices.append(line.split()[0])
-            devices = sorted(devices)
-            return devices
-        except subprocess.CalledProcessError:
+            return parse_device_list(subprocess.check_output(cmd, universal_newlines=True, timeout=10))
+        except subprocess.SubprocessError:
             return []
 
-    def get_device_info(self, device_id):
-        power_on = None
-        if power_on is None:
-            try:
-                cmd = ['adb', '-s', device_id, 'shell', 'dumpsys', 'input_method']
-                for line in subprocess.check_output(cmd, universal_newlines=True, timeout=10).splitlines():
-                    if 'mSystemReady' in line:
-                        if 'mScreenOn' in line:
-                            power_on = 'mScreenOn=true' in line
-                        elif 'mInteractive' in line:
-                            power_on = 'mInteractive=true' in line
-            except subprocess.SubprocessError:
-                pass
+    def track_devices(self):
+        cmd = ['adb', 'track-devices']
+        logger.info(' '.join(cmd))
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                header = read_exact(process.stdout, 4)
+                if header is None:
+                    return
+                payload = read_exact(process.stdout, int(header, 16))
+                if payload is None:
+                    return
+                yield payload.decode(errors='replace')
+        finally:
+            process.kill()
+            process.wait()
 
-        if power_on is None:
+    def shell(self, device_id, remote_cmd, terminate_flag, stdout=None, stderr=None):
+        cmd = ['adb', '-s', device_id, 'shell', remote_cmd]
+        logger.info(' '.join(cmd))
+        process = subprocess.Popen(
+                cmd, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL if stdout is None else stdout,
+                stderr=subprocess.DEVNULL if stderr is None else stderr)
+        return wait_process(process, terminate_flag)
+
+    def shell_output(self, device_id, remote_cmd, terminate_flag):
+        cmd = ['adb', '-s', device_id, 'shell', remote_cmd]
+        process = subprocess.Popen(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True)
+        with terminate_flag.watch(process.terminate):
             try:
-                cmd = ['adb', '-s', device_id, 'shell', 'dumpsys', 'power']
-                for line in subprocess.check_output(cmd, universal_newlines=True, timeout=10).splitlines():
-                    if 'Display Power' in line:
-                        power_on = 'ON' in line
-            except subprocess.SubprocessError:
-                pass
+                output = process.communicate(timeout=terminate_flag.remaining())[0]
+            except subprocess.TimeoutExpired:
+                process.terminate()
+                output = None
+        if terminate_flag.is_set():
+            output = None
+        process.stdout.close()
+        return process.wait(), output
 
-        battery = None
+    def push(self, device_id, local_path, remote_path, terminate_flag):
+        cmd = ['adb', '-s', device_id, 'push', '--sync', local_path, remote_path]
+        logger.info(' '.join(cmd))
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return wait_process(process, terminate_flag)
+
+    def pull(self, device_id, remote_path, local_path, terminate_flag):
+        cmd = ['adb', '-s', device_id, 'pull', remote_path, local_path]
+        logger.info(' '.join(cmd))
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return wait_process(process, terminate_flag)
+
+    def stream_in(self, device_id, remote_cmd, write_archive, terminate_flag):
+        cmd = ['adb', '-s', device_id, 'exec-in', remote_cmd]
+        logger.info(' '.join(cmd))
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        writer = ProcessWriter(process, terminate_flag)
         try:
-            cmd = ['adb', '-s', device_id, 'shell', 'dumpsys', 'battery']
-            for line in subprocess.check_output(cmd, universal_newlines=True, timeout=10).splitlines():
-                if 'level' in line:
-                    battery = float(line.strip().split()[-1])
-        except subprocess.SubprocessError:
+            with terminate_flag.watch(process.terminate):
+                write_archive(writer)
+        except AdbCancelled:
+            logger.warning(f'Device {device_id}: transfer cancelled after {writer.bytes_written} bytes')
+        except BrokenPipeError:
+            logger.error(f'Device {device_id}: transfer aborted by device after {writer.bytes_written} bytes')
+        except OSError as e:
+            logger.error(f'Device {device_id}: failed to read archive: {e}')
+            process.terminate()
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
             pass
+        return wait_process(process, terminate_flag), writer.bytes_written
 
-        hostname = None
+    def stream_out(self, device_id, remote_cmd, fileobj, terminate_flag):
+        cmd = ['adb', '-s', device_id, 'exec-out', remote_cmd]
+        logger.info(' '.join(cmd))
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        fd = process.stdout.fileno()
+        bytes_read = 0
+        with terminate_flag.watch(process.terminate):
+            while not terminate_flag.is_set():
+                data = os.read(fd, TRANSFER_CHUNK_SIZE)
+                if not data:
+                    break
+                fileobj.write(data)
+                bytes_read += len(data)
+        process.stdout.close()
+        return wait_process(process, terminate_flag), bytes_read
+
+
+class AdbNativeBackend:
+    name = 'native'
+
+    def __init__(self):
+        self.client = AdbClient()
+        self.cli = AdbCliBackend()
+
+    def supports_shell_v2(self, device_id):
         try:
-            cmd = ['adb', '-s', device_id, 'shell', 'getprop', 'persist.project_name']
-            hostname = subprocess.check_output(cmd, universal_newlines=True, timeout=10).strip()
-            if not hostname:
-                cmd = ['adb', '-s', device_id, 'shell', 'getprop', 'ro.product.model']
-                hostname = subprocess.check_output(cmd, universal_newlines=True, timeout=10).strip()
-        except subprocess.SubprocessError:
-            pass
+            return 'shell_v2' in self.client.get_features(device_id)
+        except (AdbError, OSError):
+            return False
+
+    def list_devices(self):
+        try:
+            return parse_device_list(self.client.devices())
+        except (AdbError, OSError) as e:
+            logger.error(f'Failed to list devices: {e}')
+            return []
+
+    def track_devices(self):
+        logger.info('Tracking devices through the adb server')
+        for text in self.client.track_devices():
+            device_ids = set(parse_device_list(text))
+            for device_id in list(self.client.features):
+                if device_id not in device_ids:
+                    self.client.forget_device(device_id)
+            yield text
+
+    def open_session(self, device_id, remote_cmd, raw=False):
+        if raw:
+            return self.client.exec(device_id, remote_cmd)
+        return self.client.shell(device_id, remote_cmd)
+
+    def run_shell(self, device_id, remote_cmd, terminate_flag, stdout=None, stderr=None, raw=False):
+        try:
+            session = self.open_session(device_id, remote_cmd, raw)
+        except (AdbError, OSError) as e:
+            logger.error(f'Device {device_id}: failed to open shell: {e}')
+            return 1
+        try:
+            return session.wait(stdout, stderr, terminate_flag)
+        except AdbCancelled:
+            return CANCELLED_RETURN_CODE
+        except (AdbError, OSError) as e:
+            logger.error(f'Device {device_id}: shell failed: {e}')
+            return 1
+        finally:
+            session.close()
+
+    def shell(self, device_id, remote_cmd, terminate_flag, stdout=None, stderr=None):
+        if not self.supports_shell_v2(device_id):
+            return self.cli.shell(device_id, remote_cmd, terminate_flag, stdout, stderr)
+        logger.info(f'adb -s {device_id} shell {remote_cmd} (native)')
+        return self.run_shell(device_id, remote_cmd, terminate_flag, stdout, stderr)
+
+    def shell_output(self, device_id, remote_cmd, terminate_flag):
+        if not self.supports_shell_v2(device_id):
+            return self.cli.shell_output(device_id, remote_cmd, terminate_flag)
+        output = io.BytesIO()
+        return_code = self.run_shell(device_id, remote_cmd, terminate_flag, stdout=output)
+        if return_code == CANCELLED_RETURN_CODE:
+            return return_code, None
+        return return_code, output.getvalue().decode(errors='replace')
+
+    def push(self, device_id, local_path, remote_path, terminate_flag):
+        logger.info(f'adb -s {device_id} push {local_path} {remote_path} (native)')
+        try:
+            with open(local_path, 'rb') as f, self.client.sync(device_id) as sync:
+                sync.push(f, remote_path, os.stat(local_path).st_mode & 0o777, terminate_flag)
+            return 0
+        except AdbCancelled:
+            return CANCELLED_RETURN_CODE
+        except (AdbError, OSError) as e:
+            logger.error(f'Device {device_id}: push failed: {e}')
+            return 1
+
+    def pull(self, device_id, remote_path, local_path, terminate_flag):
+        logger.info(f'adb -s {device_id} pull {remote_path} {local_path} (native)')
+        try:
+            with open(local_path, 'wb') as f, self.client.sync(device_id) as sync:
+                sync.pull(remote_path, f, terminate_flag)
+            return 0
+        except AdbCancelled:
+            return CANCELLED_RETURN_CODE
+        except (AdbError, OSError) as e:
+            logger.error(f'Device {device_id}: pull failed: {e}')
+            return 1
+
+    def stream_in(self, device_id, remote_cmd, write_archive, terminate_flag):
+        raw = not self.supports_shell_v2(device_id)
+        logger.info(f'adb -s {device_id} {"exec-in" if raw else "shell"} {remote_cmd} < archive (native)')
+        try:
+            session = self.open_session(device_id, remote_cmd, raw)
+        except (AdbError, OSError) as e:
+            logger.error(f'Device {device_id}: failed to open shell: {e}')
+            return 1, 0
+        writer = ShellWriter(session, terminate_flag)
+        try:
+            write_archive(writer)
+            session.close_stdin(terminate_flag)
+            return session.wait(terminate_flag=terminate_flag), writer.bytes_written
+        except AdbCancelled:
+            logger.warning(f'Device {device_id}: transfer cancelled after {writer.bytes_written} bytes')
+            return CANCELLED_RETURN_CODE, writer.bytes_written
+        except (AdbError, OSError) as e:
+            logger.error(f'Device {device_id}: transfer failed after {writer.bytes_written} bytes: {e}')
+            return 1, writer.bytes_written
+        finally:
+            session.close()
+
+    def stream_out(self, device_id, remote_cmd, fileobj, terminate_flag):
+        raw = not self.supports_shell_v2(device_id)
+        logger.info(f'adb -s {device_id} {"exec-out" if raw else "shell"} {remote_cmd} > archive (native)')
+        writer = CountingWriter(fileobj)
+        return_code = self.run_shell(device_id, remote_cmd, terminate_flag, stdout=writer, raw=raw)
+        return return_code, writer.bytes_written
+
+
+def get_adb_backend(name=ADB_BACKEND):
+    if name == 'native':
+        return AdbNativeBackend()
+    assert name == 'cli'
+    return AdbCliBackend()
+
+
+class DeviceWatcher(Thread):
+    def __init__(self, on_change=None, backend=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.on_change = on_change
+        self.backend = backend or get_adb_backend()
+        self.device_ids = None
+        self.lock = Lock()
+
+    def get_device_ids(self):
+        with self.lock:
+            return self.device_ids
+
+    def set_device_ids(self, device_ids):
+        with self.lock:
+            changed = device_ids != self.device_ids
+            self.device_ids = device_ids
+        if changed:
+            logger.info(f'Devices changed: {device_ids}')
+            if self.on_change is not None:
+                self.on_change(device_ids)
+
+    def run(self):
+        while True:
+            try:
+                for text in self.backend.track_devices():
+                    self.set_device_ids(parse_device_list(text))
+            except (AdbError, OSError, ValueError) as e:
+                logger.error(f'Device tracking failed: {e}')
+
+            logger.warning('Device tracking stopped, restarting')
+            with self.lock:
+                self.device_ids = None
+            time.sleep(1)
+
+
+class DeviceManager:
+    def __init__(
+            self, transfer_mode=DEVICE_TRANSFER_MODE, push_compression=DEVICE_PUSH_COMPRESSION,
+            pull_compression=DEVICE_PULL_COMPRESSION, device_watcher=None, backend=None):
+        assert transfer_mode in ('push', 'stream')
+        assert push_compression in ('', 'none', 'auto', 'gzip', 'zstd')
+        assert pull_compression in ('', 'none', 'auto', 'gzip', 'zstd')
+        self.transfer_mode = transfer_mode
+        self.push_compression = '' if push_compression == 'none' else push_compression
+        self.pull_compression = '' if pull_compression == 'none' else pull_compression
+        self.device_watcher = device_watcher
+        self.backend = backend or get_adb_backend()
+        self.device_codecs = {}
+        self.link_meters = {}
+        self.progress_reporter = ProgressReporter()
+
+    def get_all_device_ids(self):
+        if self.device_watcher is not None:
+            device_ids = self.device_watcher.get_device_ids()
+            if device_ids is not None:
+                return device_ids
+        return self.backend.list_devices()
+
+    def get_shell_output(self, device_id, remote_cmd, deadline):
+        return_code, output = self.backend.shell_output(device_id, remote_cmd, deadline)
+        if return_code or output is None:
+            return None
+        return output
+
+    def get_device_info(self, device_id, hostname=None, model=None, timeout=DEVICE_INFO_TIMEOUT):
+        deadline = Deadline(timeout=timeout)
+
+        power_on = None
+        if power_on is None:
+            output = self.get_shell_output(device_id, 'dumpsys input_method', deadline)
+            for line in (output or '').splitlines():
+                if 'mSystemReady' in line:
+                    if 'mScreenOn' in line:
+                        power_on = 'mScreenOn=true' in line
+                    elif 'mInteractive' in line:
+                        power_on = 'mInteractive=true' in line
+
+        if power_on is None:
+            output = self.get_shell_output(device_id, 'dumpsys power', deadline)
+            for line in (output or '').splitlines():
+                if 'Display Power' in line:
+                    power_on = 'ON' in line
+
+        battery = None
+        output = self.get_shell_output(device_id, 'dumpsys battery', deadline)
+        for line in (output or '').splitlines():
+            if 'level' in line:
+                battery = float(line.strip().split()[-1])
+
+        if model is None:
+            output = self.get_shell_output(device_id, 'getprop ro.product.model', deadline)
+            model = None if output is None else output.strip() or None
+
+        if hostname is None:
+            output = self.get_shell_output(device_id, 'getprop persist.project_name', deadline)
+            if output is not None:
+                hostname = output.strip() or model
+
+        labels = []
+        output = self.get_shell_output(device_id, f'getprop {DEVICE_LABELS_PROP}', deadline)
+        if output is not None:
+            labels = [label.strip() for label in output.split(',') if label.strip()]
 
         return {
             'device_id': device_id,
             'power_on': power_on,
             'battery': battery,
             'hostname': hostname,
+            'model': model,
+            'labels': labels,
         }
 
+    def load_transfer_profile(self, device_id, profile):
+        if profile.get('codecs') is not None:
+            self.device_codecs[device_id] = profile['codecs']
+        if profile.get('link_speed') is not None:
+            self.link_meters[device_id] = LinkMeter(profile['link_speed'])
+
+    def get_transfer_profile(self, device_id):
+        profile = {'link_speed': self.get_link_meter(device_id).speed}
+        if device_id in self.device_codecs:
+            profile['codecs'] = self.device_codecs[device_id]
+        return profile
+
+    def get_link_meter(self, device_id):
+        if device_id not in self.link_meters:
+            self.link_meters[device_id] = LinkMeter(DEVICE_LINK_SPEED)
+        return self.link_meters[device_id]
+
+    def get_device_codecs(self, device_id, terminate_flag):
+        if device_id not in self.device_codecs:
+            remote_cmd = '; '.join([
+                f'for c in {" ".join(CODECS)}',
+                'do echo muse | $c -c 2>/dev/null | $c -dc 2>/dev/null | grep -q muse && echo $c',
+                'done',
+                'true',
+            ])
+            return_code, output = self.backend.shell_output(device_id, remote_cmd, terminate_flag)
+            if return_code or output is None:
+                return []
+            self.device_codecs[device_id] = [name for name in output.split() if name in CODECS]
+            logger.info(f'Device {device_id}: supports compression codecs {self.device_codecs[device_id]}')
+        return self.device_codecs[device_id]
+
+    @traced('choose_push_codec')
+    def choose_push_codec(self, device_id, write_archive, terminate_flag):
+        if not self.push_compression:
+            return None
+        codecs = self.get_device_codecs(device_id, terminate_flag)
+        if not codecs:
+            return None
+
+        sample = SampleWriter()
+        try:
+            write_archive(sample)
+        except SampleFull:
+            pass
+        profiles = measure_codecs(sample.getvalue(), codecs)
+        name = select_codec(self.push_compression, profiles, self.get_link_meter(device_id).speed)
+        logger.info(f'Device {device_id}: pushing with compression {name or "none"}')
+        return get_codec(name)
+
+    @traced('choose_pull_codec')
+    def choose_pull_codec(self, device_id, collect_cmd, terminate_flag):
+        if not self.pull_compression:
+            return None
+        codecs = self.get_device_codecs(device_id, terminate_flag)
+        if self.pull_compression != 'auto':
+            return get_codec(self.pull_compression) if self.pull_compression in codecs else None
+        if not codecs:
+            return None
+
+        remote_cmd = '; '.join(['exec 2>/dev/null'] + collect_cmd + [
+            f'tar cf - ${{paths[@]}} | head -c {SAMPLE_SIZE} > __sample.tar',
+            'echo raw $(wc -c < __sample.tar)',
+        ] + [
+            f'echo {name} $({CODECS[name].device_compress_cmd} < __sample.tar | wc -c)' for name in codecs
+        ] + ['rm -f __sample.tar'])
+        return_code, output = self.backend.shell_output(device_id, remote_cmd, terminate_flag)
+        if return_code or output is None:
+            return None
+        sizes = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1].isdigit():
+                sizes[fields[0]] = int(fields[1])
+        if not sizes.get('raw'):
+            return None
+        profiles = {
+            name: (sizes[name] / sizes['raw'], DEVICE_COMPRESS_SPEEDS[name])
+            for name in codecs if name in sizes}
+        name = select_codec('auto', profiles, self.get_link_meter(device_id).speed)
+        logger.info(f'Device {device_id}: pulling with compression {name or "none"}')
+        return get_codec(name)
+
+    def record_transfer(self, device_id, direction, num_bytes, time_cost):
+        self.get_link_meter(device_id).add(num_bytes, time_cost)
+        TRANSFER_BYTES.inc(num_bytes, device=device_id, direction=direction)
+        TRANSFER_SECONDS.inc(time_cost, device=device_id, direction=direction)
+        if time_cost > 0:
+            TRANSFER_SPEED.set(num_bytes / time_cost, device=device_id, direction=direction)
+
+    @traced('stream_in', 'device')
+    def stream_to_device(self, device_id, remote_cmd, write_archive, terminate_flag):
+        start_time = time.time()
+        return_code, num_bytes = self.backend.stream_in(device_id, remote_cmd, write_archive, terminate_flag)
+        self.record_transfer(device_id, 'push', num_bytes, log_transfer(device_id, num_bytes, start_time))
+        if terminate_flag.is_set() and not return_code:
+            return_code = 1
+        return return_code
+
+    @traced('push', 'device')
+    def push_file(self, device_id, local_path, remote_path, terminate_flag):
+        start_time = time.time()
+        return_code = self.backend.push(device_id, local_path, remote_path, terminate_flag)
+        if not return_code:
+            self.record_transfer(device_id, 'push', os.path.getsize(local_path), time.time() - start_time)
+        return return_code
+
+    @traced('pull', 'device')
+    def pull_file(self, device_id, remote_path, local_path, terminate_flag):
+        start_time = time.time()
+        return_code = self.backend.pull(device_id, remote_path, local_path, terminate_flag)
+        if not return_code:
+            self.record_transfer(device_id, 'pull', os.path.getsize(local_path), time.time() - start_time)
+        return return_code
+
+    @traced('build_archive')
+    def write_temp_archive(self, write_archive, codec):
+        fd, tar_path = tempfile.mkstemp(dir=INPUT_ARCHIVE_DIR, suffix='.tar' + (codec.suffix if codec else ''))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                compressed(write_archive, codec)(f)
+        except BaseException:
+            os.remove(tar_path)
+            raise
+        return tar_path
+
+    def push_archive(self, device_id, write_archive, terminate_flag):
+        codec = self.choose_push_codec(device_id, write_archive, terminate_flag)
+        return self.push_encoded_archive(device_id, write_archive, codec, terminate_flag)
+
+    def push_encoded_archive(self, device_id, write_archive, codec, terminate_flag):
+        if self.transfer_mode == 'stream':
+            remote_cmd = ' && '.join([
+                'set -o pipefail',
+                f'rm -rf {quote(DEVICE_WORKSPACE)}',
+                f'mkdir -p {quote(DEVICE_WORKSPACE)}',
+                f'cd {quote(DEVICE_WORKSPACE)}',
+                f"{get_extract_cmd(codec)} --no-same-owner --exclude '*/__empty.txt'",
+            ])
+            return self.stream_to_device(device_id, remote_cmd, compressed(write_archive, codec), terminate_flag)
+
+        try:
+            tar_path = self.write_temp_archive(write_archive, codec)
+        except OSError as e:
+            logger.error(f'Device {device_id}: failed to build archive: {e}')
+            return 1
+        try:
+            return self.push_input_file(device_id, tar_path, codec, terminate_flag)
+        finally:
+            os.remove(tar_path)
+
+    def push_input_file(self, device_id, tar_path, codec, terminate_flag):
+        with span('clean_workspace', 'device'):
+            self.backend.shell(device_id, f'rm -rf {DEVICE_WORKSPACE}', terminate_flag)
+
+        remote_path = '__input.tar' + (codec.suffix if codec else '')
+        return_code = self.push_file(device_id, tar_path, f'{DEVICE_WORKSPACE}/{remote_path}', terminate_flag)
+        if return_code:
+            return return_code
+
+        remote_cmd = ' && '.join([
+            'set -o pipefail',
+            f'cd {DEVICE_WORKSPACE}',
+            f"{get_extract_cmd(codec, remote_path)} --no-same-owner --exclude '*/__empty.txt'",
+            f'rm {remote_path}',
+        ])
+        with span('extract', 'device'):
+            return self.backend.shell(device_id, remote_cmd, terminate_flag)
+
     def push_data(self, device_id, tar_path, terminate_flag):
-        cmd = ['adb', '-s', device_id, 'shell', 'rm', '-rf', DEVICE_WORKSPACE]
-        logger.info(' '.join(cmd))
-        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        while not terminate_flag.is_set():
-            try:
-                process.wait(timeout=0.1)
-                break
-            except subprocess.TimeoutExpired:
-                pass
-        if terminate_flag.is_set():
-            process.terminate()
-        process.wait()
+        def write_archive(f):
+            copy_file(tar_path, f)
 
-        cmd = ['adb', '-s', device_id, 'push', '--sync', tar_path, f'{DEVICE_WORKSPACE}/__input.tar']
-        logger.info(' '.join(cmd))
-        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        while not terminate_flag.is_set():
-            try:
-                process.wait(timeout=0.1)
-                break
-            except subprocess.TimeoutExpired:
-                pass
-        if terminate_flag.is_set():
-            process.terminate()
-        process.wait()
-        if process.returncode:
-            return process.returncode
+        codec = self.choose_push_codec(device_id, write_archive, terminate_flag)
+        if codec is None and self.transfer_mode == 'push':
+            return self.push_input_file(device_id, tar_path, None, terminate_flag)
+        return self.push_encoded_archive(device_id, write_archive, codec, terminate_flag)
+
+    @traced('prepare_cache', 'device')
+    def prepare_cached_workspace(self, device_id, terminate_flag):
+        cache_dir = quote(DEVICE_CACHE_DIR)
+        remote_cmd = '; '.join([
+            f'[ -z "$(find {cache_dir}/{DEVICE_TREE_NAME} -type f -cnewer {cache_dir}/{DEVICE_MANIFEST_NAME}'
+            f' 2>/dev/null | head -n 1)" ] || rm -f {cache_dir}/{DEVICE_MANIFEST_NAME}',
+            f'rm -rf {quote(DEVICE_WORKSPACE)}',
+            f'mkdir -p {quote(DEVICE_WORKSPACE)} {cache_dir}/{DEVICE_TREE_NAME}',
+            f'md5sum {cache_dir}/{DEVICE_MANIFEST_NAME} 2>/dev/null',
+            'true',
+        ])
+        logger.info(f'adb -s {device_id} shell {remote_cmd}')
+        return_code, output = self.backend.shell_output(device_id, remote_cmd, terminate_flag)
+        if return_code or output is None:
+            return None
+        fields = output.split()
+        return fields[0] if fields else ''
 
-        cmd = [
-            'adb', '-s', device_id, 'shell',
-            f'cd {DEVICE_WORKSPACE} && tar xvf __input.tar --no-same-owner --exclude */__empty.txt'
+    def push_cached_data(self, device_id, write_delta, reset, terminate_flag):
+        codec = self.choose_push_codec(device_id, write_delta, terminate_flag)
+        sync_cmd = [
+            'set -o pipefail',
+            f'cd {quote(DEVICE_CACHE_DIR)}',
+            f'rm -f {DEVICE_MANIFEST_NAME}',
         ]
-        logger.info(' '.join(cmd))
-        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        while not terminate_flag.is_set():
-            try:
-                process.wait(timeout=0.1)
-                break
-            except subprocess.TimeoutExpired:
-                pass
-        if terminate_flag.is_set():
-            process.terminate()
-        process.wait()
-        if process.returncode:
-            return process.returncode
-        return 0
+        if reset:
+            sync_cmd += [f'rm -rf {DEVICE_TREE_NAME}', f'mkdir {DEVICE_TREE_NAME}']
+
+        if self.transfer_mode == 'stream':
+            remote_cmd = ' && '.join(sync_cmd + [
+                f'{get_extract_cmd(codec)} --no-same-owner',
+                f'sh {SYNC_SCRIPT_NAME}',
+            ])
+            return self.stream_to_device(device_id, remote_cmd, compressed(write_delta, codec), terminate_flag)
+
+        try:
+            delta_tar_path = self.write_temp_archive(write_delta, codec)
+        except OSError as e:
+            logger.error(f'Device {device_id}: failed to build archive: {e}')
+            return 1
+        remote_path = '__delta.tar' + (codec.suffix if codec else '')
+        try:
+            return_code = self.push_file(device_id, delta_tar_path, f'{DEVICE_CACHE_DIR}/{remote_path}', terminate_flag)
+            if return_code:
+                return return_code
+        finally:
+            os.remove(delta_tar_path)
+
+        remote_cmd = ' && '.join(sync_cmd + [
+            f'{get_extract_cmd(codec, remote_path)} --no-same-owner',
+            f'rm {remote_path}',
+            f'sh {SYNC_SCRIPT_NAME}',
+        ])
+        with span('sync_cache', 'device'):
+            return self.backend.shell(device_id, remote_cmd, terminate_flag)
+
+    @traced('clear_cache', 'device')
+    def clear_cache(self, device_id, terminate_flag):
+        return self.backend.shell(device_id, f'rm -rf {quote(DEVICE_CACHE_DIR)}', terminate_flag)
+
+    @traced('stream_out', 'device')
+    def stream_from_device(self, device_id, remote_cmd, dst_path, codec, terminate_flag):
+        start_time = time.time()
+        try:
+            with open(dst_path, 'wb') as f:
+                writer = f if codec is None else codec.decompress_writer(f)
+                return_code, num_bytes = self.backend.stream_out(device_id, remote_cmd, writer, terminate_flag)
+                if codec is not None and not return_code:
+                    writer.close()
+        except DECOMPRESS_ERRORS as e:
+            logger.error(f'Device {device_id}: failed to decompress output: {e}')
+            return 1
+        self.record_transfer(device_id, 'pull', num_bytes, log_transfer(device_id, num_bytes, start_time))
+        if terminate_flag.is_set() and not return_code:
+            return_code = 1
+        return return_code
 
     def pull_data(self, device_id, src_path, dst_path, terminate_flag):
         src_path_str = ' '.join([f"'{p}'" for p in src_path])
-        remote_cmd = '; '.join([
+        collect_cmd = [
             f'cd {DEVICE_WORKSPACE}',
             'touch __empty.txt',
             'paths=()',
@@ -131,56 +787,48 @@ class DeviceManager:
             'then paths+=($p)',
             'fi',
             'done',
-            'tar cvf __output.tar ${paths[@]}',
-        ])
+        ]
+        codec = self.choose_pull_codec(device_id, collect_cmd, terminate_flag)
+        compress_cmd = '' if codec is None else f' | {codec.device_compress_cmd}'
 
-        cmd = ['adb', '-s', device_id, 'shell', remote_cmd]
-        logger.info(' '.join(cmd))
-        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        while not terminate_flag.is_set():
-            try:
-                process.wait(0.1)
-                break
-            except subprocess.TimeoutExpired:
-                pass
-        if terminate_flag.is_set():
-            process.terminate()
-        process.wait()
-        if process.returncode:
-            return process.returncode
+        if self.transfer_mode == 'stream':
+            archive_cmd = ['set -o pipefail', f'tar cf - ${{paths[@]}}{compress_cmd}']
+            remote_cmd = '; '.join(['exec 2>/dev/null'] + collect_cmd + archive_cmd)
+            return self.stream_from_device(device_id, remote_cmd, dst_path, codec, terminate_flag)
 
-        cmd = ['adb', '-s', device_id, 'pull', f'{DEVICE_WORKSPACE}/__output.tar', dst_path]
-        logger.info(' '.join(cmd))
-        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        while not terminate_flag.is_set():
-            try:
-                process.wait(0.1)
-                break
-            except subprocess.TimeoutExpired:
-                pass
-        if terminate_flag.is_set():
-            process.terminate()
-        process.wait()
-        if process.returncode:
-            return process.returncode
+        remote_path = '__output.tar' + (codec.suffix if codec else '')
+        remote_cmd = '; '.join(
+                ['set -o pipefail'] + collect_cmd + [f'tar cf - ${{paths[@]}}{compress_cmd} > {remote_path}'])
+        with span('archive_outputs', 'device'):
+            return_code = self.backend.shell(device_id, remote_cmd, terminate_flag)
+        if return_code:
+            return return_code
 
+        if codec is None:
+            return self.pull_file(device_id, f'{DEVICE_WORKSPACE}/{remote_path}', dst_path, terminate_flag)
+
+        local_path = dst_path + codec.suffix
+        try:
+            return_code = self.pull_file(device_id, f'{DEVICE_WORKSPACE}/{remote_path}', local_path, terminate_flag)
+            if return_code:
+                return return_code
+            with span('decompress'):
+                decompress_file(codec.name, local_path, dst_path)
+        except DECOMPRESS_ERRORS as e:
+            logger.error(f'Device {device_id}: failed to decompress output: {e}')
+            return 1
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
         return 0
 
+    @traced('command', 'device')
     def run_device_command(self, device_id, stdout_file, stderr_file, remote_cmd, terminate_flag):
         out_writer = open(stdout_file, 'wb')
         err_writer = open(stderr_file, 'wb')
 
         start_time = time.time()
-        last_print_time = time.time()
         remote_cmd_str = ' '.join(remote_cmd)
-        local_cmd = [
-            'adb', '-s', device_id, 'shell', '-n',
-            f'cd {quote(DEVICE_WORKSPACE)} && {remote_cmd_str}'
-        ]
-        logger.info(' '.join(local_cmd))
-        process = subprocess.Popen(
-                local_cmd, stdin=subprocess.DEVNULL,
-                stdout=out_writer, stderr=err_writer)
 
         def print_offset():
             stdout_offset = out_writer.tell()
@@ -193,21 +841,15 @@ class DeviceManager:
                 f', {stderr_offset} bytes to stderr'
             )
 
-        while not terminate_flag.is_set():
-            if time.time() > last_print_time + 1.0:
-                print_offset()
-                last_print_time = time.time()
-            try:
-                process.wait(0.1)
-                break
-            except subprocess.TimeoutExpired:
-                continue
-        if terminate_flag.is_set():
-            process.terminate()
-        process.wait()
+        with self.progress_reporter.report(print_offset):
+            return_code = self.backend.shell(
+                    device_id, f'cd {quote(DEVICE_WORKSPACE)} && {remote_cmd_str}', terminate_flag,
+                    stdout=out_writer, stderr=err_writer)
+        out_writer.flush()
+        err_writer.flush()
         print_offset()
 
         out_writer.close()
         err_writer.close()
 
-        return process.returncode
+        return return_code
@@ -0,0 +1,116 @@
+import time
+from functools import lru_cache
+from threading import Thread
+
+from loguru import logger
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+
+from muse.db import get_db, get_colle
+from muse.server_settings import EVENT_LOG_SIZE
+
+EVENTS_COLLE_NAME = 'task_events'
+
+
+def supports_change_streams():
+    hello = get_db().client.admin.command('isMaster')
+    return 'setName' in hello or hello.get('msg') == 'isdbgrid'
+
+
+@lru_cache()
+def use_event_log():
+    return not supports_change_streams()
+
+
+def init_event_log():
+    if use_event_log():
+        ensure_event_log()
+
+
+def ensure_event_log():
+    db = get_db()
+    try:
+        db.create_collection(EVENTS_COLLE_NAME, capped=True, size=EVENT_LOG_SIZE)
+    except CollectionInvalid:
+        if not db[EVENTS_COLLE_NAME].options().get('capped'):
+            raise RuntimeError(
+                    f'Collection {EVENTS_COLLE_NAME} exists but is not capped, drop it so it can be recreated')
+    # tailable cursors on an empty capped collection die immediately
+    colle_events = get_colle(EVENTS_COLLE_NAME)
+    if colle_events.find_one() is None:
+        colle_events.insert_one({'task_id': None, 'status': None, 'time': 0})
+
+
+def publish_task_event(task_id, status=None):
+    if not use_event_log():
+        return
+    try:
+        get_colle(EVENTS_COLLE_NAME).insert_one({'task_id': task_id, 'status': status, 'time': time.time()})
+    except PyMongoError as e:
+        logger.warning(f'Task {task_id}: failed to publish event: {e}')
+
+
+def publish_task_events(task_ids, status=None):
+    if not use_event_log():
+        return
+    now = time.time()
+    try:
+        get_colle(EVENTS_COLLE_NAME).insert_many(
+                [{'task_id': task_id, 'status': status, 'time': now} for task_id in task_ids])
+    except PyMongoError as e:
+        logger.warning(f'Failed to publish events for {len(task_ids)} task(s): {e}')
+
+
+class EventWatcher(Thread):
+    def __init__(self, callback):
+        Thread.__init__(self)
+        self.daemon = True
+        self.callback = callback
+
+    def run(self):
+        if use_event_log():
+            logger.info(f'Change streams unavailable, tailing {EVENTS_COLLE_NAME}')
+            self.tail_event_log()
+            return
+        try:
+            self.watch_change_stream()
+        except OperationFailure as e:
+            logger.error(f'Failed to watch task change stream: {e.details.get("errmsg", e)}')
+
+    def watch_change_stream(self):
+        pipeline = [{'$match': {'$or': [
+            {'operationType': 'insert'},
+            {'updateDescription.updatedFields.status': {'$exists': True}},
+            {'updateDescription.updatedFields.input_archive_ready': {'$exists': True}},
+        ]}}]
+        while True:
+            try:
+                with get_colle('tasks').watch(pipeline) as stream:
+                    logger.info('Watching task change stream')
+                    for change in stream:
+                        if change['operationType'] == 'insert':
+                            status = change['fullDocument'].get('status')
+                        else:
+                            status = change['updateDescription']['updatedFields'].get('status')
+                        self.callback({'task_id': change['documentKey']['_id'], 'status': status})
+            except OperationFailure:
+                raise
+            except PyMongoError as e:
+                logger.warning(f'Task change stream interrupted: {e}')
+                self.callback(None)
+                time.sleep(1)
+
+    def tail_event_log(self):
+        colle_events = get_colle(EVENTS_COLLE_NAME)
+        last_time = time.time()
+        while True:
+            try:
+                cursor = colle_events.find({'time': {'$gte': last_time}}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for event in cursor:
+                        last_time = event['time']
+                        self.callback(event)
+            except PyMongoError as e:
+                logger.warning(f'Tailing {EVENTS_COLLE_NAME} interrupted: {e}')
+                self.callback(None)
+            time.sleep(1)
@@ -1,2 +1,14 @@
 class MuseClientError(RuntimeError):
     pass
+
+
+class TransferError(MuseClientError):
+    pass
+
+
+class AdbError(RuntimeError):
+    pass
+
+
+class AdbCancelled(AdbError):
+    pass
@@ -0,0 +1,60 @@
+import heapq
+import itertools
+
+
+def parse_user_values(text, value_type):
+    values = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        user, _, value = item.partition('=')
+        values[user.strip()] = value_type(value)
+    return values
+
+
+class FairShareQueue:
+    def __init__(self, user_weights, user_max_tasks, active_tasks):
+        self.user_weights = user_weights
+        self.user_max_tasks = user_max_tasks
+        self.active_tasks = dict(active_tasks)
+        self.queues = {}
+        self.counter = itertools.count()
+
+    def get_weight(self, user):
+        return self.user_weights.get(user, self.user_weights.get('*', 1.0))
+
+    def get_max_tasks(self, user):
+        return self.user_max_tasks.get(user, self.user_max_tasks.get('*', 0))
+
+    def is_capped(self, user):
+        max_tasks = self.get_max_tasks(user)
+        return max_tasks > 0 and self.active_tasks.get(user, 0) >= max_tasks
+
+    def add(self, priority, user, tasks):
+        self.queues.setdefault(priority, {})[user] = iter(tasks)
+
+    def push_user(self, heap, user, task):
+        if task is not None and not self.is_capped(user):
+            share = self.active_tasks.get(user, 0) / max(self.get_weight(user), 1e-6)
+            heapq.heappush(heap, (share, task['create_time'], next(self.counter), user, task))
+
+    def iter_dispatch(self, free_devices, get_devices):
+        for priority in sorted(self.queues, reverse=True):
+            if not free_devices:
+                return
+            user_queues = self.queues[priority]
+            heap = []
+            for user, tasks in user_queues.items():
+                self.push_user(heap, user, next(tasks, None))
+            while heap and free_devices:
+                _, _, _, user, task = heapq.heappop(heap)
+                tasks = user_queues[user]
+                while task is not None:
+                    devices = get_devices(task) or ()
+                    device_id = next((device_id for device_id in devices if device_id in free_devices), None)
+                    if device_id is not None:
+                        self.active_tasks[user] = self.active_tasks.get(user, 0) + 1
+                        yield task, device_id
+                        self.push_user(heap, user, next(tasks, None))
+                        break
+                    task = next(tasks, None)
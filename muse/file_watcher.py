@@ -0,0 +1,114 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from threading import Thread, Condition
+
+from loguru import logger
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+INOTIFY_BUFFER_SIZE = 64 * 1024
+
+
+def open_inotify(directory):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    wd = libc.inotify_add_watch(fd, os.fsencode(directory), IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE)
+    if wd < 0:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), f'inotify_add_watch failed on {directory}')
+    return fd
+
+
+def parse_inotify_events(data):
+    names = []
+    offset = 0
+    while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+        _, _, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+        offset += INOTIFY_EVENT_HEADER.size
+        names.append(data[offset:offset + name_len].rstrip(b'\0').decode(errors='replace'))
+        offset += name_len
+    return names
+
+
+class FileWatcher(Thread):
+    def __init__(self, directory, poll_interval=0.1):
+        Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.watched = {}
+        self.epoch = 0
+        self.condition = Condition()
+        self.listeners = []
+        try:
+            self.fd = open_inotify(directory)
+        except (OSError, AttributeError) as e:
+            logger.warning(f'inotify unavailable ({e}), falling back to polling {directory}')
+            self.fd = None
+
+    def watch(self, names):
+        with self.condition:
+            for name in names:
+                refs, version = self.watched.get(name, (0, 0))
+                self.watched[name] = (refs + 1, version)
+
+    def unwatch(self, names):
+        with self.condition:
+            for name in names:
+                refs, version = self.watched[name]
+                if refs > 1:
+                    self.watched[name] = (refs - 1, version)
+                else:
+                    del self.watched[name]
+
+    def get_version(self, names):
+        with self.condition:
+            return tuple(self.watched[name][1] for name in names), self.epoch
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def notify(self, names):
+        with self.condition:
+            names = [name for name in names if name in self.watched]
+            for name in names:
+                refs, version = self.watched[name]
+                self.watched[name] = (refs, version + 1)
+            self.condition.notify_all()
+        if names:
+            for callback in self.listeners:
+                callback(names)
+
+    def broadcast(self):
+        with self.condition:
+            self.epoch += 1
+            self.condition.notify_all()
+        for callback in self.listeners:
+            callback(None)
+
+    def wait(self, names, version, timeout):
+        if self.fd is None:
+            timeout = min(timeout, self.poll_interval)
+        with self.condition:
+            return self.condition.wait_for(lambda: self.get_version(names) != version, timeout)
+
+    def run(self):
+        if self.fd is None:
+            return
+        while True:
+            select.select([self.fd], [], [])
+            try:
+                data = os.read(self.fd, INOTIFY_BUFFER_SIZE)
+            except BlockingIOError:
+                continue
+            self.notify(set(parse_inotify_events(data)))
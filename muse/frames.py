@@ -0,0 +1,44 @@
+import json
+import struct
+from enum import Enum
+
+FRAME_HEADER = struct.Struct('>BI')
+
+
+class FrameType(Enum):
+    HEARTBEAT = 0
+    STDOUT = 1
+    STDERR = 2
+    STATUS = 3
+    RESULT = 4
+
+
+def encode_frame(frame_type, payload=b''):
+    return FRAME_HEADER.pack(frame_type.value, len(payload)) + payload
+
+
+def encode_json_frame(frame_type, obj):
+    return encode_frame(frame_type, json.dumps(obj).encode())
+
+
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        frames = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            frame_type, size = FRAME_HEADER.unpack_from(self.buffer)
+            if len(self.buffer) < FRAME_HEADER.size + size:
+                break
+            payload = bytes(self.buffer[FRAME_HEADER.size:FRAME_HEADER.size + size])
+            del self.buffer[:FRAME_HEADER.size + size]
+            frames.append((FrameType(frame_type), payload))
+        return frames
+
+
+def decode_frames(chunks):
+    decoder = FrameDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
@@ -0,0 +1,57 @@
+import time
+from threading import Thread, Lock
+
+from loguru import logger
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from muse.db import get_colle
+from muse.server_settings import LEASE_DURATION, LEASE_FLUSH_INTERVAL
+from muse.task import TaskStatus
+
+ALIVE_STATUSES = [TaskStatus.QUEUEING.name, TaskStatus.PREPARING.name, TaskStatus.RUNNING.name]
+
+
+def get_lease_expire_time(task, now=None):
+    return (now or time.time()) + task.get('lease_duration', LEASE_DURATION)
+
+
+class LeaseManager(Thread):
+    def __init__(self, flush_interval=LEASE_FLUSH_INTERVAL):
+        Thread.__init__(self)
+        self.daemon = True
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.lock = Lock()
+        self.started = False
+
+    def renew(self, task):
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.start()
+            expire_time = get_lease_expire_time(task)
+            if expire_time > self.pending.get(task['_id'], 0):
+                self.pending[task['_id']] = expire_time
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        requests = [
+            UpdateOne({'_id': task_id, 'status': {'$in': ALIVE_STATUSES}}, {'$max': {'lease_expire_time': expire_time}})
+            for task_id, expire_time in pending.items()]
+        try:
+            get_colle('tasks').bulk_write(requests, ordered=False)
+        except PyMongoError as e:
+            logger.warning(f'Failed to flush {len(requests)} lease(s): {e}')
+            with self.lock:
+                for task_id, expire_time in pending.items():
+                    if expire_time > self.pending.get(task_id, 0):
+                        self.pending[task_id] = expire_time
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
@@ -0,0 +1,165 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from muse.events import EventWatcher
+from muse.file_watcher import FileWatcher
+from muse.frames import FrameType, encode_frame, encode_json_frame
+from muse.server_settings import LOG_DIR
+from muse.task import TaskStatus
+
+LOG_CHUNK_SIZE = 64 * 1024
+LOG_STATUS_CHECK_INTERVAL = 5.0
+TASK_HEARTBEAT_INTERVAL = 2.0
+MAX_FINISHED_TASKS = 10000
+FETCH = object()
+
+
+class Wait:
+    def __init__(self, names, version, timeout):
+        self.names = names
+        self.version = version
+        self.timeout = timeout
+
+
+def is_finished_status(status):
+    return status is not None and TaskStatus[status] in (TaskStatus.COMPLETED, TaskStatus.FAILED)
+
+
+def get_task_summary(task):
+    summary = {key: value for key, value in task.items() if key not in ('_id', 'input_manifest')}
+    summary['_id'] = str(task['_id'])
+    return summary
+
+
+class LogStreamer:
+    def __init__(self, log_dir=LOG_DIR):
+        self.file_watcher = FileWatcher(log_dir)
+        self.finished_tasks = OrderedDict()
+        self.lock = Lock()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.file_watcher.start()
+        EventWatcher(self.on_task_event).start()
+
+    def on_task_event(self, event):
+        if event is None:
+            self.file_watcher.broadcast()
+            return
+        if is_finished_status(event['status']):
+            self.set_finished(event['task_id'])
+        self.file_watcher.notify([str(event['task_id'])])
+
+    def set_finished(self, task_id):
+        with self.lock:
+            self.finished_tasks[str(task_id)] = True
+            while len(self.finished_tasks) > MAX_FINISHED_TASKS:
+                self.finished_tasks.popitem(last=False)
+
+    def is_finished(self, task_id):
+        with self.lock:
+            return str(task_id) in self.finished_tasks
+
+    def stream(self, task_id, log_file_path, offset):
+        names = [os.path.basename(log_file_path), str(task_id)]
+        last_check_time = time.time()
+        self.file_watcher.watch(names)
+        try:
+            with open(log_file_path, 'rb') as log_file:
+                log_file.seek(offset)
+                while True:
+                    version = self.file_watcher.get_version(names)
+                    is_finished = self.is_finished(task_id)
+                    data = log_file.read(LOG_CHUNK_SIZE)
+                    if data:
+                        yield data
+                        continue
+                    if is_finished:
+                        break
+                    if time.time() - last_check_time > LOG_STATUS_CHECK_INTERVAL:
+                        status = yield FETCH
+                        if is_finished_status(status):
+                            self.set_finished(task_id)
+                            continue
+                        last_check_time = time.time()
+                    yield Wait(names, version, LOG_STATUS_CHECK_INTERVAL)
+        finally:
+            self.file_watcher.unwatch(names)
+
+    def stream_events(self, task_id, offsets):
+        task_name = str(task_id)
+        log_files = {}
+        names = [task_name]
+        self.file_watcher.watch(names)
+        try:
+            task = yield FETCH
+            last_task_version = self.file_watcher.get_version([task_name])
+            last_heartbeat_time = time.time()
+            last_status = None
+            while True:
+                version = self.file_watcher.get_version(names)
+
+                task_version = self.file_watcher.get_version([task_name])
+                heartbeat_due = time.time() - last_heartbeat_time > TASK_HEARTBEAT_INTERVAL
+                if task_version != last_task_version or heartbeat_due:
+                    task = yield FETCH
+                    last_task_version = task_version
+                if heartbeat_due:
+                    last_heartbeat_time = time.time()
+                    yield encode_frame(FrameType.HEARTBEAT)
+                if task['status'] != last_status:
+                    last_status = task['status']
+                    yield encode_json_frame(FrameType.STATUS, {'status': last_status})
+
+                for log in ('stdout', 'stderr'):
+                    if log not in log_files and task.get(log) and os.path.exists(task[log]):
+                        log_files[log] = open(task[log], 'rb')
+                        log_files[log].seek(offsets.get(log, 0))
+                        log_name = os.path.basename(task[log])
+                        self.file_watcher.watch([log_name])
+                        names.append(log_name)
+                        version = None
+
+                has_data = False
+                for frame_type, log in ((FrameType.STDOUT, 'stdout'), (FrameType.STDERR, 'stderr')):
+                    if log in log_files:
+                        data = log_files[log].read(LOG_CHUNK_SIZE)
+                        if data:
+                            has_data = True
+                            yield encode_frame(frame_type, data)
+                if has_data or version is None:
+                    continue
+
+                if is_finished_status(task['status']):
+                    yield encode_json_frame(FrameType.RESULT, get_task_summary(task))
+                    break
+
+                yield Wait(names, version, TASK_HEARTBEAT_INTERVAL)
+        finally:
+            self.file_watcher.unwatch(names)
+            for log_file in log_files.values():
+                log_file.close()
+
+    def run(self, steps, fetch):
+        value = None
+        try:
+            while True:
+                try:
+                    step = steps.send(value)
+                except StopIteration:
+                    return
+                value = None
+                if step is FETCH:
+                    value = fetch()
+                elif isinstance(step, Wait):
+                    self.file_watcher.wait(step.names, step.version, step.timeout)
+                else:
+                    yield step
+        finally:
+            steps.close()
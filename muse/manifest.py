@@ -0,0 +1,124 @@
+import hashlib
+import io
+import os
+import stat
+import tarfile
+import time
+
+HASH_CHUNK_SIZE = 1 << 20
+TAR_BUFFER_SIZE = 1 << 20
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def hash_file_chunks(path, chunk_size):
+    h = hashlib.sha256()
+    chunk_hashes = []
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+            chunk_hashes.append(hashlib.sha256(data).hexdigest())
+            size += len(data)
+    return size, h.hexdigest(), chunk_hashes
+
+
+def get_arcname(path):
+    parts = os.path.normpath(path).replace(os.sep, '/').split('/')
+    while parts and parts[0] in ('', '.', '..'):
+        parts.pop(0)
+    return '/'.join(parts)
+
+
+def iter_manifest(paths):
+    seen = set()
+
+    def file_entry(path):
+        st = os.stat(path)
+        return {
+            'path': get_arcname(path),
+            'type': 'file',
+            'hash': hash_file(path),
+            'size': st.st_size,
+            'mode': stat.S_IMODE(st.st_mode),
+            'mtime': int(st.st_mtime),
+        }
+
+    def dir_entry(path):
+        st = os.stat(path)
+        return {
+            'path': get_arcname(path),
+            'type': 'dir',
+            'mode': stat.S_IMODE(st.st_mode),
+            'mtime': int(st.st_mtime),
+        }
+
+    def visit(path, make_entry):
+        arcname = get_arcname(path)
+        if not arcname or arcname in seen:
+            return None
+        seen.add(arcname)
+        return make_entry(path), path
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                item = visit(root, dir_entry)
+                if item is not None:
+                    yield item
+                for name in sorted(files):
+                    item = visit(os.path.join(root, name), file_entry)
+                    if item is not None:
+                        yield item
+        else:
+            item = visit(path, file_entry)
+            if item is not None:
+                yield item
+
+
+def build_manifest(paths):
+    manifest = []
+    blob_sources = {}
+    for entry, path in iter_manifest(paths):
+        manifest.append(entry)
+        if entry['type'] == 'file':
+            blob_sources.setdefault(entry['hash'], path)
+    return manifest, blob_sources
+
+
+def get_manifest_hashes(manifest):
+    return sorted({entry['hash'] for entry in manifest if entry['type'] == 'file'})
+
+
+def write_manifest_tar(manifest, get_blob_path, fileobj, prefix='', extra_files=None):
+    with tarfile.open(fileobj=fileobj, mode='w|', bufsize=TAR_BUFFER_SIZE) as tar:
+        for name, data in (extra_files or {}).items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+        for entry in manifest:
+            info = tarfile.TarInfo(prefix + entry['path'])
+            info.mode = entry['mode']
+            info.mtime = entry['mtime']
+            if entry['type'] == 'dir':
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = entry['size']
+                with open(get_blob_path(entry['hash']), 'rb') as f:
+                    tar.addfile(info, f)
@@ -0,0 +1,83 @@
+import os
+import time
+
+import requests
+from loguru import logger
+
+from muse.db import get_colle
+from muse.server_settings import NODE_ID, NODE_TIMEOUT, NODE_URL, ORIGIN_URL
+
+NODES_COLLE_NAME = 'nodes'
+NODE_URL_TTL = 10.0
+FETCH_TIMEOUT = 60
+FETCH_CHUNK_SIZE = 1 << 20
+
+
+def is_local_node(node_id):
+    return node_id is None or node_id == NODE_ID
+
+
+def register_node(device_ids):
+    get_colle(NODES_COLLE_NAME).update_one(
+        {'_id': NODE_ID},
+        {'$set': {'url': NODE_URL, 'device_ids': sorted(device_ids), 'update_time': time.time()}},
+        upsert=True)
+
+
+def get_live_nodes(timeout=NODE_TIMEOUT):
+    nodes = get_colle(NODES_COLLE_NAME).find({'update_time': {'$gte': time.time() - timeout}})
+    return {node['_id']: node for node in nodes}
+
+
+def get_remote_device_ids(live_nodes):
+    device_ids = set()
+    for node_id, node in live_nodes.items():
+        if not is_local_node(node_id):
+            device_ids.update(node['device_ids'])
+    return device_ids
+
+
+class NodeDirectory:
+    def __init__(self, ttl=NODE_URL_TTL):
+        self.ttl = ttl
+        self.urls = {}
+        self.colle_nodes = get_colle(NODES_COLLE_NAME)
+
+    def get_url(self, node_id):
+        url, expire_time = self.urls.get(node_id, (None, 0))
+        if expire_time < time.time():
+            node = self.colle_nodes.find_one({'_id': node_id}, {'url': 1})
+            url = (node.get('url') or None) if node is not None else None
+            self.urls[node_id] = url, time.time() + self.ttl
+        return url
+
+
+def fetch_input_blobs(blob_store, blob_hashes, origin_url=ORIGIN_URL):
+    for blob_hash in blob_store.find_missing(blob_hashes):
+        try:
+            with requests.get(f'{origin_url}blob/{blob_hash}', stream=True, timeout=FETCH_TIMEOUT) as response:
+                if response.status_code != 200 or not blob_store.receive(blob_hash, response.raw.read):
+                    logger.error(f'Blob {blob_hash}: failed to fetch from {origin_url}: HTTP {response.status_code}')
+                    return False
+        except requests.RequestException as e:
+            logger.error(f'Blob {blob_hash}: failed to fetch from {origin_url}: {e}')
+            return False
+    return True
+
+
+def fetch_input_archive(task_id, path, origin_url=ORIGIN_URL):
+    tmp_path = f'{path}.part'
+    try:
+        with requests.get(f'{origin_url}task/input/{task_id}', stream=True, timeout=FETCH_TIMEOUT) as response:
+            if response.status_code != 200:
+                logger.error(f'Task {task_id}: failed to fetch input archive from {origin_url}: '
+                             f'HTTP {response.status_code}')
+                return False
+            with open(tmp_path, 'wb') as f:
+                for data in response.iter_content(FETCH_CHUNK_SIZE):
+                    f.write(data)
+        os.replace(tmp_path, path)
+        return True
+    except (requests.RequestException, OSError) as e:
+        logger.error(f'Task {task_id}: failed to fetch input archive from {origin_url}: {e}')
+        return False
@@ -1,26 +1,75 @@
 import os
 import time
-from threading import Thread
-from multiprocessing import Process, Event
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Event
 from pathlib import Path
 
 from loguru import logger
 from pymongo import ReturnDocument
 
-from muse.server_settings import LOG_DIR, INPUT_ARCHIVE_DIR, OUTPUT_ARCHIVE_DIR
-from muse.device_manager import DeviceManager
-from muse.task import TaskStatus, TaskFailReason
+from muse.server_settings import (
+    LOG_DIR, INPUT_ARCHIVE_DIR, OUTPUT_ARCHIVE_DIR, OUTPUT_CHUNK_SIZE, SCHEDULER_POLL_INTERVAL,
+    DEVICE_INFO_INTERVAL, DEVICE_INFO_WORKERS, TASK_WORKERS, MUSE_SERVER_HOST, SCHEDULER_METRICS_PORT, USER_WEIGHTS,
+    USER_MAX_TASKS, NODE_ID, NODE_DEVICE_GRACE, NODE_TIMEOUT, ORIGIN_URL)
+from muse.blob_store import BlobStore
+from muse.compression import SAMPLE_SIZE, available_codecs, measure_codecs
+from muse.device_cache import (
+    DeviceCache, DEVICE_MANIFEST_NAME, DEVICE_TREE_NAME, SYNC_SCRIPT_NAME, build_sync_script, format_device_manifest)
+from muse.device_manager import DeviceManager, DeviceWatcher
+from muse.fair_share import FairShareQueue, parse_user_values
+from muse.manifest import get_manifest_hashes, hash_file_chunks, write_manifest_tar
+from muse.metrics import Counter, Gauge, Histogram, start_metrics_server
+from muse.nodes import (
+    fetch_input_archive, fetch_input_blobs, get_live_nodes, get_remote_device_ids, is_local_node, register_node)
+from muse.selector import format_selector, match_device
+from muse.terminate import TerminateFlag
+from muse.trace import Tracer, make_span, span, traced
+from muse.trace_store import TraceStore, ensure_trace_indexes
+from muse.task import TaskPriority, TaskStatus, TaskFailReason
 from muse.db import get_colle
-
-
-class TaskProcess(Process):
-    def __init__(self, task, device_id):
-        Process.__init__(self)
-
+from muse.events import EventWatcher, init_event_log, publish_task_event
+from muse.lease import ALIVE_STATUSES, get_lease_expire_time
+
+QUEUE_WAIT_SECONDS = Histogram('muse_task_queue_wait_seconds', 'Time from inputs being ready to dispatch')
+STAGE_SECONDS = Histogram('muse_task_stage_seconds', 'Duration of task stages', ['stage', 'device'])
+DISPATCH_SECONDS = Histogram('muse_scheduler_dispatch_seconds', 'Duration of one dispatch pass over the queue')
+QUEUED_TASKS = Gauge('muse_scheduler_queued_tasks', 'Tasks with inputs ready waiting for a device')
+ACTIVE_TASKS = Gauge('muse_device_active_tasks', 'Tasks running on each device', ['device'])
+FINISHED_TASKS = Counter('muse_tasks_finished_total', 'Finished tasks by status', ['status', 'fail_reason'])
+
+# tasks read per priority and user in one pass, later ones wait until the head of the queue moves
+DISPATCH_SCAN_LIMIT = 1000
+DISPATCH_BATCH_SIZE = 16
+READY_FILTER = {'status': TaskStatus.QUEUEING.name, 'input_archive_ready': 1}
+QUEUED_TASK_FIELDS = [
+    'create_time', 'create_user', 'priority', 'hint_device_id', 'device_selector', 'input_ready_time', 'lease_duration']
+
+
+def update_task(colle_tasks, task_filter, update, **kwargs):
+    doc = colle_tasks.find_one_and_update(task_filter, update, **kwargs)
+    status = update.get('$set', {}).get('status')
+    if doc is not None and status is not None:
+        publish_task_event(task_filter['_id'], status)
+        if status in (TaskStatus.COMPLETED.name, TaskStatus.FAILED.name):
+            FINISHED_TASKS.inc(status=status, fail_reason=update['$set'].get('fail_reason', ''))
+    return doc
+
+
+class TaskRunner:
+    def __init__(self, task, device_id, device_manager, blob_store, device_cache, trace_store, get_pinned_blobs):
         self.task = task
         self.device_id = device_id
-        self.terminate_flag = Event()
-        self.device_manager = DeviceManager()
+        self.terminate_flag = TerminateFlag()
+        self.device_manager = device_manager
+        self.blob_store = blob_store
+        self.device_cache = device_cache
+        self.trace_store = trace_store
+        self.get_pinned_blobs = get_pinned_blobs
+        self.blob_hashes = set()
+        self.colle_tasks = get_colle('tasks')
+        self.colle_devices = get_colle('devices')
+        self.colle_manifests = get_colle('manifests')
+        self.future = None
 
     def get_task_id(self):
         return self.task['_id']
@@ -41,200 +90,555 @@ class TaskProcess(Process):
 
         return stdout_path, stderr_path
 
+    def push_cached_input(self, task, device_id, manifest):
+        task_id = task['_id']
+
+        device_digest = self.device_manager.prepare_cached_workspace(device_id, self.terminate_flag)
+        if device_digest is None:
+            return 1
+
+        reset, changed, stale_paths = self.device_cache.plan(device_id, device_digest, manifest)
+        changed_size = sum(entry['size'] for entry in changed if entry['type'] == 'file')
+        logger.info(
+            f'Task {task_id}: device cache has {len(manifest) - len(changed)}/{len(manifest)} entries'
+            f', pushing {len(changed)} entries of {changed_size} bytes, removing {len(stale_paths)} stale entries')
+
+        def write_delta(f):
+            write_manifest_tar(changed, self.blob_store.get_path, f, prefix=f'{DEVICE_TREE_NAME}/', extra_files={
+                f'{DEVICE_MANIFEST_NAME}.new': format_device_manifest(manifest),
+                SYNC_SCRIPT_NAME: build_sync_script(stale_paths),
+            })
+
+        self.blob_store.touch(get_manifest_hashes(changed))
+        return_code = self.device_manager.push_cached_data(device_id, write_delta, reset, self.terminate_flag)
+        if return_code:
+            self.device_cache.invalidate(device_id)
+        else:
+            self.device_cache.commit(device_id, manifest)
+        return return_code
+
+    def fetch_inputs(self, task, local_input_tar, manifest):
+        if manifest is not None:
+            if not fetch_input_blobs(self.blob_store, self.blob_hashes):
+                return False
+            self.blob_store.evict(pinned=self.get_pinned_blobs())
+            return True
+        if os.path.exists(local_input_tar):
+            return True
+        return fetch_input_archive(task['_id'], local_input_tar)
+
+    @traced('push_input')
+    def push_input(self, task, device_id, local_input_tar):
+        manifest = None
+        if 'input_manifest_id' in task:
+            manifest = self.colle_manifests.find_one({'_id': task['input_manifest_id']})['manifest']
+            self.blob_hashes = set(get_manifest_hashes(manifest))
+        if ORIGIN_URL:
+            with span('fetch_inputs'):
+                if not self.fetch_inputs(task, local_input_tar, manifest):
+                    return 1
+
+        if manifest is None:
+            return self.device_manager.push_data(device_id, local_input_tar, self.terminate_flag)
+
+        if self.device_cache.fits(manifest):
+            return self.push_cached_input(task, device_id, manifest)
+
+        if self.device_cache.has_mirror(device_id):
+            self.device_cache.invalidate(device_id)
+            self.device_manager.clear_cache(device_id, self.terminate_flag)
+        self.blob_store.touch(get_manifest_hashes(manifest))
+        return self.device_manager.push_archive(
+                device_id, lambda f: write_manifest_tar(manifest, self.blob_store.get_path, f), self.terminate_flag)
+
+    def read_output_sample(self, path):
+        with open(path, 'rb') as f:
+            return f.read(SAMPLE_SIZE)
+
     def run_task(self, task, device_id):
         task_id = task['_id']
         logger.info(f'Task {task_id}: preparing')
 
+        device_filter = {'key': 'device', 'device_id': device_id}
+        profile = self.colle_devices.find_one(device_filter, {'codecs': 1, 'link_speed': 1})
+        self.device_manager.load_transfer_profile(device_id, profile or {})
+
         stdout_path, stderr_path = self.prepare_log(task)
 
         push_data_failed = False
         local_input_tar = os.path.join(INPUT_ARCHIVE_DIR, f'{task_id}.tar')
         local_output_tar = os.path.join(OUTPUT_ARCHIVE_DIR, f'{task_id}.tar')
 
-        return_code = self.device_manager.push_data(device_id, local_input_tar, self.terminate_flag)
+        return_code = self.push_input(task, device_id, local_input_tar)
+        run_start_time = time.time()
+        STAGE_SECONDS.observe(run_start_time - task['start_time'], stage='push', device=device_id)
         if return_code:
             logger.error(f'Task {task_id}: push data failed')
             push_data_failed = True
 
         if push_data_failed:
-            self.colle_tasks.find_one_and_update(
+            update_task(
+                self.colle_tasks,
                 {'_id': task_id, 'status': TaskStatus.PREPARING.name},
                 {'$set': {
                     'status': TaskStatus.FAILED.name,
                     'fail_reason': TaskFailReason.PUSH_DATA_FAILED.name,
+                    'finish_time': run_start_time,
                 }})
             return
 
-        self.colle_tasks.find_one_and_update(
+        update_task(
+            self.colle_tasks,
             {'_id': task_id, 'status': TaskStatus.PREPARING.name},
             {'$set': {
                 'status': TaskStatus.RUNNING.name,
                 'stdout': stdout_path,
-                'stderr': stderr_path}})
+                'stderr': stderr_path,
+                'run_start_time': run_start_time}})
 
         logger.warning(f'Task {task_id}: running')
         command_return_code = self.device_manager.run_device_command(
                 device_id, stdout_path, stderr_path, task['cmd']['shell'], self.terminate_flag)
+        run_end_time = time.time()
+        STAGE_SECONDS.observe(run_end_time - run_start_time, stage='run', device=device_id)
         logger.info(f'Task {task_id}: command completed with return code {command_return_code}')
 
         pull_data_failed = False
         logger.info(f'Task {task_id}: pulling data from {local_output_tar}')
-        return_code = self.device_manager.pull_data(
-                device_id, task['output']['files'], local_output_tar, self.terminate_flag)
+        with span('pull_output'):
+            return_code = self.device_manager.pull_data(
+                    device_id, task['output']['files'], local_output_tar, self.terminate_flag)
+        pull_end_time = time.time()
+        STAGE_SECONDS.observe(pull_end_time - run_end_time, stage='pull', device=device_id)
+        stage_times = {'run_end_time': run_end_time, 'pull_end_time': pull_end_time}
         logger.info(f'Task {task_id}: pulled data from {local_output_tar} with return code {return_code}')
+        self.colle_devices.update_one(device_filter, {'$set': self.device_manager.get_transfer_profile(device_id)})
 
         if return_code:
             logger.error(f'Task {task_id}: pull data failed')
             pull_data_failed = True
 
         if pull_data_failed:
-            self.colle_tasks.find_one_and_update(
+            update_task(
+                self.colle_tasks,
                 {'_id': task_id, 'status': TaskStatus.RUNNING.name},
-                {'$set': {
-                    'status': TaskStatus.FAILED.name,
-                    'fail_reason': TaskFailReason.PULL_DATA_FAILED.name}})
+                {'$set': dict(
+                    stage_times,
+                    status=TaskStatus.FAILED.name,
+                    fail_reason=TaskFailReason.PULL_DATA_FAILED.name,
+                    finish_time=time.time())})
             return
 
+        with span('hash_output'):
+            output_size, output_sha256, output_chunks = hash_file_chunks(local_output_tar, OUTPUT_CHUNK_SIZE)
+            output_info = {
+                'output_size': output_size,
+                'output_sha256': output_sha256,
+                'output_chunk_size': OUTPUT_CHUNK_SIZE,
+                'output_chunks': output_chunks,
+                'output_codecs': measure_codecs(self.read_output_sample(local_output_tar), available_codecs()),
+            }
+        finish_time = time.time()
+        STAGE_SECONDS.observe(finish_time - pull_end_time, stage='finalize', device=device_id)
+
         if command_return_code == 0:
-            self.colle_tasks.find_one_and_update(
+            update_task(
+                self.colle_tasks,
                 {'_id': task_id, 'status': TaskStatus.RUNNING.name},
-                {'$set': {
-                    'status': TaskStatus.COMPLETED.name,
-                    'finish_time': time.time()}})
+                {'$set': dict(
+                    output_info,
+                    **stage_times,
+                    status=TaskStatus.COMPLETED.name,
+                    finish_time=finish_time)})
         else:
-            self.colle_tasks.find_one_and_update(
+            update_task(
+                self.colle_tasks,
                 {'_id': task_id, 'status': TaskStatus.RUNNING.name},
-                {'$set': {
-                    'status': TaskStatus.FAILED.name,
-                    'fail_reason': TaskFailReason.NONZERO_RETURN_CODE.name,
-                    'finish_time': time.time()}})
+                {'$set': dict(
+                    output_info,
+                    **stage_times,
+                    status=TaskStatus.FAILED.name,
+                    fail_reason=TaskFailReason.NONZERO_RETURN_CODE.name,
+                    finish_time=finish_time)})
 
         logger.warning(f'Task {task_id}: finished')
 
     def run(self):
-        self.colle_tasks = get_colle('tasks')
-
-        self.run_task(self.task, self.device_id)
+        task_id = self.task['_id']
+        tracer = Tracer('scheduler', sink=lambda task_span: self.trace_store.add(task_id, task_span))
+        try:
+            with tracer.activate():
+                self.run_task(self.task, self.device_id)
+        except Exception as e:
+            logger.exception(f'Task {task_id}: unexpected exception: {e}')
+            update_task(
+                self.colle_tasks,
+                {'_id': task_id, 'status': {'$in': [TaskStatus.PREPARING.name, TaskStatus.RUNNING.name]}},
+                {'$set': {
+                    'status': TaskStatus.FAILED.name,
+                    'fail_reason': TaskFailReason.INTERNAL_ERROR.name,
+                    'finish_time': time.time()}})
 
 
 class Scheduler:
     def __init__(self):
-        self.device_manager = DeviceManager()
+        self.device_watcher = DeviceWatcher(on_change=self.on_devices_changed)
+        self.device_manager = DeviceManager(device_watcher=self.device_watcher)
         self.colle_tasks = get_colle('tasks')
         self.colle_devices = get_colle('devices')
-        self.task_processes = []
+        self.blob_store = BlobStore()
+        self.device_cache = DeviceCache()
+        self.trace_store = TraceStore()
+        self.task_runners = {}
+        self.device_tasks = {}
+        self.wakeup = Event()
+        self.device_info_wakeup = Event()
+        self.task_executor = ThreadPoolExecutor(max_workers=TASK_WORKERS)
+        self.device_info_executor = ThreadPoolExecutor(max_workers=DEVICE_INFO_WORKERS)
+        self.device_hostnames = {}
+        self.device_models = {}
+        self.refreshing_devices = set()
+        self.device_info_lock = Lock()
+        self.user_weights = parse_user_values(USER_WEIGHTS, float)
+        self.user_max_tasks = parse_user_values(USER_MAX_TASKS, int)
+        self.queued_tasks_time = 0
+
+        self.colle_tasks.create_index([
+            ('status', 1), ('input_archive_ready', 1), ('priority', 1), ('create_user', 1), ('create_time', 1),
+            ('_id', 1)])
+        self.colle_tasks.create_index([('status', 1), ('input_archive_ready', 1), ('hint_device_id', 1)])
+        self.colle_tasks.create_index([('status', 1), ('input_archive_ready', 1), ('device_selector', 1)])
+        self.colle_tasks.create_index([('status', 1), ('queue_deadline', 1)])
+        self.colle_tasks.update_many(
+            {'status': TaskStatus.QUEUEING.name, 'priority': {'$exists': False}},
+            {'$set': {'priority': TaskPriority.NORMAL.value}})
+        self.colle_tasks.create_index([('status', 1), ('lease_expire_time', 1)])
+        self.colle_devices.create_index([('key', 1), ('device_id', 1)])
+        self.colle_devices.delete_many({'key': 'info'})
+        ensure_trace_indexes()
+        init_event_log()
+        self.load_busy_devices()
+
+    def on_devices_changed(self, device_ids):
+        self.wakeup.set()
+        self.device_info_wakeup.set()
 
     def loop(self):
+        self.device_watcher.start()
+
         update_device_info_thread = Thread(target=self.loop_update_device_info)
         update_device_info_thread.daemon = True
         update_device_info_thread.start()
 
+        event_watcher = EventWatcher(lambda event: self.wakeup.set())
+        event_watcher.start()
+
         while True:
+            self.wakeup.wait(SCHEDULER_POLL_INTERVAL)
+            self.wakeup.clear()
             try:
-                self.find_task_to_run()
-                self.find_task_to_kill()
                 self.clean_dead_task()
+                self.find_task_to_kill()
+                self.find_task_to_run()
             except Exception as e:
                 logger.exception(f'Unexpected exception: {e}')
-            time.sleep(0.1)
-
-    def find_task_to_run(self):
-        available_devices = self.device_manager.get_all_device_ids()
-        task = self.colle_tasks.find_one({'status': TaskStatus.QUEUEING.name, 'input_archive_ready': 1})
-        if task is None:
-            return False
-        task_id = task['_id']
 
-        selected_device = None
-        busy_devices = set()
+    def load_busy_devices(self):
+        local_devices = set(self.device_manager.get_all_device_ids())
         working_tasks = self.colle_tasks.find({
-            'status': {'$in': [TaskStatus.PREPARING.name, TaskStatus.RUNNING.name, TaskStatus.KILLING.name]}})
-        for exist_task in working_tasks:
-            if 'device_id' in exist_task:
-                busy_devices.add(exist_task['device_id'])
-        for device_candidate in available_devices:
-            if device_candidate not in busy_devices and task['hint_device_id'] == device_candidate:
-                selected_device = task['hint_device_id']
-
-        if selected_device is None:
-            logger.warning(f'Task {task_id}: device unavailable')
-            self.colle_tasks.find_one_and_update(
-                {'_id': task_id},
-                {'$set': {
-                    'status': TaskStatus.FAILED.name,
-                    'fail_reason': TaskFailReason.DEVICE_UNAVAILABLE.name,
-                    'finish_time': time.time()}})
-            return False
+            'status': {'$in': [TaskStatus.PREPARING.name, TaskStatus.RUNNING.name, TaskStatus.KILLING.name]},
+            'node_id': {'$in': [NODE_ID, None]}},
+            {'device_id': 1, 'status': 1, 'node_id': 1})
+        for task in working_tasks:
+            if task.get('node_id') is None and task.get('device_id') not in local_devices:
+                # started before tasks recorded their node, left to the node the device is attached to
+                continue
+            if 'device_id' in task:
+                self.device_tasks[task['device_id']] = task['_id']
+                ACTIVE_TASKS.set(1, device=task['device_id'])
+            if task['status'] != TaskStatus.KILLING.name:
+                # left over by a previous scheduler process, the kill handling releases its device
+                logger.warning(f'Task {task["_id"]}: runner is gone')
+                update_task(
+                    self.colle_tasks,
+                    {'_id': task['_id'], 'status': task['status']},
+                    {'$set': {'status': TaskStatus.KILLING.name, 'node_id': NODE_ID}})
+
+    def release_device(self, device_id, task_id):
+        if self.device_tasks.get(device_id) == task_id:
+            del self.device_tasks[device_id]
+            ACTIVE_TASKS.set(0, device=device_id)
 
-        task = self.colle_tasks.find_one_and_update(
-            {'_id': task_id},
+    def fail_queued_task(self, task_id, fail_reason):
+        update_task(
+            self.colle_tasks,
+            {'_id': task_id, 'status': TaskStatus.QUEUEING.name},
             {'$set': {
-                'status': TaskStatus.PREPARING.name,
-                'device_id': selected_device,
-                'start_time': time.time(),
-                'active_time': time.time(),
-            }}, return_document=ReturnDocument.AFTER)
+                'status': TaskStatus.FAILED.name,
+                'fail_reason': fail_reason.name,
+                'finish_time': time.time()}})
+
+    def get_matching_devices(self, selector, available_devices, device_infos, matching_devices):
+        key = format_selector(selector)
+        if key not in matching_devices:
+            matching_devices[key] = [
+                device_id for device_id in sorted(available_devices)
+                if device_id in device_infos and match_device(device_infos[device_id], selector)]
+        return matching_devices[key]
+
+    def get_candidate_devices(self, task, known_devices, available_devices, device_infos, matching_devices):
+        hint_device_id = task.get('hint_device_id')
+        if hint_device_id is not None:
+            return [hint_device_id] if hint_device_id in known_devices else None
+
+        devices = self.get_matching_devices(task['device_selector'], known_devices, device_infos, matching_devices)
+        if not devices and all(device_id in device_infos for device_id in available_devices):
+            return None
+        return devices
+
+    def get_active_tasks_per_user(self):
+        active_tasks = {}
+        for runner in self.task_runners.values():
+            user = runner.task.get('create_user')
+            active_tasks[user] = active_tasks.get(user, 0) + 1
+        remote_tasks = self.colle_tasks.aggregate([
+            {'$match': {
+                'status': {'$in': [TaskStatus.PREPARING.name, TaskStatus.RUNNING.name]},
+                'node_id': {'$nin': [NODE_ID, None]}}},
+            {'$group': {'_id': '$create_user', 'count': {'$sum': 1}}},
+        ])
+        for item in remote_tasks:
+            active_tasks[item['_id']] = active_tasks.get(item['_id'], 0) + item['count']
+        return active_tasks
+
+    def fail_expired_tasks(self, now):
+        expired_tasks = self.colle_tasks.find(
+            {'status': TaskStatus.QUEUEING.name, 'queue_deadline': {'$lt': now}}, {'queue_timeout': 1})
+        num_failed = 0
+        for task in expired_tasks:
+            logger.warning(f'Task {task["_id"]}: no device became free within {task["queue_timeout"]}s')
+            self.fail_queued_task(task['_id'], TaskFailReason.QUEUE_TIMEOUT)
+            num_failed += 1
+        return num_failed
+
+    def load_device_infos(self, device_infos):
+        if not device_infos:
+            device_infos.update(
+                (info['device_id'], info) for info in self.colle_devices.find({'key': 'device'}, {'_id': 0}))
+        return device_infos
+
+    def fail_unavailable_tasks(self, known_devices, available_devices, device_infos, matching_devices):
+        task_filters = [dict(READY_FILTER, hint_device_id={'$nin': sorted(known_devices) + [None]})]
+        selectors = self.colle_tasks.distinct('device_selector', dict(READY_FILTER, device_selector={'$ne': None}))
+        for selector in selectors:
+            self.load_device_infos(device_infos)
+            task = {'device_selector': selector}
+            candidates = self.get_candidate_devices(
+                    task, known_devices, available_devices, device_infos, matching_devices)
+            if candidates is None:
+                task_filters.append(dict(READY_FILTER, device_selector=selector))
+        for task in self.colle_tasks.find({'$or': task_filters}, {'_id': 1}):
+            logger.warning(f'Task {task["_id"]}: device unavailable')
+            self.fail_queued_task(task['_id'], TaskFailReason.DEVICE_UNAVAILABLE)
+
+    def open_queued_tasks(self, priority, user):
+        return self.colle_tasks.find(
+            dict(READY_FILTER, priority=priority, create_user=user),
+            QUEUED_TASK_FIELDS,
+        ).sort([('create_time', 1), ('_id', 1)]).limit(DISPATCH_SCAN_LIMIT).batch_size(DISPATCH_BATCH_SIZE)
+
+    def update_queued_tasks_gauge(self, now):
+        if now - self.queued_tasks_time > SCHEDULER_POLL_INTERVAL:
+            QUEUED_TASKS.set(self.colle_tasks.count_documents(READY_FILTER))
+            self.queued_tasks_time = now
+
+    def find_task_to_run(self):
+        start_time = time.time()
+        self.update_queued_tasks_gauge(start_time)
+        self.fail_expired_tasks(start_time)
+        available_devices = set(self.device_manager.get_all_device_ids())
+        # devices of a node that stopped reporting stay known for a while, so a restart does not fail their queue
+        known_devices = available_devices | get_remote_device_ids(get_live_nodes(NODE_TIMEOUT + NODE_DEVICE_GRACE))
+        device_infos = {}
+        matching_devices = {}
+        self.fail_unavailable_tasks(known_devices, available_devices, device_infos, matching_devices)
+
+        free_devices = available_devices - set(self.device_tasks)
+        if not free_devices or len(self.task_runners) >= TASK_WORKERS:
+            return 0
+
+        queue = FairShareQueue(self.user_weights, self.user_max_tasks, self.get_active_tasks_per_user())
+        cursors = []
+        for priority in self.colle_tasks.distinct('priority', READY_FILTER):
+            for user in self.colle_tasks.distinct('create_user', dict(READY_FILTER, priority=priority)):
+                cursors.append(self.open_queued_tasks(priority, user))
+                queue.add(priority, user, cursors[-1])
+
+        def get_devices(task):
+            if task.get('device_selector') is not None:
+                self.load_device_infos(device_infos)
+            return self.get_candidate_devices(task, known_devices, available_devices, device_infos, matching_devices)
+
+        try:
+            num_dispatched = self.dispatch_tasks(queue, free_devices, get_devices, start_time)
+        finally:
+            for cursor in cursors:
+                cursor.close()
+        DISPATCH_SECONDS.observe(time.time() - start_time)
+        logger.info(f'Dispatched {num_dispatched} task(s) from {len(cursors)} user queue(s)')
+        return num_dispatched
+
+    def dispatch_tasks(self, queue, free_devices, get_devices, start_time):
+        num_dispatched = 0
+        for task, selected_device in queue.iter_dispatch(free_devices, get_devices):
+            if len(self.task_runners) >= TASK_WORKERS:
+                logger.info(f'All {TASK_WORKERS} task workers are busy')
+                break
+            task_id = task['_id']
+            task = update_task(
+                self.colle_tasks,
+                {'_id': task_id, 'status': TaskStatus.QUEUEING.name},
+                {'$set': {
+                    'status': TaskStatus.PREPARING.name,
+                    'device_id': selected_device,
+                    'node_id': NODE_ID,
+                    'start_time': time.time(),
+                    'lease_expire_time': get_lease_expire_time(task),
+                }}, return_document=ReturnDocument.AFTER)
+            if task is None:
+                continue
 
-        if task:
             logger.warning(f'Task {task_id}: assigned to device {selected_device}')
-            p = TaskProcess(task, selected_device)
-            p.start()
-            self.task_processes.append(p)
-            return True
-        return False
+            QUEUE_WAIT_SECONDS.observe(task['start_time'] - task.get('input_ready_time', task['create_time']))
+            self.trace_store.add(task_id, make_span(
+                    'assign', 'scheduler', start_time, task['start_time'], attrs={'device': selected_device}))
+            self.device_tasks[selected_device] = task_id
+            ACTIVE_TASKS.set(1, device=selected_device)
+            free_devices.discard(selected_device)
+            runner = TaskRunner(
+                    task, selected_device, self.device_manager, self.blob_store, self.device_cache, self.trace_store,
+                    self.get_pinned_blobs)
+            self.task_runners[task_id] = runner
+            runner.future = self.task_executor.submit(runner.run)
+            runner.future.add_done_callback(lambda future: self.wakeup.set())
+            num_dispatched += 1
+        return num_dispatched
 
     def find_task_to_kill(self):
         now = time.time()
 
-        alive_tasks = self.colle_tasks.find({
-            'status': {'$in': [TaskStatus.QUEUEING.name, TaskStatus.PREPARING.name, TaskStatus.RUNNING.name]}})
-        for task in alive_tasks:
-            if now - task['active_time'] > 10.0:
-                self.colle_tasks.find_one_and_update(
-                    {'_id': task['_id'], 'status': task['status']},
-                    {'$set': {'status': TaskStatus.KILLING.name}})
+        expired_tasks = self.colle_tasks.find(
+            {'status': {'$in': ALIVE_STATUSES}, 'lease_expire_time': {'$lt': now}},
+            {'status': 1})
+        for task in expired_tasks:
+            logger.warning(f'Task {task["_id"]}: lease expired')
+            update_task(
+                self.colle_tasks,
+                {'_id': task['_id'], 'status': task['status'], 'lease_expire_time': {'$lt': now}},
+                {'$set': {'status': TaskStatus.KILLING.name}})
+
+        live_nodes = get_live_nodes()
+        orphaned_tasks = self.colle_tasks.find(
+            {'status': {'$in': [TaskStatus.PREPARING.name, TaskStatus.RUNNING.name]},
+             'node_id': {'$nin': list(live_nodes) + [NODE_ID, None]}},
+            {'status': 1, 'node_id': 1})
+        for task in orphaned_tasks:
+            logger.warning(f'Task {task["_id"]}: node {task["node_id"]} is gone')
+            update_task(
+                self.colle_tasks,
+                {'_id': task['_id'], 'status': task['status']},
+                {'$set': {'status': TaskStatus.KILLING.name}})
 
         for task in self.colle_tasks.find({'status': TaskStatus.KILLING.name}):
             task_id = task['_id']
-            logger.warning(f'Task {task_id}: is being killed')
-            for p in self.task_processes:
-                if p.get_task_id() == task_id:
-                    p.terminate_flag.set()
-                    p.join()
-
-            self.colle_tasks.find_one_and_update(
-                {'_id': task_id},
-                {'$set': {'status': TaskStatus.FAILED.name, 'fail_reason': TaskFailReason.KILLED.name}})
+            if not is_local_node(task.get('node_id')) and task['node_id'] in live_nodes:
+                continue
+            runner = self.task_runners.get(task_id)
+            if runner is not None:
+                if not runner.terminate_flag.is_set():
+                    logger.warning(f'Task {task_id}: is being killed')
+                    runner.terminate_flag.set()
+                if not runner.future.cancel() and not runner.future.done():
+                    continue
+                self.task_runners.pop(task_id, None)
+            if 'device_id' in task:
+                self.release_device(task['device_id'], task_id)
+
+            update_task(
+                self.colle_tasks,
+                {'_id': task_id, 'status': TaskStatus.KILLING.name},
+                {'$set': {
+                    'status': TaskStatus.FAILED.name,
+                    'fail_reason': TaskFailReason.KILLED.name,
+                    'finish_time': time.time()}})
             logger.warning(f'Task {task_id}: is killed')
 
+    def get_pinned_blobs(self):
+        pinned = set()
+        for runner in list(self.task_runners.values()):
+            pinned.update(runner.blob_hashes)
+        return pinned
+
     def clean_dead_task(self):
-        alive_processes = []
-        for p in self.task_processes:
-            if p.is_alive():
-                alive_processes.append(p)
-            else:
-                p.join()
-        self.task_processes = alive_processes
+        for task_id, runner in list(self.task_runners.items()):
+            if runner.future.done():
+                del self.task_runners[task_id]
+                self.release_device(runner.get_device_id(), task_id)
 
     def loop_update_device_info(self):
         while True:
-            self.update_device_info()
-            time.sleep(30)
+            try:
+                self.update_device_info()
+            except Exception as e:
+                logger.exception(f'Unexpected exception: {e}')
+            self.device_info_wakeup.wait(DEVICE_INFO_INTERVAL)
+            self.device_info_wakeup.clear()
+
+    def refresh_device_info(self, device_id):
+        try:
+            device_info = self.device_manager.get_device_info(
+                    device_id, hostname=self.device_hostnames.get(device_id), model=self.device_models.get(device_id))
+            if device_info['hostname'] is not None:
+                self.device_hostnames[device_id] = device_info['hostname']
+            if device_info['model'] is not None:
+                self.device_models[device_id] = device_info['model']
+            self.colle_devices.update_one(
+                {'key': 'device', 'device_id': device_id},
+                {'$set': dict(device_info, node_id=NODE_ID, update_time=time.time())}, upsert=True)
+        except Exception as e:
+            logger.exception(f'Device {device_id}: failed to update device info: {e}')
+        finally:
+            with self.device_info_lock:
+                self.refreshing_devices.discard(device_id)
 
     def update_device_info(self):
         device_ids = self.device_manager.get_all_device_ids()
-        device_infos = []
+
+        for device_values in (self.device_hostnames, self.device_models):
+            for device_id in list(device_values):
+                if device_id not in device_ids:
+                    del device_values[device_id]
+        self.colle_devices.delete_many(
+                {'key': 'device', 'node_id': {'$in': [NODE_ID, None]}, 'device_id': {'$nin': list(device_ids)}})
+        register_node(device_ids)
+        known_nodes = list(get_live_nodes(NODE_TIMEOUT + NODE_DEVICE_GRACE))
+        self.colle_devices.delete_many({'key': 'device', 'node_id': {'$nin': known_nodes + [NODE_ID, None]}})
+
+        num_submitted = 0
         for device_id in device_ids:
-            device_infos.append(self.device_manager.get_device_info(device_id))
+            with self.device_info_lock:
+                if device_id in self.refreshing_devices:
+                    continue
+                self.refreshing_devices.add(device_id)
+            self.device_info_executor.submit(self.refresh_device_info, device_id)
+            num_submitted += 1
 
-        num_devices = len(device_infos)
-        logger.info(f'Update device info, found {num_devices} devices')
-        self.colle_devices.update_one(
-            {'key': 'info'},
-            {'$set': {'device_infos': device_infos, 'update_time': time.time()}}, upsert=True)
+        logger.info(f'Update device info, found {len(device_ids)} devices, refreshing {num_submitted}')
 
 
 def run_scheduler():
+    if SCHEDULER_METRICS_PORT:
+        start_metrics_server(MUSE_SERVER_HOST, SCHEDULER_METRICS_PORT)
     scheduler = Scheduler()
     scheduler.loop()
 
@@ -0,0 +1,34 @@
+from fnmatch import fnmatchcase
+
+SELECTOR_KEYS = ('device_id', 'model', 'hostname', 'label')
+
+
+def parse_selector(terms):
+    selector = {}
+    for term in terms:
+        key, sep, pattern = term.partition('=')
+        if not sep or key not in SELECTOR_KEYS:
+            raise ValueError(f'Invalid device selector {term!r}, expected one of {", ".join(SELECTOR_KEYS)}=PATTERN')
+        selector[key] = pattern
+    return selector
+
+
+def is_valid_selector(selector):
+    return (
+        isinstance(selector, dict) and bool(selector)
+        and all(key in SELECTOR_KEYS and isinstance(pattern, str) for key, pattern in selector.items()))
+
+
+def match_device(device_info, selector):
+    for key, pattern in selector.items():
+        if key == 'label':
+            values = device_info.get('labels') or []
+        else:
+            values = [device_info.get(key)]
+        if not any(value is not None and fnmatchcase(value, pattern) for value in values):
+            return False
+    return True
+
+
+def format_selector(selector):
+    return ','.join(f'{key}={pattern}' for key, pattern in sorted(selector.items()))
@@ -1,152 +1,244 @@
 import time
-import os
 
-from loguru import logger
-from bson import ObjectId
-from flask import Flask, request, jsonify, Response, send_file
+import requests
+from flask import Flask, g, redirect, request, jsonify, Response, send_file, stream_with_context
 from flask_cors import CORS
+from loguru import logger
 
-from muse.db import get_colle
-from muse.server_settings import INPUT_ARCHIVE_DIR, OUTPUT_ARCHIVE_DIR, MUSE_SERVER_HOST, MUSE_SERVER_PORT
-from muse.task import TaskStatus
+from muse.blob_store import is_valid_hash
+from muse.compression import ENCODING_HEADER, get_codec
+from muse.metrics import CONTENT_TYPE
+from muse.server_settings import MUSE_SERVER_HOST, MUSE_SERVER_PORT, NODE_FORWARD_MODE, SERVER_DEBUG, SERVER_MODE
+from muse.service import MuseService
 
 app = Flask(__name__)
 CORS(app)
+service = MuseService()
+
+NODE_ROUTES = {
+    '/task/log/<string:_id>/<string:log>',
+    '/task/events/<string:_id>',
+    '/task/download/<string:_id>',
+    '/task/output/<string:_id>/<int:index>',
+}
+FORWARD_HEADERS = ('Content-Type', 'Content-Length', ENCODING_HEADER)
+FORWARD_CHUNK_SIZE = 1 << 16
+
+
+@app.before_request
+def start_timer():
+    g.start_time = time.time()
+
+
+@app.before_request
+def forward_to_node():
+    if request.url_rule is None or request.url_rule.rule not in NODE_ROUTES:
+        return None
+    node_url = service.get_node_url(request.view_args['_id'])
+    if node_url is None:
+        return None
+    url = node_url + request.full_path.rstrip('?').lstrip('/')
+    if NODE_FORWARD_MODE == 'redirect':
+        return redirect(url, code=307)
+    headers = {key: value for key, value in request.headers.items() if key in (ENCODING_HEADER, 'Range')}
+    try:
+        upstream = requests.get(url, headers=headers, stream=True)
+    except requests.RequestException as e:
+        logger.error(f'Failed to proxy {url}: {e}')
+        return '', 502
+    return Response(
+            stream_with_context(upstream.iter_content(FORWARD_CHUNK_SIZE)), status=upstream.status_code,
+            headers={key: upstream.headers[key] for key in FORWARD_HEADERS if key in upstream.headers})
+
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    service.record_request(
+            request.method, route, response.status_code, g.start_time, (request.view_args or {}).get('_id'))
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(service.get_metrics(), content_type=CONTENT_TYPE)
 
 
 @app.route('/device/list', methods=['GET'])
 def list_devices():
-    colle_devices = get_colle('devices')
-
-    info = colle_devices.find_one({'key': 'info'})
-    if info is None:
-        device_infos = []
-        update_time = 0
-    else:
-        device_infos = info['device_infos']
-        update_time = info['update_time']
-    return jsonify({'device_infos': device_infos, 'update_time': update_time})
+    return jsonify(service.list_devices())
 
 
 @app.route('/task/create', methods=['POST'])
 def create_task():
-    colle_tasks = get_colle('tasks')
-    j = request.json
-    result = colle_tasks.insert_one({
-        'status': TaskStatus.QUEUEING.name,
-        'cmd': {
-            'shell': j['cmd']['shell'],
-        },
-        'output': {
-            'files': j['output']['files'],
-        },
-        'hint_device_id': j['hint_device_id'],
-        'create_user': j['create_user'],
-        'create_time': time.time(),
-        'active_time': time.time(),
-    })
-    return jsonify({'_id': str(result.inserted_id)})
+    body, status = service.create_task(request.json)
+    return (jsonify(body) if body else body), status
+
+
+@app.route('/task/create_batch', methods=['POST'])
+def create_tasks():
+    body, status = service.create_tasks(request.json)
+    return (jsonify(body) if body else body), status
 
 
 @app.route('/task/upload/<string:_id>', methods=['POST'])
 def upload_input_archive(_id):
-    colle_tasks = get_colle('tasks')
     f = request.files['file']
-    f.save(os.path.join(INPUT_ARCHIVE_DIR, f'{_id}.tar'))
-    colle_tasks.find_one_and_update(
-        {'_id': ObjectId(_id)},
-        {'$set': {'input_archive_ready': 1}})
+    f.save(service.get_input_archive_path(_id))
+    service.set_input_archive_ready(_id)
     return '', 200
 
 
+@app.route('/blob/missing', methods=['POST'])
+def find_missing_blobs():
+    result = service.find_missing_blobs(request.json['hashes'])
+    if result is None:
+        return '', 400
+    return jsonify(result)
+
+
+@app.route('/blob/upload/<string:blob_hash>', methods=['POST'])
+def upload_blob(blob_hash):
+    if not is_valid_hash(blob_hash):
+        return '', 400
+    encoding = request.headers.get(ENCODING_HEADER)
+    if encoding is not None and get_codec(encoding) is None:
+        return '', 415
+    if not service.blob_store.receive(blob_hash, request.stream.read, encoding):
+        return '', 400
+    return '', 200
+
+
+@app.route('/blob/chunked/<string:blob_hash>', methods=['POST'])
+def start_chunked_blob(blob_hash):
+    body, status = service.start_chunked_blob(blob_hash, request.json)
+    return (jsonify(body) if body else body), status
+
+
+@app.route('/blob/chunked/<string:blob_hash>/<int:index>', methods=['PUT'])
+def upload_blob_chunk(blob_hash, index):
+    status = service.upload_blob_chunk(
+            blob_hash, index, request.get_data(), request.headers.get('X-Chunk-Sha256'),
+            request.headers.get(ENCODING_HEADER))
+    return '', status
+
+
+@app.route('/blob/chunked/<string:blob_hash>/commit', methods=['POST'])
+def commit_chunked_blob(blob_hash):
+    body, status = service.commit_chunked_blob(blob_hash)
+    return (jsonify(body) if body else body), status
+
+
+@app.route('/blob/<string:blob_hash>', methods=['GET'])
+def download_blob(blob_hash):
+    path = service.find_blob(blob_hash)
+    if path is None:
+        return '', 404
+    return send_file(path, mimetype='application/octet-stream')
+
+
+@app.route('/task/input/<string:_id>', methods=['GET'])
+def download_input_archive(_id):
+    path = service.find_input_archive(_id)
+    if path is None:
+        return '', 404
+    return send_file(path, mimetype='application/x-tar')
+
+
+@app.route('/task/input/<string:_id>', methods=['POST'])
+def set_input_manifest(_id):
+    body, status = service.set_input_manifest(_id, request.json['manifest'])
+    return (jsonify(body) if body else body), status
+
+
 @app.route('/task/download/<string:_id>', methods=['GET'])
 def download_output_archive(_id):
-    return send_file(os.path.join(OUTPUT_ARCHIVE_DIR, f'{_id}.tar'), as_attachment=True)
+    return send_file(service.get_output_archive_path(_id), as_attachment=True, conditional=True)
+
+
+@app.route('/task/output/<string:_id>', methods=['GET'])
+def get_output_info(_id):
+    output_info = service.get_output_info(_id)
+    if output_info is None:
+        return '', 404
+    return jsonify(output_info)
+
+
+@app.route('/task/output/<string:_id>/<int:index>', methods=['GET'])
+def download_output_chunk(_id, index):
+    data, encoding = service.read_output_chunk(_id, index, request.headers.get(ENCODING_HEADER))
+    if data is None:
+        return '', 404
+    response = Response(data, mimetype='application/octet-stream')
+    if encoding is not None:
+        response.headers[ENCODING_HEADER] = encoding
+    return response
 
 
 @app.route('/task/query/<string:_id>', methods=['GET'])
 def query_task(_id):
-    colle_tasks = get_colle('tasks')
-    d = colle_tasks.find_one_and_update(
-        {'_id': ObjectId(_id)},
-        {'$set': {'active_time': time.time()}})
-    d['_id'] = str(d['_id'])
-    return jsonify(d)
+    return jsonify(service.query_task(_id))
+
+
+@app.route('/task/query_batch', methods=['POST'])
+def query_tasks():
+    return jsonify(service.query_tasks(request.json['_ids']))
 
 
 @app.route('/task/log/<string:_id>/<string:log>', methods=['GET'])
 def stream_task_log(_id, log):
-    assert log in ('stdout', 'stderr')
-    colle_tasks = get_colle('tasks')
-    task_log = colle_tasks.find_one(
-        {'_id': ObjectId(_id)},
-        {'stderr': 1, 'stdout': 1})
-    if task_log is None or log not in task_log:
-        log_file_path = None
-    else:
-        log_file_path = task_log[log]
-    logger.info(f'{log}: {log_file_path}')
+    offset = request.args.get('offset', 0, type=int)
+    log_file_path, steps, fetch = service.open_task_log(_id, log, offset)
+    if log_file_path is None:
+        return Response(b'', mimetype='text/plain')
+    if steps is None:
+        return send_file(log_file_path, mimetype='text/plain', conditional=True)
+    return Response(service.log_streamer.run(steps, fetch), mimetype='text/plain')
+
 
-    def get_log():
-        if log_file_path is None or not os.path.exists(log_file_path):
-            return
+@app.route('/task/events/<string:_id>', methods=['GET'])
+def stream_task_events(_id):
+    offsets = {
+        'stdout': request.args.get('stdout', 0, type=int),
+        'stderr': request.args.get('stderr', 0, type=int),
+    }
+    steps, fetch = service.open_task_events(_id, offsets)
+    if steps is None:
+        return '', 404
+    return Response(service.log_streamer.run(steps, fetch), mimetype='application/octet-stream')
 
-        last_check_time = 0
 
-        with open(log_file_path, 'r') as log_file:
-            is_finished = False
-            os.set_blocking(log_file.fileno(), False)
-            while True:
-                data = log_file.read(4096)
-                if len(data):
-                    yield data
-                else:
-                    if is_finished:
-                        break
-                    if time.time() - last_check_time > 0.1:
-                        d = colle_tasks.find_one({'_id': ObjectId(_id)}, {'status': 1})
-                        if TaskStatus[d['status']] in (TaskStatus.COMPLETED, TaskStatus.FAILED):
-                            is_finished = True
-                        last_check_time = time.time()
+@app.route('/task/trace/<string:_id>', methods=['GET'])
+def get_trace(_id):
+    trace = service.get_trace(_id)
+    if trace is None:
+        return '', 404
+    return jsonify(trace)
 
-                    time.sleep(0.001)
 
-    return Response(get_log(), mimetype='text/plain')
+@app.route('/task/trace/<string:_id>', methods=['POST'])
+def add_trace_spans(_id):
+    return '', service.add_trace_spans(_id, request.json.get('spans'))
 
 
 @app.route('/task/list', methods=['GET'])
 def list_tasks():
-    colle_tasks = get_colle('tasks')
-    doc = colle_tasks.find({'status': {
-        '$in': [
-            TaskStatus.QUEUEING.name, TaskStatus.PREPARING.name,
-            TaskStatus.RUNNING.name, TaskStatus.KILLING.name
-        ]
-    }})
-
-    tasks = []
-    for task in doc:
-        t = {key: value for key, value in task.items() if key != '_id'}
-        tasks.append(t)
-
-    return jsonify({'tasks': tasks})
+    return jsonify(service.list_tasks())
 
 
 @app.route('/task/kill/<string:_id>', methods=['DELETE'])
 def kill_task(_id):
-    colle_tasks = get_colle('tasks')
-    doc = colle_tasks.find_one_and_update(
-          {'_id': ObjectId(_id), 'status': {
-              '$in': [TaskStatus.QUEUEING.name, TaskStatus.PREPARING.name, TaskStatus.RUNNING.name]}},
-          {'$set': {'status': TaskStatus.KILLING.name}})
-    if doc:
+    if service.kill_task(_id):
         return '', 204
     else:
         return '', 409
 
 
 def run_server():
-    app.run(host=MUSE_SERVER_HOST, port=MUSE_SERVER_PORT, debug=True)
+    if SERVER_MODE == 'aiohttp':
+        from muse.aio_server import run_server as run_aio_server
+        return run_aio_server()
+    app.run(host=MUSE_SERVER_HOST, port=MUSE_SERVER_PORT, debug=SERVER_DEBUG)
 
 
 if __name__ == '__main__':
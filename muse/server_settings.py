@@ -1,16 +1,55 @@
 import os
+import socket
 
 
 MONGODB_URI = os.getenv('MUSE_MONGODB_URI', 'mongodb://127.0.0.1:27017')
 
 MUSE_SERVER_HOST = os.getenv('MUSE_SERVER_HOST', '0.0.0.0')
 MUSE_SERVER_PORT = int(os.getenv('MUSE_SERVER_PORT', 10813))
+SERVER_MODE = os.getenv('MUSE_SERVER_MODE', 'flask')
+SERVER_DEBUG = os.getenv('MUSE_SERVER_DEBUG', '0') == '1'
+
+ADB_BACKEND = os.getenv('MUSE_ADB_BACKEND', 'cli')
+ADB_SERVER_HOST = os.getenv('MUSE_ADB_SERVER_HOST', '127.0.0.1')
+ADB_SERVER_PORT = int(os.getenv('ANDROID_ADB_SERVER_PORT', 5037))
+
+SCHEDULER_POLL_INTERVAL = float(os.getenv('MUSE_SCHEDULER_POLL_INTERVAL', 5.0))
+DEVICE_INFO_INTERVAL = float(os.getenv('MUSE_DEVICE_INFO_INTERVAL', 30.0))
+DEVICE_INFO_TIMEOUT = float(os.getenv('MUSE_DEVICE_INFO_TIMEOUT', 15.0))
+DEVICE_LABELS_PROP = os.getenv('MUSE_DEVICE_LABELS_PROP', 'persist.muse.labels')
+DEVICE_INFO_WORKERS = int(os.getenv('MUSE_DEVICE_INFO_WORKERS', 16))
+TASK_WORKERS = int(os.getenv('MUSE_SCHEDULER_TASK_WORKERS', 32))
+USER_WEIGHTS = os.getenv('MUSE_SCHEDULER_USER_WEIGHTS', '')
+USER_MAX_TASKS = os.getenv('MUSE_SCHEDULER_USER_MAX_TASKS', '')
+SCHEDULER_METRICS_PORT = int(os.getenv('MUSE_SCHEDULER_METRICS_PORT', 10814))
+LEASE_DURATION = float(os.getenv('MUSE_LEASE_DURATION', 10.0))
+LEASE_FLUSH_INTERVAL = float(os.getenv('MUSE_LEASE_FLUSH_INTERVAL', 1.0))
+TRACE_FLUSH_INTERVAL = float(os.getenv('MUSE_TRACE_FLUSH_INTERVAL', 1.0))
+TRACE_TTL = float(os.getenv('MUSE_TRACE_TTL', 7 * 24 * 3600))
+EVENT_LOG_SIZE = int(os.getenv('MUSE_EVENT_LOG_SIZE', 16 * 1024 ** 2))
+
+NODE_ID = os.getenv('MUSE_NODE_ID', socket.gethostname())
+NODE_URL = os.getenv('MUSE_NODE_URL', '')
+NODE_TIMEOUT = float(os.getenv('MUSE_NODE_TIMEOUT', 3 * DEVICE_INFO_INTERVAL))
+NODE_DEVICE_GRACE = float(os.getenv('MUSE_NODE_DEVICE_GRACE', 600))
+NODE_FORWARD_MODE = os.getenv('MUSE_NODE_FORWARD_MODE', 'redirect')
+ORIGIN_URL = os.getenv('MUSE_ORIGIN_URL', '')
 
 CACHE_DIR = os.getenv('MUSE_SERVER_CACHE_DIR', os.path.expanduser('~/.cache/muse_server'))
 INPUT_ARCHIVE_DIR = os.path.join(CACHE_DIR, 'input_archive')
 OUTPUT_ARCHIVE_DIR = os.path.join(CACHE_DIR, 'output_archive')
 LOG_DIR = os.path.join(CACHE_DIR, 'log')
+BLOB_DIR = os.path.join(CACHE_DIR, 'blob')
+BLOB_CACHE_SIZE = int(os.getenv('MUSE_SERVER_BLOB_CACHE_SIZE', 20 * 1024 ** 3))
+PARTIAL_BLOB_TTL = float(os.getenv('MUSE_SERVER_PARTIAL_BLOB_TTL', 24 * 3600))
+OUTPUT_CHUNK_SIZE = int(os.getenv('MUSE_OUTPUT_CHUNK_SIZE', 8 * 1024 ** 2))
 DEVICE_WORKSPACE = os.getenv('MUSE_DEVICE_WORKSPACE', '/data/local/tmp/muse')
+DEVICE_CACHE_DIR = os.getenv('MUSE_DEVICE_CACHE_DIR', '/data/local/tmp/muse_cache')
+DEVICE_TRANSFER_MODE = os.getenv('MUSE_DEVICE_TRANSFER_MODE', 'push')
+DEVICE_PUSH_COMPRESSION = os.getenv('MUSE_DEVICE_PUSH_COMPRESSION', '')
+DEVICE_PULL_COMPRESSION = os.getenv('MUSE_DEVICE_PULL_COMPRESSION', '')
+DEVICE_LINK_SPEED = float(os.getenv('MUSE_DEVICE_LINK_SPEED', 20 * 1024 ** 2))
+DEVICE_CACHE_SIZE = int(os.getenv('MUSE_DEVICE_CACHE_SIZE', 4 * 1024 ** 3))
 
-for d in (INPUT_ARCHIVE_DIR, OUTPUT_ARCHIVE_DIR, LOG_DIR):
+for d in (INPUT_ARCHIVE_DIR, OUTPUT_ARCHIVE_DIR, LOG_DIR, BLOB_DIR):
     os.makedirs(d, exist_ok=True)
@@ -0,0 +1,368 @@
+import hashlib
+import json
+import math
+import os
+import time
+
+from bson import ObjectId
+from loguru import logger
+
+from muse.blob_store import BlobStore, MAX_UPLOAD_CHUNK_SIZE, is_valid_hash
+from muse.compression import DECOMPRESS_ERRORS, available_codecs, decompress, get_codec
+from muse.db import get_colle
+from muse.events import init_event_log, publish_task_event, publish_task_events
+from muse.lease import ALIVE_STATUSES, LeaseManager
+from muse.log_stream import LogStreamer, is_finished_status
+from muse.manifest import get_manifest_hashes
+from muse.metrics import Gauge, Histogram, expose_metrics
+from muse.nodes import NodeDirectory, is_local_node
+from muse.selector import is_valid_selector
+from muse.server_settings import INPUT_ARCHIVE_DIR, OUTPUT_ARCHIVE_DIR, LEASE_DURATION
+from muse.task import TaskPriority, TaskStatus
+from muse.trace import get_stage_spans, make_span
+from muse.trace_store import TraceStore, load_trace
+
+MANIFEST_TTL = 24 * 3600
+UNTRACED_ROUTE_PREFIXES = ('/task/events/', '/task/log/', '/task/query/', '/task/trace/')
+
+HTTP_REQUEST_SECONDS = Histogram(
+        'muse_http_request_seconds', 'Time to handle an HTTP request',
+        ['method', 'route', 'status'])
+TASKS = Gauge('muse_tasks', 'Unfinished tasks by status', ['status'])
+
+
+class MuseService:
+    def __init__(self):
+        self.blob_store = BlobStore()
+        self.log_streamer = LogStreamer()
+        self.lease_manager = LeaseManager()
+        self.trace_store = TraceStore()
+        self.node_directory = NodeDirectory()
+        self.colle_tasks = get_colle('tasks')
+        self.colle_devices = get_colle('devices')
+        self.colle_manifests = get_colle('manifests')
+        init_event_log()
+
+    def list_devices(self):
+        device_infos = list(self.colle_devices.find({'key': 'device'}, {'_id': 0, 'key': 0}).sort('device_id', 1))
+        update_time = max([info['update_time'] for info in device_infos], default=0)
+        return {'device_infos': device_infos, 'update_time': update_time}
+
+    def make_task(self, j, create_user, create_time):
+        device_selector = j.get('device_selector')
+        if (j.get('hint_device_id') is None) == (device_selector is None):
+            return None
+        if device_selector is not None and not is_valid_selector(device_selector):
+            return None
+        priority = j.get('priority') or TaskPriority.NORMAL.name
+        if not isinstance(priority, str) or priority not in TaskPriority.__members__:
+            return None
+        lease_duration = j.get('lease_duration')
+        if lease_duration is None:
+            lease_duration = LEASE_DURATION
+        if isinstance(lease_duration, bool) or not isinstance(lease_duration, (int, float)) or not (
+                0 < lease_duration < math.inf):
+            return None
+        queue_timeout = j.get('queue_timeout')
+        if queue_timeout is not None and (
+                isinstance(queue_timeout, bool) or not isinstance(queue_timeout, (int, float))
+                or not queue_timeout >= 0):
+            return None
+        return {
+            'status': TaskStatus.QUEUEING.name,
+            'cmd': {
+                'shell': j['cmd']['shell'],
+            },
+            'output': {
+                'files': j['output']['files'],
+            },
+            'hint_device_id': j.get('hint_device_id'),
+            'device_selector': device_selector,
+            'queue_timeout': queue_timeout,
+            'priority': TaskPriority[priority].value,
+            'create_user': create_user,
+            'create_time': create_time,
+            'lease_duration': float(lease_duration),
+            'lease_expire_time': create_time + lease_duration,
+        }
+
+    def create_task(self, j):
+        task = self.make_task(j, j['create_user'], time.time())
+        if task is None:
+            return '', 400
+        result = self.colle_tasks.insert_one(task)
+        publish_task_event(result.inserted_id, TaskStatus.QUEUEING.name)
+        return {'_id': str(result.inserted_id)}, 200
+
+    def create_tasks(self, j):
+        tasks = [self.make_task(task, j['create_user'], time.time()) for task in j['tasks']]
+        if not tasks or None in tasks:
+            return '', 400
+        if j.get('input_manifest') is not None:
+            manifest_id, missing = self.store_manifest(j['input_manifest'])
+            if manifest_id is None:
+                return ({'missing': missing}, 409) if missing else ('', 400)
+            input_ready_time = time.time()
+            for task in tasks:
+                task.update(input_manifest_id=manifest_id, input_archive_ready=1, input_ready_time=input_ready_time)
+                if task['queue_timeout'] is not None:
+                    task['queue_deadline'] = input_ready_time + task['queue_timeout']
+        result = self.colle_tasks.insert_many(tasks)
+        publish_task_events(result.inserted_ids, TaskStatus.QUEUEING.name)
+        logger.info(f'Created {len(result.inserted_ids)} task(s) for {j["create_user"]}')
+        if j.get('input_manifest') is not None:
+            self.evict_blobs()
+        return {'_ids': [str(_id) for _id in result.inserted_ids]}, 200
+
+    def get_input_archive_path(self, _id):
+        return os.path.join(INPUT_ARCHIVE_DIR, f'{ObjectId(_id)}.tar')
+
+    def get_output_archive_path(self, _id):
+        return os.path.join(OUTPUT_ARCHIVE_DIR, f'{ObjectId(_id)}.tar')
+
+    def find_input_archive(self, _id):
+        if not ObjectId.is_valid(_id):
+            return None
+        path = self.get_input_archive_path(_id)
+        return path if os.path.exists(path) else None
+
+    def find_blob(self, blob_hash):
+        if not is_valid_hash(blob_hash) or not self.blob_store.has(blob_hash):
+            return None
+        self.blob_store.touch([blob_hash])
+        return self.blob_store.get_path(blob_hash)
+
+    def get_node_url(self, _id):
+        if not ObjectId.is_valid(_id):
+            return None
+        task = self.colle_tasks.find_one({'_id': ObjectId(_id)}, {'node_id': 1})
+        if task is None or is_local_node(task.get('node_id')):
+            return None
+        return self.node_directory.get_url(task['node_id'])
+
+    def mark_input_ready(self, _id, **fields):
+        now = time.time()
+        task = self.colle_tasks.find_one_and_update(
+            {'_id': ObjectId(_id)},
+            {'$set': dict(fields, input_archive_ready=1, input_ready_time=now)},
+            {'lease_duration': 1, 'queue_timeout': 1})
+        if task is not None and task.get('queue_timeout') is not None:
+            self.colle_tasks.update_one({'_id': task['_id']}, {'$set': {'queue_deadline': now + task['queue_timeout']}})
+        publish_task_event(ObjectId(_id))
+        return task
+
+    def set_input_archive_ready(self, _id):
+        self.mark_input_ready(_id)
+
+    def find_missing_blobs(self, blob_hashes):
+        if not all(is_valid_hash(h) for h in blob_hashes):
+            return None
+        missing = self.blob_store.find_missing(blob_hashes)
+        self.blob_store.touch(set(blob_hashes) - set(missing))
+        return {'missing': missing, 'encodings': available_codecs()}
+
+    def start_chunked_blob(self, blob_hash, j):
+        size = j.get('size')
+        chunk_size = j.get('chunk_size')
+        if not is_valid_hash(blob_hash) or not isinstance(size, int) or not isinstance(chunk_size, int):
+            return '', 400
+        if size < 0 or not 0 < chunk_size <= MAX_UPLOAD_CHUNK_SIZE:
+            return '', 400
+        if self.blob_store.has(blob_hash):
+            self.blob_store.touch([blob_hash])
+            return {'exists': True}, 200
+        received = self.blob_store.start_chunked(blob_hash, size, chunk_size)
+        return {'exists': False, 'received': received}, 200
+
+    def upload_blob_chunk(self, blob_hash, index, data, chunk_hash, encoding=None):
+        if not is_valid_hash(blob_hash) or not is_valid_hash(chunk_hash):
+            return 400
+        if encoding is not None:
+            if get_codec(encoding) is None:
+                return 415
+            try:
+                data = decompress(encoding, data, MAX_UPLOAD_CHUNK_SIZE)
+            except DECOMPRESS_ERRORS as e:
+                logger.warning(f'Blob {blob_hash}: failed to decode chunk {index}: {e}')
+                return 400
+        result = self.blob_store.write_chunk(blob_hash, index, data, chunk_hash)
+        if result is None:
+            return 404
+        return 200 if result else 400
+
+    def commit_chunked_blob(self, blob_hash):
+        if not is_valid_hash(blob_hash):
+            return '', 400
+        committed, missing = self.blob_store.commit_chunked(blob_hash)
+        if missing:
+            return {'missing_chunks': missing}, 409
+        return '', (200 if committed else 400)
+
+    def store_manifest(self, manifest):
+        blob_hashes = get_manifest_hashes(manifest)
+        if not all(is_valid_hash(h) for h in blob_hashes):
+            return None, []
+        missing = self.blob_store.find_missing(blob_hashes)
+        if missing:
+            return None, missing
+        self.blob_store.touch(blob_hashes)
+        manifest_id = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+        self.colle_manifests.update_one(
+            {'_id': manifest_id},
+            {'$set': {'update_time': time.time()}, '$setOnInsert': {'manifest': manifest}}, upsert=True)
+        return manifest_id, []
+
+    def evict_blobs(self):
+        manifest_ids = self.colle_tasks.distinct('input_manifest_id', {'status': {'$in': ALIVE_STATUSES}})
+        pinned = set()
+        for doc in self.colle_manifests.find({'_id': {'$in': manifest_ids}}):
+            pinned.update(get_manifest_hashes(doc['manifest']))
+        self.blob_store.evict(pinned)
+        self.colle_manifests.delete_many(
+            {'_id': {'$nin': manifest_ids}, 'update_time': {'$lt': time.time() - MANIFEST_TTL}})
+
+    def set_input_manifest(self, _id, manifest):
+        manifest_id, missing = self.store_manifest(manifest)
+        if manifest_id is None:
+            return ({'missing': missing}, 409) if missing else ('', 400)
+        task = self.mark_input_ready(_id, input_manifest_id=manifest_id)
+        if task is not None:
+            self.lease_manager.renew(task)
+        self.evict_blobs()
+        return '', 200
+
+    def get_output_info(self, _id):
+        task = self.colle_tasks.find_one(
+            {'_id': ObjectId(_id)},
+            {'output_size': 1, 'output_sha256': 1, 'output_chunk_size': 1, 'output_chunks': 1, 'output_codecs': 1})
+        if task is None:
+            return None
+        codecs = task.get('output_codecs', {})
+        return {
+            'size': task.get('output_size'),
+            'sha256': task.get('output_sha256'),
+            'chunk_size': task.get('output_chunk_size'),
+            'chunks': task.get('output_chunks', []),
+            'codecs': {name: codecs[name] for name in available_codecs() if name in codecs},
+        }
+
+    def read_output_chunk(self, _id, index, encoding=None):
+        task = self.colle_tasks.find_one({'_id': ObjectId(_id)}, {'output_size': 1, 'output_chunk_size': 1})
+        if task is None or task.get('output_chunk_size') is None:
+            return None, None
+        offset = index * task['output_chunk_size']
+        if index < 0 or offset >= max(task['output_size'], 1):
+            return None, None
+        with open(self.get_output_archive_path(_id), 'rb') as f:
+            f.seek(offset)
+            data = f.read(task['output_chunk_size'])
+        codec = get_codec(encoding)
+        if codec is None:
+            return data, None
+        return codec.compress(data), codec.name
+
+    def get_task(self, _id):
+        task = self.colle_tasks.find_one({'_id': ObjectId(_id)})
+        if task is not None:
+            self.lease_manager.renew(task)
+        return task
+
+    def query_task(self, _id):
+        task = self.get_task(_id)
+        task['_id'] = str(task['_id'])
+        return task
+
+    def query_tasks(self, _ids):
+        tasks = list(self.colle_tasks.find(
+                {'_id': {'$in': [ObjectId(_id) for _id in _ids]}}, {'output_chunks': 0, 'output_codecs': 0}))
+        for task in tasks:
+            self.lease_manager.renew(task)
+            task['_id'] = str(task['_id'])
+        return {'tasks': tasks}
+
+    def open_task_log(self, _id, log, offset):
+        assert log in ('stdout', 'stderr')
+        task_log = self.colle_tasks.find_one(
+            {'_id': ObjectId(_id)},
+            {'stderr': 1, 'stdout': 1, 'status': 1})
+        if task_log is None or log not in task_log:
+            log_file_path = None
+        else:
+            log_file_path = task_log[log]
+        logger.info(f'{log}: {log_file_path} from offset {offset}')
+
+        if log_file_path is None or not os.path.exists(log_file_path):
+            return None, None, None
+        if is_finished_status(task_log['status']) and offset == 0:
+            return log_file_path, None, None
+
+        def get_status():
+            return self.colle_tasks.find_one({'_id': ObjectId(_id)}, {'status': 1})['status']
+
+        if is_finished_status(task_log['status']):
+            self.log_streamer.set_finished(_id)
+        self.log_streamer.start()
+        return log_file_path, self.log_streamer.stream(_id, log_file_path, offset), get_status
+
+    def open_task_events(self, _id, offsets):
+        if self.colle_tasks.find_one({'_id': ObjectId(_id)}, {'_id': 1}) is None:
+            return None, None
+        self.log_streamer.start()
+        return self.log_streamer.stream_events(_id, offsets), lambda: self.get_task(_id)
+
+    def list_tasks(self):
+        doc = self.colle_tasks.find({'status': {'$in': ALIVE_STATUSES + [TaskStatus.KILLING.name]}})
+
+        tasks = []
+        for task in doc:
+            t = {key: value for key, value in task.items() if key != '_id'}
+            tasks.append(t)
+
+        return {'tasks': tasks}
+
+    def record_request(self, method, route, status, start_time, _id=None):
+        end_time = time.time()
+        HTTP_REQUEST_SECONDS.observe(end_time - start_time, method=method, route=route, status=status)
+        if _id is not None and ObjectId.is_valid(_id) and not route.startswith(UNTRACED_ROUTE_PREFIXES):
+            self.trace_store.add(_id, make_span(
+                    f'{method} {route}', 'server', start_time, end_time, attrs={'status': status}))
+
+    def add_trace_spans(self, _id, spans):
+        if not isinstance(spans, list):
+            return 400
+        for span in spans:
+            if not isinstance(span, dict) or not isinstance(span.get('name'), str):
+                return 400
+            if not all(isinstance(span.get(key), (int, float)) for key in ('start', 'end')):
+                return 400
+            self.trace_store.add(_id, make_span(
+                    span['name'], str(span.get('process', 'client')), span['start'], span['end'],
+                    int(span.get('depth', 0)), span.get('attrs') if isinstance(span.get('attrs'), dict) else {}))
+        return 200
+
+    def get_trace(self, _id):
+        task = self.colle_tasks.find_one({'_id': ObjectId(_id)}, {'output_chunks': 0, 'output_codecs': 0})
+        if task is None:
+            return None
+        self.trace_store.flush()
+        spans = sorted(get_stage_spans(task) + load_trace(_id), key=lambda span: span['start'])
+        return {'spans': spans}
+
+    def get_metrics(self):
+        counts = {status: 0 for status in ALIVE_STATUSES + [TaskStatus.KILLING.name]}
+        for doc in self.colle_tasks.aggregate([
+                {'$match': {'status': {'$in': list(counts)}}},
+                {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            counts[doc['_id']] = doc['count']
+        for status, count in counts.items():
+            TASKS.set(count, status=status)
+        return expose_metrics()
+
+    def kill_task(self, _id):
+        doc = self.colle_tasks.find_one_and_update(
+            {'_id': ObjectId(_id), 'status': {'$in': ALIVE_STATUSES}},
+            {'$set': {'status': TaskStatus.KILLING.name}})
+        if doc:
+            publish_task_event(ObjectId(_id), TaskStatus.KILLING.name)
+            return True
+        return False
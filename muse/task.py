@@ -16,3 +16,12 @@ class TaskFailReason(Enum):
     PULL_DATA_FAILED = 2
     NONZERO_RETURN_CODE = 3
     KILLED = 4
+    QUEUE_TIMEOUT = 5
+    INTERNAL_ERROR = 6
+
+
+class TaskPriority(Enum):
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+    URGENT = 3
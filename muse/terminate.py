@@ -0,0 +1,51 @@
+import time
+from contextlib import contextmanager
+from threading import Event, Lock
+
+
+class TerminateFlag:
+    def __init__(self):
+        self.event = Event()
+        self.lock = Lock()
+        self.callbacks = []
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def set(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def remaining(self):
+        return None
+
+    @contextmanager
+    def watch(self, callback):
+        # callback interrupts a blocking wait, e.g. by killing the process or shutting down the socket
+        with self.lock:
+            is_set = self.event.is_set()
+            if not is_set:
+                self.callbacks.append(callback)
+        if is_set:
+            callback()
+        try:
+            yield
+        finally:
+            with self.lock:
+                if callback in self.callbacks:
+                    self.callbacks.remove(callback)
+
+
+class Deadline(TerminateFlag):
+    def __init__(self, timeout):
+        TerminateFlag.__init__(self)
+        self.deadline = time.time() + timeout
+
+    def is_set(self):
+        return TerminateFlag.is_set(self) or time.time() >= self.deadline
+
+    def remaining(self):
+        return max(self.deadline - time.time(), 0)
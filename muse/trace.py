@@ -0,0 +1,151 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import local
+
+STAGES = [
+    ('queue', 'input_ready_time', 'start_time'),
+    ('push', 'start_time', 'run_start_time'),
+    ('run', 'run_start_time', 'run_end_time'),
+    ('pull', 'run_end_time', 'pull_end_time'),
+    ('finalize', 'pull_end_time', 'finish_time'),
+]
+
+current = local()
+
+
+class Tracer:
+    def __init__(self, process, sink=None):
+        self.process = process
+        self.sink = sink
+        self.spans = []
+        self.depth = 0
+
+    @contextmanager
+    def activate(self):
+        prev_tracer = getattr(current, 'tracer', None)
+        current.tracer = self
+        try:
+            yield self
+        finally:
+            current.tracer = prev_tracer
+
+    @contextmanager
+    def span(self, name, process=None, **attrs):
+        start_time = time.time()
+        depth = self.depth
+        self.depth += 1
+        try:
+            yield
+        except BaseException:
+            attrs['error'] = True
+            raise
+        finally:
+            self.depth = depth
+            self.add(make_span(name, process or self.process, start_time, time.time(), depth, attrs))
+
+    def add(self, span):
+        if self.sink is None:
+            self.spans.append(span)
+        else:
+            self.sink(span)
+
+
+def make_span(name, process, start_time, end_time, depth=0, attrs=None):
+    return {
+        'name': name,
+        'process': process,
+        'start': start_time,
+        'end': end_time,
+        'depth': depth,
+        'attrs': attrs or {},
+    }
+
+
+@contextmanager
+def span(name, process=None, **attrs):
+    tracer = getattr(current, 'tracer', None)
+    if tracer is None:
+        yield
+        return
+    with tracer.span(name, process, **attrs):
+        yield
+
+
+def traced(name, process=None):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, process):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_stage_spans(task):
+    spans = []
+    for name, start_key, end_key in STAGES:
+        start_time = task.get(start_key)
+        if start_key == 'input_ready_time' and start_time is None:
+            start_time = task.get('create_time')
+        end_time = task.get(end_key)
+        if start_time is not None and end_time is not None:
+            spans.append(make_span(name, 'task', start_time, end_time))
+    return spans
+
+
+def format_waterfall(spans, width=40):
+    if not spans:
+        return []
+    begin = min(span['start'] for span in spans)
+    total = max(max(span['end'] for span in spans) - begin, 1e-6)
+    name_width = max(len('  ' * span['depth'] + span['name']) for span in spans)
+    lines = []
+    for span in sorted(spans, key=lambda span: (span['start'], span['depth'])):
+        offset = int((span['start'] - begin) / total * width)
+        length = max(1, int((span['end'] - span['start']) / total * width))
+        bar = ' ' * offset + '#' * min(length, width - offset)
+        name = ('  ' * span['depth'] + span['name']).ljust(name_width)
+        error = ' !' if span['attrs'].get('error') else ''
+        lines.append(
+            f'{span["process"]:<9} {name}  {span["start"] - begin:8.3f}s {span["end"] - span["start"]:8.3f}s'
+            f'  |{bar.ljust(width)}|{error}')
+    return lines
+
+
+def assign_lanes(spans):
+    lanes = {}
+    lane_stacks = {}
+    for index, span in sorted(enumerate(spans), key=lambda item: (item[1]['start'], -item[1]['end'])):
+        stacks = lane_stacks.setdefault(span['process'], [])
+        for lane, stack in enumerate(stacks):
+            while stack and stack[-1] <= span['start']:
+                stack.pop()
+            if not stack or span['end'] <= stack[-1]:
+                break
+        else:
+            lane = len(stacks)
+            stacks.append([])
+        stacks[lane].append(span['end'])
+        lanes[index] = lane
+    return [lanes[index] for index in range(len(spans))]
+
+
+def to_chrome_trace(spans):
+    processes = sorted({span['process'] for span in spans})
+    pids = {process: pid for pid, process in enumerate(processes, 1)}
+    events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': process}}
+        for process, pid in pids.items()]
+    for span, lane in zip(spans, assign_lanes(spans)):
+        events.append({
+            'name': span['name'],
+            'cat': span['process'],
+            'ph': 'X',
+            'ts': int(span['start'] * 1e6),
+            'dur': int((span['end'] - span['start']) * 1e6),
+            'pid': pids[span['process']],
+            'tid': lane,
+            'args': span['attrs'],
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
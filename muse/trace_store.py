@@ -0,0 +1,56 @@
+import datetime
+import time
+from threading import Thread, Lock
+
+from bson import ObjectId
+from loguru import logger
+from pymongo.errors import PyMongoError
+
+from muse.db import get_colle
+from muse.server_settings import TRACE_FLUSH_INTERVAL, TRACE_TTL
+
+TRACES_COLLE_NAME = 'task_traces'
+
+
+def ensure_trace_indexes():
+    colle_traces = get_colle(TRACES_COLLE_NAME)
+    colle_traces.create_index([('task_id', 1), ('start', 1)])
+    colle_traces.create_index('create_date', expireAfterSeconds=int(TRACE_TTL))
+
+
+def load_trace(task_id):
+    return list(get_colle(TRACES_COLLE_NAME).find(
+        {'task_id': ObjectId(task_id)}, {'_id': 0, 'task_id': 0, 'create_date': 0}).sort('start', 1))
+
+
+class TraceStore(Thread):
+    def __init__(self, flush_interval=TRACE_FLUSH_INTERVAL):
+        Thread.__init__(self)
+        self.daemon = True
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.lock = Lock()
+        self.started = False
+
+    def add(self, task_id, span):
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.start()
+            self.pending.append(dict(span, task_id=ObjectId(task_id)))
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        create_date = datetime.datetime.utcnow()
+        try:
+            get_colle(TRACES_COLLE_NAME).insert_many([dict(span, create_date=create_date) for span in pending])
+        except PyMongoError as e:
+            logger.warning(f'Failed to flush {len(pending)} trace span(s): {e}')
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
@@ -0,0 +1,337 @@
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+
+import requests
+from humanize import naturalsize
+from loguru import logger
+
+from muse.client_settings import (
+    TRANSFER_CONNECTIONS, TRANSFER_CHUNK_SIZE, TRANSFER_RETRIES, TRANSFER_COMPRESSION, TRANSFER_LINK_SPEED)
+from muse.compression import (
+    DECOMPRESS_ERRORS, ENCODING_HEADER, SAMPLE_SIZE, LinkMeter, decompress, get_codec, measure_codecs, select_codec)
+from muse.exceptions import MuseClientError, TransferError
+
+UPLOAD_BATCH_SIZE = 256
+RETRYABLE_ERRORS = (
+    requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, TransferError)
+
+
+class Progress:
+    def __init__(self, action, total_size):
+        self.action = action
+        self.total_size = total_size
+        self.done_size = 0
+        self.prev_print_time = 0
+        self.lock = Lock()
+
+    def add_total(self, size):
+        with self.lock:
+            self.total_size += size
+
+    def add(self, size):
+        with self.lock:
+            self.done_size += size
+            if time.time() > self.prev_print_time + 1.0 or self.done_size == self.total_size:
+                logger.info(f'{self.action}: {naturalsize(self.done_size)} / {naturalsize(self.total_size)}')
+                self.prev_print_time = time.time()
+
+
+def with_retries(func, *args):
+    for attempt in range(TRANSFER_RETRIES):
+        try:
+            return func(*args)
+        except RETRYABLE_ERRORS as e:
+            if attempt == TRANSFER_RETRIES - 1:
+                raise MuseClientError(f'Transfer failed after {TRANSFER_RETRIES} attempts: {e}')
+            logger.warning(f'Transfer interrupted ({e}), retrying in {2 ** attempt} second(s)')
+            time.sleep(2 ** attempt)
+
+
+def read_chunk(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class Transfer:
+    def __init__(
+            self, server_url, connections=TRANSFER_CONNECTIONS, chunk_size=TRANSFER_CHUNK_SIZE,
+            compression=TRANSFER_COMPRESSION):
+        self.server_url = server_url
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.encodings = []
+        self.link_meter = LinkMeter(TRANSFER_LINK_SPEED)
+        self.sessions = local()
+
+    def get_session(self):
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+        return self.sessions.session
+
+    def send(self, method, url, data=None, headers=None):
+        start_time = time.time()
+        response = self.get_session().request(method, url, data=data, headers=headers)
+        num_bytes = len(data) if data is not None else len(response.content)
+        self.link_meter.add(num_bytes, time.time() - start_time)
+        return response
+
+    def encode(self, data):
+        if self.compression in ('', 'none') or not self.encodings:
+            return data, {}
+        profiles = measure_codecs(data[:SAMPLE_SIZE], self.encodings)
+        name = select_codec(self.compression, profiles, self.link_meter.speed)
+        if name is None:
+            return data, {}
+        return get_codec(name).compress(data), {ENCODING_HEADER: name}
+
+    def upload_blob(self, blob_hash, path, progress):
+        with open(path, 'rb') as f:
+            data = f.read()
+        body, headers = self.encode(data)
+        headers['Content-Type'] = 'application/octet-stream'
+        response = self.send('POST', f'{self.server_url}blob/upload/{blob_hash}', body, headers)
+        if response.status_code != 200:
+            raise TransferError(f'Failed to upload blob {blob_hash}: HTTP {response.status_code}')
+        progress.add(len(data))
+
+    def start_chunked_blob(self, blob_hash, size):
+        response = self.get_session().post(
+                f'{self.server_url}blob/chunked/{blob_hash}', json={'size': size, 'chunk_size': self.chunk_size})
+        if response.status_code != 200:
+            raise TransferError(f'Failed to start chunked upload of blob {blob_hash}: HTTP {response.status_code}')
+        return response.json()
+
+    def upload_blob_chunk(self, blob_hash, path, index, progress):
+        data = read_chunk(path, index * self.chunk_size, self.chunk_size)
+        body, headers = self.encode(data)
+        headers['Content-Type'] = 'application/octet-stream'
+        headers['X-Chunk-Sha256'] = hashlib.sha256(data).hexdigest()
+        response = self.send('PUT', f'{self.server_url}blob/chunked/{blob_hash}/{index}', body, headers)
+        if response.status_code != 200:
+            raise TransferError(f'Failed to upload chunk {index} of blob {blob_hash}: HTTP {response.status_code}')
+        progress.add(len(data))
+
+    def commit_chunked_blob(self, blob_hash):
+        response = self.get_session().post(f'{self.server_url}blob/chunked/{blob_hash}/commit')
+        if response.status_code == 409:
+            return response.json()['missing_chunks']
+        if response.status_code != 200:
+            raise MuseClientError(f'Server rejected blob {blob_hash}: HTTP {response.status_code}')
+        return []
+
+    def find_missing_blobs(self, blob_hashes):
+        response = self.get_session().post(f'{self.server_url}blob/missing', json={'hashes': blob_hashes})
+        if response.status_code != 200:
+            raise TransferError(f'Failed to query missing blobs: HTTP {response.status_code}')
+        self.encodings = response.json().get('encodings', [])
+        return set(response.json()['missing'])
+
+    def schedule_blob(self, executor, blob_hash, path, size, progress):
+        progress.add_total(size)
+        if size <= self.chunk_size:
+            return [executor.submit(with_retries, self.upload_blob, blob_hash, path, progress)], False
+        state = with_retries(self.start_chunked_blob, blob_hash, size)
+        if state['exists']:
+            progress.add(size)
+            return [], False
+        futures = []
+        received = set(state['received'])
+        for index in range(-(-size // self.chunk_size)):
+            if index in received:
+                progress.add(min(self.chunk_size, size - index * self.chunk_size))
+            else:
+                futures.append(executor.submit(with_retries, self.upload_blob_chunk, blob_hash, path, index, progress))
+        return futures, True
+
+    def upload_manifest(self, entries):
+        manifest = []
+        seen = set()
+        batch = []
+        futures = []
+        chunked_blobs = []
+        stats = {'size': 0, 'missing': 0, 'missing_size': 0}
+        progress = Progress('Uploading', 0)
+
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            def flush():
+                missing = with_retries(self.find_missing_blobs, [entry['hash'] for entry, path in batch])
+                for entry, path in batch:
+                    if entry['hash'] not in missing:
+                        continue
+                    stats['missing'] += 1
+                    stats['missing_size'] += entry['size']
+                    blob_futures, chunked = self.schedule_blob(executor, entry['hash'], path, entry['size'], progress)
+                    futures.extend(blob_futures)
+                    if chunked:
+                        chunked_blobs.append((entry['hash'], path))
+                batch.clear()
+
+            for entry, path in entries:
+                manifest.append(entry)
+                if entry['type'] != 'file' or entry['hash'] in seen:
+                    continue
+                seen.add(entry['hash'])
+                stats['size'] += entry['size']
+                batch.append((entry, path))
+                if len(batch) >= UPLOAD_BATCH_SIZE:
+                    flush()
+            if batch:
+                flush()
+            for future in futures:
+                future.result()
+
+        for blob_hash, path in chunked_blobs:
+            missing = with_retries(self.commit_chunked_blob, blob_hash)
+            if missing:
+                self.run_jobs([(self.upload_blob_chunk, blob_hash, path, index, progress) for index in missing])
+                if with_retries(self.commit_chunked_blob, blob_hash):
+                    raise MuseClientError(f'Failed to upload blob {blob_hash}')
+
+        logger.info(
+            f'Inputs: {len(seen)} blob(s) of {naturalsize(stats["size"])}'
+            f', uploaded {stats["missing"]} blob(s) of {naturalsize(stats["missing_size"])}')
+        return manifest
+
+    def run_jobs(self, jobs):
+        if not jobs:
+            return
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            futures = [executor.submit(with_retries, *job) for job in jobs]
+            for future in futures:
+                future.result()
+
+    def iter_chunks(self, num_chunks, fetch):
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            futures = deque()
+            next_index = 0
+            while next_index < num_chunks or futures:
+                while next_index < num_chunks and len(futures) < 2 * self.connections:
+                    futures.append(executor.submit(fetch, next_index))
+                    next_index += 1
+                yield futures.popleft().result()
+
+    def download_chunk(self, url, offset, size, chunk_hash, codecs, progress):
+        name = select_codec(self.compression, codecs, self.link_meter.speed)
+        response = self.send('GET', url, headers={} if name is None else {ENCODING_HEADER: name})
+        if response.status_code != 200:
+            raise TransferError(f'Failed to download bytes {offset}+{size}: HTTP {response.status_code}')
+        data = response.content
+        encoding = response.headers.get(ENCODING_HEADER)
+        if encoding is not None:
+            try:
+                data = decompress(encoding, data, size)
+            except (DECOMPRESS_ERRORS + (KeyError,)) as e:
+                raise TransferError(f'Failed to decode bytes {offset}+{size}: {e}')
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            raise TransferError(f'Checksum mismatch for bytes {offset}+{size}')
+        progress.add(size)
+        return data
+
+    def download(self, url, output_info, write=None, path=None):
+        size = output_info['size']
+        chunk_size = output_info['chunk_size']
+        num_chunks = len(output_info['chunks'])
+        codecs = get_output_codecs(output_info)
+        progress = Progress('Downloading', size)
+
+        partial = None
+        done = set()
+        if path is not None:
+            partial = PartialDownload(path, output_info)
+            done = partial.open()
+            progress.done_size = partial.done_size()
+
+        def fetch(index):
+            offset = index * chunk_size
+            chunk_len = min(chunk_size, size - offset)
+            if index in done:
+                return partial.read(index)
+            data = with_retries(
+                    self.download_chunk, f'{url}/{index}', offset, chunk_len, output_info['chunks'][index], codecs,
+                    progress)
+            if partial is not None:
+                partial.write(index, data)
+            return data
+
+        h = hashlib.sha256()
+        for data in self.iter_chunks(num_chunks, fetch):
+            h.update(data)
+            if write is not None:
+                write(data)
+
+        if h.hexdigest() != output_info['sha256']:
+            if partial is not None:
+                partial.discard()
+            raise MuseClientError('Checksum mismatch for the downloaded archive')
+        if partial is not None:
+            partial.commit()
+
+
+def get_output_codecs(output_info):
+    return {name: profile for name, profile in output_info.get('codecs', {}).items() if get_codec(name)}
+
+
+class PartialDownload:
+    def __init__(self, path, output_info):
+        self.path = path
+        self.part_path = f'{path}.part'
+        self.state_path = f'{path}.part.json'
+        self.sha256 = output_info['sha256']
+        self.size = output_info['size']
+        self.chunk_size = output_info['chunk_size']
+        self.num_chunks = len(output_info['chunks'])
+        self.done = set()
+        self.lock = Lock()
+
+    def open(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state['sha256'] == self.sha256 and os.path.getsize(self.part_path) == self.size:
+                self.done = set(state['done'])
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        if not self.done:
+            with open(self.part_path, 'wb') as f:
+                f.truncate(self.size)
+        else:
+            logger.info(f'Resuming download, {len(self.done)} of {self.num_chunks} chunk(s) already present')
+        return set(self.done)
+
+    def get_chunk_range(self, index):
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def done_size(self):
+        return sum(self.get_chunk_range(index)[1] for index in self.done)
+
+    def read(self, index):
+        return read_chunk(self.part_path, *self.get_chunk_range(index))
+
+    def write(self, index, data):
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, self.get_chunk_range(index)[0])
+        finally:
+            os.close(fd)
+        with self.lock:
+            self.done.add(index)
+            with open(self.state_path, 'w') as f:
+                json.dump({'sha256': self.sha256, 'done': sorted(self.done)}, f)
+
+    def discard(self):
+        os.remove(self.part_path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def commit(self):
+        os.replace(self.part_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
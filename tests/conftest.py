@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_adb_server import FakeAdbServer  # noqa: E402
+
+
+@pytest.fixture
+def adb_server(tmp_path):
+    server = FakeAdbServer(str(tmp_path / 'devices'), {
+        'dev1': ['shell_v2', 'cmd'],
+        'legacy': ['cmd'],
+    }).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def adb_client(adb_server):
+    from muse.adb import AdbClient
+
+    return AdbClient('127.0.0.1', adb_server.port)
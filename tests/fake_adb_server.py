@@ -0,0 +1,215 @@
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
+
+SHELL_STDIN = 0
+SHELL_STDOUT = 1
+SHELL_STDERR = 2
+SHELL_EXIT = 3
+SHELL_CLOSE_STDIN = 4
+SYNC_DATA_MAX = 64 * 1024
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def send_okay(sock, payload=None):
+    sock.sendall(b'OKAY' if payload is None else b'OKAY%04x' % len(payload) + payload)
+
+
+def send_fail(sock, message):
+    payload = message.encode()
+    sock.sendall(b'FAIL%04x' % len(payload) + payload)
+
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        sock = self.request
+        serial = None
+        try:
+            while True:
+                size = int(recv_exact(sock, 4), 16)
+                service = recv_exact(sock, size).decode()
+                self.server.services.append(service)
+                if serial is None:
+                    serial = self.handle_host(service)
+                    if serial is None:
+                        return
+                else:
+                    self.handle_device(serial, service)
+                    return
+        except (EOFError, ConnectionError):
+            pass
+
+    def handle_host(self, service):
+        sock = self.request
+        if service == 'host:devices':
+            send_okay(sock, self.server.get_device_list())
+        elif service == 'host:track-devices':
+            send_okay(sock, self.server.get_device_list())
+            sock.recv(1)
+        elif service.startswith('host-serial:') and service.endswith(':features'):
+            serial = service[len('host-serial:'):-len(':features')]
+            if serial not in self.server.devices:
+                send_fail(sock, f"device '{serial}' not found")
+            else:
+                send_okay(sock, ','.join(self.server.devices[serial]).encode())
+        elif service.startswith('host:transport:'):
+            serial = service[len('host:transport:'):]
+            if serial not in self.server.devices:
+                send_fail(sock, f"device '{serial}' not found")
+                return None
+            send_okay(sock)
+            return serial
+        else:
+            send_fail(sock, f'unknown host service {service}')
+        return None
+
+    def handle_device(self, serial, service):
+        if service.startswith('shell,v2,raw:') and 'shell_v2' in self.server.devices[serial]:
+            send_okay(self.request)
+            self.handle_shell_v2(serial, service[len('shell,v2,raw:'):])
+        elif service.startswith('exec:'):
+            send_okay(self.request)
+            self.handle_exec(serial, service[len('exec:'):])
+        elif service == 'sync:':
+            send_okay(self.request)
+            self.handle_sync(serial)
+        else:
+            send_fail(self.request, f'unknown device service {service}')
+
+    def start_process(self, serial, cmd, stderr):
+        return subprocess.Popen(
+                ['sh', '-c', cmd], cwd=self.server.get_device_root(serial),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+
+    def handle_shell_v2(self, serial, cmd):
+        sock = self.request
+        process = self.start_process(serial, cmd, subprocess.PIPE)
+        lock = threading.Lock()
+
+        def send_packet(packet_id, data):
+            with lock:
+                sock.sendall(struct.pack('<BI', packet_id, len(data)) + data)
+
+        def forward(stream, packet_id):
+            for data in iter(lambda: os.read(stream.fileno(), SYNC_DATA_MAX), b''):
+                send_packet(packet_id, data)
+
+        def read_stdin():
+            try:
+                while True:
+                    packet_id, size = struct.unpack('<BI', recv_exact(sock, 5))
+                    data = recv_exact(sock, size)
+                    if packet_id == SHELL_STDIN:
+                        process.stdin.write(data)
+                        process.stdin.flush()
+                    elif packet_id == SHELL_CLOSE_STDIN:
+                        process.stdin.close()
+            except (EOFError, ConnectionError, OSError, ValueError):
+                process.kill()
+
+        threading.Thread(target=read_stdin, daemon=True).start()
+        readers = [
+            threading.Thread(target=forward, args=(process.stdout, SHELL_STDOUT)),
+            threading.Thread(target=forward, args=(process.stderr, SHELL_STDERR)),
+        ]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        send_packet(SHELL_EXIT, bytes([process.wait() & 0xff]))
+
+    def handle_exec(self, serial, cmd):
+        sock = self.request
+        process = self.start_process(serial, cmd, subprocess.DEVNULL)
+
+        def read_stdin():
+            try:
+                for data in iter(lambda: sock.recv(SYNC_DATA_MAX), b''):
+                    process.stdin.write(data)
+                process.stdin.close()
+            except (ConnectionError, OSError, ValueError):
+                process.kill()
+
+        threading.Thread(target=read_stdin, daemon=True).start()
+        for data in iter(lambda: os.read(process.stdout.fileno(), SYNC_DATA_MAX), b''):
+            sock.sendall(data)
+        process.wait()
+        sock.shutdown(socket.SHUT_WR)
+
+    def handle_sync(self, serial):
+        sock = self.request
+        while True:
+            command, size = struct.unpack('<4sI', recv_exact(sock, 8))
+            path = self.server.get_device_path(serial, recv_exact(sock, size).decode().split(',')[0])
+            if command == b'SEND':
+                self.receive_file(path)
+            elif command == b'RECV':
+                self.send_file(path)
+            else:
+                return
+
+    def receive_file(self, path):
+        sock = self.request
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            while True:
+                command, size = struct.unpack('<4sI', recv_exact(sock, 8))
+                if command == b'DONE':
+                    break
+                f.write(recv_exact(sock, size))
+        sock.sendall(b'OKAY' + struct.pack('<I', 0))
+
+    def send_file(self, path):
+        sock = self.request
+        if not os.path.isfile(path):
+            message = b'No such file or directory'
+            sock.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+            return
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(SYNC_DATA_MAX), b''):
+                sock.sendall(b'DATA' + struct.pack('<I', len(data)) + data)
+        sock.sendall(b'DONE' + struct.pack('<I', 0))
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, devices):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeAdbHandler)
+        self.root = root
+        self.devices = devices
+        self.services = []
+        self.connections = 0
+        for serial in devices:
+            os.makedirs(self.get_device_root(serial), exist_ok=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def get_device_list(self):
+        return ''.join(f'{serial}\tdevice\n' for serial in self.devices).encode()
+
+    def get_device_root(self, serial):
+        return os.path.join(self.root, serial)
+
+    def get_device_path(self, serial, path):
+        return os.path.join(self.get_device_root(serial), path.lstrip('/'))
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
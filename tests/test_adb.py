@@ -0,0 +1,134 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from muse.adb import AdbClient
+from muse.device_manager import AdbNativeBackend, CANCELLED_RETURN_CODE, parse_device_list
+from muse.exceptions import AdbCancelled, AdbError
+from muse.terminate import Deadline, TerminateFlag
+
+
+def run_shell(adb_client, serial, cmd, stdin=None):
+    session = adb_client.shell(serial, cmd)
+    stdout, stderr = io.BytesIO(), io.BytesIO()
+    try:
+        if stdin is not None:
+            session.write_stdin(stdin)
+            session.close_stdin()
+        return session.wait(stdout, stderr), stdout.getvalue(), stderr.getvalue()
+    finally:
+        session.close()
+
+
+def test_host_services(adb_client):
+    assert parse_device_list(adb_client.devices()) == ['dev1', 'legacy']
+    assert parse_device_list(next(adb_client.track_devices())) == ['dev1', 'legacy']
+    assert adb_client.get_features('dev1') == {'shell_v2', 'cmd'}
+    with pytest.raises(AdbError, match='not found'):
+        adb_client.get_features('missing')
+
+
+def test_host_transport(adb_client, adb_server):
+    run_shell(adb_client, 'dev1', 'true')
+    assert adb_server.services[-2:] == ['host:transport:dev1', 'shell,v2,raw:true']
+    with pytest.raises(AdbError, match='not found'):
+        adb_client.open_service('missing', 'exec:true')
+
+
+def test_shell_v2_exit_code(adb_client):
+    assert run_shell(adb_client, 'dev1', 'exit 3')[0] == 3
+    assert run_shell(adb_client, 'dev1', 'exit 0')[0] == 0
+
+
+def test_shell_v2_streams(adb_client):
+    return_code, stdout, stderr = run_shell(adb_client, 'dev1', 'echo out; echo err >&2; exit 1')
+    assert (return_code, stdout, stderr) == (1, b'out\n', b'err\n')
+
+    data = os.urandom(200 * 1024)
+    return_code, stdout, _ = run_shell(adb_client, 'dev1', 'cat', stdin=data)
+    assert return_code == 0 and stdout == data
+
+
+def test_shell_v2_unsupported(adb_client):
+    with pytest.raises(AdbError, match='shell protocol v2'):
+        adb_client.shell('legacy', 'true')
+
+
+@pytest.mark.parametrize('make_flag', [lambda: TerminateFlag(), lambda: Deadline(0.3)])
+def test_shell_cancelled(adb_client, make_flag):
+    terminate_flag = make_flag()
+    threading.Timer(0.3, terminate_flag.set).start()
+    session = adb_client.shell('dev1', 'sleep 10')
+    start_time = time.time()
+    try:
+        with pytest.raises(AdbCancelled):
+            session.wait(terminate_flag=terminate_flag)
+    finally:
+        session.close()
+    assert time.time() - start_time < 2
+
+
+def test_exec(adb_client):
+    data = os.urandom(200 * 1024)
+    session = adb_client.exec('legacy', 'cat')
+    stdout = io.BytesIO()
+    try:
+        session.write_stdin(data)
+        session.close_stdin()
+        assert session.wait(stdout) == 0
+    finally:
+        session.close()
+    assert stdout.getvalue() == data
+
+
+def test_sync_push_pull(adb_client, adb_server):
+    data = os.urandom(300 * 1024 + 7)
+    with adb_client.sync('dev1') as sync:
+        assert sync.push(io.BytesIO(data), '/data/local/tmp/a.bin') == len(data)
+    with open(os.path.join(adb_server.get_device_root('dev1'), 'data/local/tmp/a.bin'), 'rb') as f:
+        assert f.read() == data
+
+    pulled = io.BytesIO()
+    with adb_client.sync('dev1') as sync:
+        assert sync.pull('/data/local/tmp/a.bin', pulled) == len(data)
+    assert pulled.getvalue() == data
+    assert adb_server.services.count('sync:') == 1
+
+
+def test_sync_pull_missing(adb_client):
+    with pytest.raises(AdbError, match='No such file'):
+        with adb_client.sync('dev1') as sync:
+            sync.pull('/data/local/tmp/missing', io.BytesIO())
+    assert adb_client.sync_pool.get('dev1', []) == []
+
+
+def test_native_backend(adb_server, tmp_path):
+    backend = AdbNativeBackend()
+    backend.client = AdbClient('127.0.0.1', adb_server.port)
+    terminate_flag = TerminateFlag()
+
+    assert backend.shell_output('dev1', 'echo hello; exit 2', terminate_flag) == (2, 'hello\n')
+
+    data = os.urandom(100 * 1024)
+    for device_id in ('dev1', 'legacy'):
+        return_code, num_bytes = backend.stream_in(
+                device_id, 'cat > in.bin', lambda f: f.write(data), terminate_flag)
+        assert (return_code, num_bytes) == (0, len(data))
+        output = io.BytesIO()
+        assert backend.stream_out(device_id, 'cat in.bin', output, terminate_flag) == (0, len(data))
+        assert output.getvalue() == data
+
+    local_path = str(tmp_path / 'local.bin')
+    with open(local_path, 'wb') as f:
+        f.write(data)
+    assert backend.push('dev1', local_path, '/data/local/tmp/b.bin', terminate_flag) == 0
+    assert backend.pull('dev1', '/data/local/tmp/b.bin', local_path + '.pulled', terminate_flag) == 0
+    with open(local_path + '.pulled', 'rb') as f:
+        assert f.read() == data
+    assert backend.pull('dev1', '/data/local/tmp/missing', local_path, terminate_flag) == 1
+
+    terminate_flag.set()
+    assert backend.shell('dev1', 'sleep 10', terminate_flag) == CANCELLED_RETURN_CODE
@@ -0,0 +1,74 @@
+from muse.fair_share import FairShareQueue, parse_user_values
+
+
+def make_tasks(user, create_times, devices=None):
+    return [{'_id': f'{user}{i}', 'create_time': t, 'devices': devices} for i, t in enumerate(create_times)]
+
+
+def dispatch(queue, devices):
+    free_devices = set(devices)
+    dispatched = []
+    for task, device_id in queue.iter_dispatch(free_devices, lambda task: task['devices'] or sorted(free_devices)):
+        # the scheduler takes the device before asking for the next task
+        free_devices.discard(device_id)
+        dispatched.append((task['_id'], device_id))
+    return dispatched
+
+
+def test_parse_user_values():
+    assert parse_user_values('alice=2, bob=0.5,,*=1', float) == {'alice': 2.0, 'bob': 0.5, '*': 1.0}
+    assert parse_user_values('', int) == {}
+
+
+def test_oldest_head_first():
+    queue = FairShareQueue({}, {}, {})
+    queue.add(1, 'a', make_tasks('a', [3, 4]))
+    queue.add(1, 'b', make_tasks('b', [1, 2]))
+    assert [task_id for task_id, _ in dispatch(queue, ['d1', 'd2', 'd3'])] == ['b0', 'a0', 'b1']
+
+
+def test_higher_priority_first():
+    queue = FairShareQueue({}, {}, {})
+    queue.add(1, 'a', make_tasks('a', [1, 2]))
+    queue.add(2, 'b', make_tasks('b', [5, 6]))
+    assert [task_id for task_id, _ in dispatch(queue, ['d1', 'd2', 'd3'])] == ['b0', 'b1', 'a0']
+
+
+def test_share_follows_weight_and_active_tasks():
+    queue = FairShareQueue({'a': 2.0}, {}, {})
+    queue.add(1, 'a', make_tasks('a', range(0, 20, 2)))
+    queue.add(1, 'b', make_tasks('b', range(1, 20, 2)))
+    users = [task_id[0] for task_id, _ in dispatch(queue, [f'd{i}' for i in range(6)])]
+    assert users.count('a') == 4 and users.count('b') == 2
+
+    queue = FairShareQueue({}, {}, {'a': 3})
+    queue.add(1, 'a', make_tasks('a', [1, 2]))
+    queue.add(1, 'b', make_tasks('b', [5, 6]))
+    assert [task_id for task_id, _ in dispatch(queue, ['d1', 'd2', 'd3'])] == ['b0', 'b1', 'a0']
+
+
+def test_user_max_tasks():
+    queue = FairShareQueue({}, {'a': 2, '*': 1}, {'c': 1})
+    queue.add(1, 'a', make_tasks('a', [1, 2, 3]))
+    queue.add(1, 'b', make_tasks('b', [4, 5]))
+    queue.add(1, 'c', make_tasks('c', [0]))
+    assert sorted(task_id for task_id, _ in dispatch(queue, [f'd{i}' for i in range(6)])) == ['a0', 'a1', 'b0']
+    assert queue.active_tasks == {'a': 2, 'b': 1, 'c': 1}
+
+
+def test_cursor_skips_tasks_without_free_device():
+    consumed = []
+
+    def iter_tasks(tasks):
+        for task in tasks:
+            consumed.append(task['_id'])
+            yield task
+
+    tasks = make_tasks('a', [1, 2, 3, 4])
+    tasks[0]['devices'] = ['busy']
+    queue = FairShareQueue({}, {}, {})
+    queue.add(1, 'a', iter_tasks(tasks))
+    queue.add(1, 'b', iter_tasks(make_tasks('b', [5, 6, 7])))
+    assert dispatch(queue, ['d1', 'd2']) == [('a1', 'd1'), ('b0', 'd2')]
+    # each queue is read lazily, at most one task past its last dispatched one
+    assert consumed == ['a0', 'b0', 'a1', 'a2', 'b1']